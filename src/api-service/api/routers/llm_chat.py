@@ -1,60 +1,147 @@
 import os
-from fastapi import APIRouter, Header, Query, Body, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Header, Query, Body, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from typing import Dict, Any, List, Optional
 import uuid
 import time
 from datetime import datetime
-import mimetypes
-from pathlib import Path
-from api.utils.llm_utils import chat_sessions, create_chat_session, generate_chat_response, rebuild_chat_session
-from api.utils.chat_utils import ChatHistoryManager
+from api.utils.llm_utils import chat_sessions, create_chat_session, generate_chat_response, generate_chat_response_stream, preprocess_image, rebuild_chat_session
+from api.utils.chat_utils import create_chat_history_manager
+from api.utils.backend_utils import run_in_backend
+from api.utils.fair_queue_utils import stream_fairly, submit_fairly
+from api.utils.idempotency_utils import run_idempotent
+from api.utils.image_utils import chat_image_blob_response, legacy_chat_image_response
+from api.utils.request_utils import read_chat_message, register_upload
+from api.utils.response_cache_utils import generate_once, lookup_first_turn, store_first_turn
+from api.utils.stream_utils import EVENT_STREAM_HEADERS, EVENT_STREAM_MEDIA_TYPE, sse_event, wants_event_stream
 
 # Define Router
 router = APIRouter()
 
 # Initialize chat history manager and sessions
-chat_manager = ChatHistoryManager(model="llm")
+chat_manager = create_chat_history_manager(model="llm")
 
 @router.get("/chats")
-async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None):
-    """Get all chats, optionally limited to a specific number"""
+async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None, before: Optional[str] = None):
+    """
+    Get chat summaries (chat_id, title, dts, cursor), newest first. Use limit to page
+    and pass the cursor of the last chat received as before to get the next page.
+    """
     print("x_session_id:", x_session_id)
-    return chat_manager.get_recent_chats(x_session_id, limit)
+    try:
+        return await run_in_backend("history", chat_manager.get_recent_chats, x_session_id, limit, before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/chats/{chat_id}")
 async def get_chat(chat_id: str, x_session_id: str = Header(None, alias="X-Session-ID")):
     """Get a specific chat by ID"""
     print("x_session_id:", x_session_id)
-    chat = chat_manager.get_chat(chat_id, x_session_id)
+    chat = await run_in_backend("history", chat_manager.get_chat, chat_id, x_session_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     return chat
 
+def stream_chat_response(chat: Dict, chat_session, message: Dict, x_session_id: str, first_turn: bool = False, cached_response: Optional[str] = None) -> StreamingResponse:
+    """
+    Stream the assistant's reply as server-sent events. Each 'message' event holds
+    a text delta; once the reply is complete the chat is saved and sent in a 'done'
+    event. Failures are reported in an 'error' event. A cached first-turn reply is
+    sent as a single delta.
+    """
+    async def events():
+        chunks = []
+        start = time.perf_counter()
+        try:
+            if cached_response is not None:
+                chunks.append(cached_response)
+                yield sse_event({"chat_id": chat["chat_id"], "delta": cached_response})
+            else:
+                async for chunk in stream_fairly(chat_manager.model, x_session_id, generate_chat_response_stream, chat_session, message):
+                    chunks.append(chunk)
+                    yield sse_event({"chat_id": chat["chat_id"], "delta": chunk})
+        except HTTPException as e:
+            yield sse_event({"status_code": e.status_code, "detail": e.detail}, event="error")
+            return
+        except Exception as e:
+            yield sse_event({"status_code": 500, "detail": f"Failed to generate response: {str(e)}"}, event="error")
+            return
+
+        chat_sessions[chat["chat_id"]] = chat_session
+        if first_turn and cached_response is None:
+            await run_in_backend(chat_manager.model, store_first_turn, chat_manager.model, message, "".join(chunks), time.perf_counter() - start)
+
+        # Add messages
+        chat["messages"].append(message)
+        chat["messages"].append({
+            "message_id": str(uuid.uuid4()),
+            "role": "assistant",
+            "content": "".join(chunks)
+        })
+
+        # Save chat
+        await run_in_backend("history", chat_manager.save_chat, chat, x_session_id)
+        yield sse_event(chat, event="done")
+
+    return StreamingResponse(events(), media_type=EVENT_STREAM_MEDIA_TYPE, headers=EVENT_STREAM_HEADERS)
+
 @router.post("/chats")
-async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, alias="X-Session-ID")):
+async def start_chat_with_llm(request: Request, response: Response, x_session_id: str = Header(None, alias="X-Session-ID"), accept: Optional[str] = Header(None), idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """
+    Start a new chat with an initial message, sent as JSON (base64 image) or as
+    multipart/form-data (binary image). Streamed if Accept is text/event-stream.
+    A retry with the same Idempotency-Key gets the chat created by the first attempt.
+    """
+    if idempotency_key and not wants_event_stream(accept):
+        return await run_idempotent((chat_manager.model, x_session_id, None), idempotency_key, response, start_chat, request, x_session_id, accept)
+    return await start_chat(request, x_session_id, accept)
+
+async def start_chat(request: Request, x_session_id: str, accept: Optional[str]):
+    """Create a chat from its first message and generate the reply"""
+    message = await read_chat_message(request)
     print("content:", message["content"])
     print("x_session_id:", x_session_id)
-    """Start a new chat with an initial message"""
     chat_id = str(uuid.uuid4())
     current_time = int(time.time())
     
-    # Create a new chat session
-    chat_session = create_chat_session()
-    chat_sessions[chat_id] = chat_session
-    
     # Add ID and role to the user message
     message["message_id"] = str(uuid.uuid4())
     message["role"] = "user"
-    
-    # Generate response
-    assistant_response = generate_chat_response(chat_session, message)
-    
-    # Create chat response
+
+    # Reuse the reply to the same image and prompt, rebuilding the session from it
+    cached_response = await run_in_backend(chat_manager.model, lookup_first_turn, chat_manager.model, message)
+    if cached_response is not None:
+        chat_session = await run_in_backend("history", rebuild_chat_session, [message, {"role": "assistant", "content": cached_response}])
+    else:
+        # Create a new chat session
+        chat_session = create_chat_session()
+
+    # Create chat title
     title = message.get("content")
     if title == "":
         title =  "Image chat"
     title = title[:50] + "..."
+
+    if wants_event_stream(accept):
+        chat = {"chat_id": chat_id, "title": title, "dts": current_time, "messages": []}
+        return stream_chat_response(chat, chat_session, message, x_session_id, first_turn=True, cached_response=cached_response)
+    
+    # Generate response
+    if cached_response is None:
+        start = time.perf_counter()
+        assistant_response, shared = await generate_once(chat_manager.model, generate_chat_response, chat_session, message, [], x_session_id)
+        if shared:
+            # Generated by an identical request in flight, in that request's session
+            chat_session = await run_in_backend("history", rebuild_chat_session, [message, {"role": "assistant", "content": assistant_response}])
+        else:
+            await run_in_backend(chat_manager.model, store_first_turn, chat_manager.model, message, assistant_response, time.perf_counter() - start)
+    else:
+        assistant_response = cached_response
+
+    # Cache the session (after generating, so its history size is measured)
+    chat_sessions[chat_id] = chat_session
+    
+    # Create chat response
     chat_response = {
         "chat_id": chat_id,
         "title": title,
@@ -70,23 +157,33 @@ async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, al
     }
     
     # Save chat
-    chat_manager.save_chat(chat_response, x_session_id)
+    await run_in_backend("history", chat_manager.save_chat, chat_response, x_session_id)
     return chat_response
 
 @router.post("/chats/{chat_id}")
-async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str = Header(None, alias="X-Session-ID")):
+async def continue_chat_with_llm(chat_id: str, request: Request, response: Response, x_session_id: str = Header(None, alias="X-Session-ID"), accept: Optional[str] = Header(None), idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """
+    Add a message to an existing chat, sent as JSON (base64 image) or as
+    multipart/form-data (binary image). Streamed if Accept is text/event-stream.
+    A retry with the same Idempotency-Key gets the chat updated by the first attempt.
+    """
+    if idempotency_key and not wants_event_stream(accept):
+        return await run_idempotent((chat_manager.model, x_session_id, chat_id), idempotency_key, response, continue_chat, chat_id, request, x_session_id, accept)
+    return await continue_chat(chat_id, request, x_session_id, accept)
+
+async def continue_chat(chat_id: str, request: Request, x_session_id: str, accept: Optional[str]):
+    """Add a message to a chat and generate the reply"""
+    message = await read_chat_message(request)
     print("content:", message["content"])
     print("x_session_id:", x_session_id)
-    """Add a message to an existing chat"""
-    chat = chat_manager.get_chat(chat_id, x_session_id)
+    chat = await run_in_backend("history", chat_manager.get_chat, chat_id, x_session_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
     # Get or rebuild chat session
     chat_session = chat_sessions.get(chat_id)
     if not chat_session:
-        chat_session = rebuild_chat_session(chat["messages"])
-        chat_sessions[chat_id] = chat_session
+        chat_session = await run_in_backend("history", rebuild_chat_session, chat["messages"])
     
     # Update timestamp
     current_time = int(time.time())
@@ -95,9 +192,16 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
     # Add message ID and role
     message["message_id"] = str(uuid.uuid4())
     message["role"] = "user"
+
+    if wants_event_stream(accept):
+        return stream_chat_response(chat, chat_session, message, x_session_id)
     
     # Generate response
-    assistant_response = generate_chat_response(chat_session, message)
+    assistant_response, shared = await generate_once(chat_manager.model, generate_chat_response, chat_session, message, chat["messages"], x_session_id)
+    if shared:
+        # Generated by an identical request in flight, in that request's session
+        chat_session = await run_in_backend("history", rebuild_chat_session, chat["messages"] + [message, {"role": "assistant", "content": assistant_response}])
+    chat_sessions[chat_id] = chat_session
     
     # Add messages
     chat["messages"].append(message)
@@ -108,60 +212,50 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
     })
     
     # Save updated chat
-    chat_manager.save_chat(chat, x_session_id)
+    await run_in_backend("history", chat_manager.save_chat, chat, x_session_id)
     return chat
 
+@router.post("/images")
+async def upload_chat_image(request: Request, x_session_id: str = Header(None, alias="X-Session-ID")):
+    """
+    Upload the image of the next message as soon as it is attached (multipart 'image'
+    file or JSON base64 'image'). Its description, embedding and resizing start in the
+    background; send the returned image_handle with the chat message to reuse them.
+    """
+    message = await read_chat_message(request)
+    image = message.get("image")
+    if not image:
+        raise HTTPException(status_code=400, detail="No image uploaded")
+    
+    image_handle = register_upload(image)
+    submit_fairly(chat_manager.model, x_session_id, preprocess_image, image)
+    return {"image_handle": image_handle, "mime_type": image.mime_type, "size": len(image)}
+
+@router.get("/images/blobs/{shard}/{blob_name}")
+async def get_chat_image_blob(shard: str, blob_name: str, request: Request):
+    """
+    Serve a content-addressed image from the chat history. The URL never changes
+    content, so responses carry a strong ETag and long-lived cache headers.
+    
+    Args:
+        shard: First two characters of the image digest
+        blob_name: The image digest and extension
+    
+    Returns:
+        Response: The image (200/206), or 304 if the client copy is current
+    """
+    return await chat_image_blob_response(request, chat_manager.blob_store, shard, blob_name)
+
 @router.get("/images/{chat_id}/{message_id}.png")
-async def get_chat_image(chat_id: str, message_id: str):
+async def get_chat_image(chat_id: str, message_id: str, request: Request):
     """
-    Serve an image from the chat history.
+    Serve an image from the chat history (images saved before the blob store).
     
     Args:
         chat_id: The chat ID
         message_id: The message ID
     
     Returns:
-        FileResponse: The image file with appropriate content type
+        Response: The image file with appropriate content type
     """
-    try:
-        # Construct the image path
-        image_path = os.path.join(
-            chat_manager.images_dir,
-            chat_id,
-            f"{message_id}.png"
-        )
-        
-        # Verify the path exists and is within the images directory
-        image_path = Path(image_path).resolve()
-        images_dir = Path(chat_manager.images_dir).resolve()
-        
-        # Security check: ensure the requested file is within the images directory
-        if not str(image_path).startswith(str(images_dir)):
-            raise HTTPException(
-                status_code=403,
-                detail="Access denied"
-            )
-        
-        if not image_path.exists():
-            raise HTTPException(
-                status_code=404,
-                detail="Image not found"
-            )
-        
-        # Determine content type
-        content_type, _ = mimetypes.guess_type(str(image_path))
-        if not content_type:
-            content_type = "application/octet-stream"
-        
-        return FileResponse(
-            path=image_path,
-            media_type=content_type
-        )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error serving image: {str(e)}"
-        )
\ No newline at end of file
+    return await legacy_chat_image_response(request, chat_manager.images_dir, chat_id, message_id)
@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import FileResponse
+from typing import Dict, Any, List, Optional
+import os
+from api.utils.profiling_utils import PROFILE_ID_PATTERN, check_profile_token, list_profiles, profile_path
+
+# Define Router
+router = APIRouter()
+
+@router.get("")
+async def get_profiles(x_profile_token: Optional[str] = Header(None, alias="X-Profile-Token")) -> List[Dict[str, Any]]:
+    """List the saved request profiles (profile_id, size, created), newest first"""
+    check_profile_token(x_profile_token)
+    return list_profiles()
+
+@router.get("/{profile_id}")
+async def get_profile(profile_id: str, x_profile_token: Optional[str] = Header(None, alias="X-Profile-Token")):
+    """Download a request profile as a speedscope file (open it at https://www.speedscope.app)"""
+    check_profile_token(x_profile_token)
+    path = profile_path(profile_id)
+    if not PROFILE_ID_PATTERN.match(profile_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=os.path.basename(path))
@@ -1,8 +1,26 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 # from api.routers import newsletter, podcast
-from api.routers import llm_rag_chat, llm_chat, llm_llama_chat
+from api.routers import llm_rag_chat, llm_chat, llm_llama_chat, profiles
 from fastapi.routing import APIRoute
+from api.utils.backend_utils import backend_stats
+from api.utils.fair_queue_utils import fair_queue_stats
+from api.utils.session_utils import chat_sessions
+from api.utils.image_utils import image_normalizer
+from api.utils.llm_image_utils import image_embedding_engine
+from api.utils.embedding_utils import query_embedding_cache
+from api.utils.response_cache_utils import generation_stats, response_cache
+from api.utils.description_utils import description_store
+from api.utils.context_utils import context_builder
+from api.utils.history_compaction_utils import history_compactor
+from api.utils.http_utils import close_http_clients, http_client_stats
+from api.utils.idempotency_utils import idempotency_store
+from api.utils.rate_limit_utils import rate_limit_stats
+from api.utils.startup_utils import WARMUP_ON_STARTUP, readiness, start_warmup
+from api.utils.metrics_utils import PROMETHEUS_CONTENT_TYPE, registry
+from api.utils.tracing_utils import TracingMiddleware, flush_traces, tracing_stats
+from api.utils.profiling_utils import PROFILING_ENABLED, ProfilingMiddleware
 
 # Setup FastAPI app
 app = FastAPI(title="API Server", description="API Server", version="v1")
@@ -16,15 +34,68 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Root span of every request, labelled with the chat backend of its path prefix
+app.add_middleware(TracingMiddleware, backends=("llm", "llm-llama", "llm-rag"))
+
+# On-demand request profiling (X-Profile: 1 or PROFILE_SAMPLE_RATE); nothing is
+# installed unless PROFILING_ENABLED
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+@app.on_event("startup")
+async def startup():
+    # Models and connections are created lazily; load them in the background so the
+    # server listens right away and /readyz reports when they are ready
+    if WARMUP_ON_STARTUP:
+        start_warmup()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Close the pooled keep-alive connections to the model backends
+    await close_http_clients()
+    flush_traces()
+
 # Routes
 @app.get("/")
 async def get_index():
     return {"message": "The API is working!!!"}
 
+@app.get("/healthz")
+async def get_liveness():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def get_readiness():
+    """Readiness: 200 once every required dependency is initialized, else 503"""
+    report = readiness()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Latency histograms (per stage and per backend) in the Prometheus text format"""
+    return PlainTextResponse(registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.get("/status")
 async def get_api_status():
     return {
         "version": "3.1",
+        "dependencies": readiness()["dependencies"],
+        "backends": backend_stats(),
+        "fair_queues": fair_queue_stats(),
+        "http_clients": http_client_stats(),
+        "rate_limits": rate_limit_stats(),
+        "session_cache": chat_sessions.stats(),
+        "image_normalizer": image_normalizer.stats(),
+        "image_embedding": image_embedding_engine.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "generation_coalescing": generation_stats(),
+        "idempotency": idempotency_store.stats(),
+        "description_store": description_store.stats(),
+        "rag_context": context_builder.stats(),
+        "history_compaction": history_compactor.stats(),
+        "tracing": tracing_stats(),
     }
 
 # Additional routers here
@@ -33,4 +104,6 @@ async def get_api_status():
 app.include_router(llm_chat.router, prefix="/llm")
 app.include_router(llm_llama_chat.router, prefix="/llm-llama")
 app.include_router(llm_rag_chat.router, prefix="/llm-rag")
+if PROFILING_ENABLED:
+    app.include_router(profiles.router, prefix="/admin/profiles")
 # app.include_router(llm_agent_chat.router, prefix="/llm-agent")
@@ -0,0 +1,273 @@
+import os
+import asyncio
+import contextvars
+import functools
+import inspect
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator
+from api.utils.profiling_utils import current_profile
+
+# Default number of concurrent calls allowed per backend. Each backend gets its own
+# bounded thread pool so a slow upstream can only exhaust its own slots and never
+# blocks the event loop (or the other backends).
+DEFAULT_MAX_CONCURRENCY = 32
+
+# Backends used by the API and their concurrency limits, overridable with
+# <NAME>_MAX_CONCURRENCY environment variables (e.g. LLM_RAG_MAX_CONCURRENCY=16)
+BACKEND_CONCURRENCY = {
+    "llm": DEFAULT_MAX_CONCURRENCY,
+    "llm-llama": DEFAULT_MAX_CONCURRENCY,
+    "llm-rag": DEFAULT_MAX_CONCURRENCY,
+    "history": 8,
+}
+
+
+def _concurrency_env_name(name: str) -> str:
+    return name.upper().replace("-", "_") + "_MAX_CONCURRENCY"
+
+
+class BackendExecutor:
+    def __init__(self, name: str, max_concurrency: int):
+        """Bounded thread pool that runs blocking backend calls off the event loop"""
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix=f"backend-{name}"
+        )
+        self._lock = threading.Lock()
+        # Bounds the coroutine calls (async HTTP clients) the same way the pool bounds
+        # the blocking ones; semaphores belong to an event loop
+        self._semaphores: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+
+    def _run(self, func: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+        # A profiled request's calls are sampled in the worker thread too
+        profile = current_profile()
+        if profile is not None:
+            profile.add_thread()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            if profile is not None:
+                profile.remove_thread()
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+        return result
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run a blocking function in this backend's pool and await its result.
+
+        The caller's context variables are copied into the worker thread so request
+        scoped state follows the call.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        with self._lock:
+            self._pending += 1
+        call = functools.partial(context.run, self._run, func, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                for stale_loop in [stale for stale in self._semaphores if stale.is_closed()]:
+                    del self._semaphores[stale_loop]
+                semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._semaphores[loop] = semaphore
+            return semaphore
+
+    def _started(self) -> None:
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+
+    def _finished(self, failed: bool) -> None:
+        with self._lock:
+            self._running -= 1
+            self._completed += 1
+            if failed:
+                self._failed += 1
+
+    async def run_async(self, func: Callable, *args, **kwargs) -> Any:
+        """Await a coroutine function on the event loop, holding one of this backend's slots"""
+        with self._lock:
+            self._pending += 1
+        async with self._semaphore():
+            self._started()
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException:
+                self._finished(failed=True)
+                raise
+            self._finished(failed=False)
+        return result
+
+    async def stream_async(self, func: Callable[..., AsyncIterator], *args, **kwargs) -> AsyncIterator:
+        """Iterate an async generator on the event loop, holding one slot for the whole stream"""
+        with self._lock:
+            self._pending += 1
+        async with self._semaphore():
+            self._started()
+            failed = False
+            iterator = func(*args, **kwargs)
+            try:
+                async for item in iterator:
+                    yield item
+            except Exception:
+                failed = True
+                raise
+            finally:
+                # Also runs when the consumer stops early (client disconnected)
+                await iterator.aclose()
+                self._finished(failed)
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """Start a blocking function in this backend's pool without waiting for it"""
+        context = contextvars.copy_context()
+        with self._lock:
+            self._pending += 1
+        return self._executor.submit(context.run, self._run, func, *args, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "running": self._running,
+                "queued": self._pending,
+                "completed": self._completed,
+                "failed": self._failed,
+            }
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+_executors: Dict[str, BackendExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_backend_executor(name: str) -> BackendExecutor:
+    """Get (or lazily create) the executor for a backend"""
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            default = BACKEND_CONCURRENCY.get(name, DEFAULT_MAX_CONCURRENCY)
+            max_concurrency = int(os.environ.get(_concurrency_env_name(name), default))
+            executor = BackendExecutor(name, max(1, max_concurrency))
+            _executors[name] = executor
+        return executor
+
+
+async def run_in_backend(backend: str, func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking backend call (Vertex AI, ChromaDB, file IO) without blocking the
+    event loop. Coroutine functions (async HTTP calls, e.g. Modal) are awaited on
+    the loop instead, within the same concurrency limit.
+
+    Args:
+        backend: Name of the backend pool to run the call in
+        func: The blocking function or coroutine function to call
+        *args, **kwargs: Arguments passed to func
+
+    Returns:
+        Any: The function's return value (exceptions are re-raised)
+    """
+    executor = get_backend_executor(backend)
+    if inspect.iscoroutinefunction(func):
+        return await executor.run_async(func, *args, **kwargs)
+    return await executor.run(func, *args, **kwargs)
+
+
+def submit_in_backend(backend: str, func: Callable, *args, **kwargs) -> Future:
+    """
+    Start a blocking backend call in the background (e.g. speculative preprocessing).
+    Failures are logged, callers that need the result wait on the returned future.
+    """
+    def log_failure(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Background {backend} call {getattr(func, '__name__', func)} failed: {future.exception()}")
+
+    future = get_backend_executor(backend).submit(func, *args, **kwargs)
+    future.add_done_callback(log_failure)
+    return future
+
+
+async def stream_in_backend(backend: str, func: Callable[..., Iterator], *args, **kwargs) -> AsyncIterator:
+    """
+    Consume a blocking generator (e.g. a streamed model response) in a backend pool
+    and yield its items on the event loop as they arrive.
+
+    The whole stream holds a single slot of the backend pool. If the consumer stops
+    early (client disconnected) the generator is closed after its next item. Async
+    generator functions are iterated on the loop directly.
+    """
+    if inspect.isasyncgenfunction(func):
+        async for item in get_backend_executor(backend).stream_async(func, *args, **kwargs):
+            yield item
+        return
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stopped = threading.Event()
+    end_of_stream = object()
+
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:
+            # Event loop already closed
+            stopped.set()
+
+    def produce():
+        try:
+            iterator = func(*args, **kwargs)
+            try:
+                for item in iterator:
+                    if stopped.is_set():
+                        break
+                    put(item)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+        except BaseException as e:
+            put(end_of_stream, e)
+            return
+        put(end_of_stream)
+
+    producer = asyncio.ensure_future(run_in_backend(backend, produce))
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is end_of_stream:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        stopped.set()
+        if producer.done() and not producer.cancelled():
+            producer.exception()
+
+
+def backend_stats() -> Dict[str, Dict[str, int]]:
+    """Runtime stats for every backend pool created so far"""
+    with _executors_lock:
+        executors = list(_executors.values())
+    return {executor.name: executor.stats() for executor in executors}
@@ -1,12 +1,43 @@
 import json
 import os
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 import shutil
 import glob
 import base64
 import traceback
 import io
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from api.utils.image_utils import BlobStore, ChatImage
+from api.utils.tracing_utils import traced_method
+
+# Chat history storage: "json" (one file per chat), "jsonl" (append-only log per chat) or "sqlite"
+CHAT_HISTORY_BACKEND = os.environ.get("CHAT_HISTORY_BACKEND", "json")
+CHAT_HISTORY_DB_NAME = "chat-history.db"
+
+# Append-only log settings
+CHAT_LOG_FSYNC_INTERVAL = float(os.environ.get("CHAT_LOG_FSYNC_INTERVAL", 0.05))
+CHAT_LOG_COMPACT_THRESHOLD = int(os.environ.get("CHAT_LOG_COMPACT_THRESHOLD", 50))
+CHAT_LOG_COMPACT_INTERVAL = float(os.environ.get("CHAT_LOG_COMPACT_INTERVAL", 60))
+CHAT_LOG_MAX_TRACKED_CHATS = 10000
+CHAT_LOG_MAX_INDEXED_SESSIONS = int(os.environ.get("CHAT_LOG_MAX_INDEXED_SESSIONS", 1000))
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    model TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    title TEXT,
+    dts INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (model, session_id, chat_id)
+);
+DROP INDEX IF EXISTS idx_chats_model_session_dts;
+CREATE INDEX IF NOT EXISTS idx_chats_model_session_dts_chat ON chats (model, session_id, dts, chat_id);
+"""
         
 class ChatHistoryManager:
     def __init__(self, model, history_dir: str = "chat-history"):
@@ -15,6 +46,7 @@ class ChatHistoryManager:
         self.history_dir = os.path.join(history_dir, model)
         self.images_dir = os.path.join(self.history_dir, "images")
         self._ensure_directories()
+        self.blob_store = BlobStore(os.path.join(self.images_dir, "blobs"))
     
     def _ensure_directories(self) -> None:
         """Ensure the chat history directory exists"""
@@ -25,39 +57,25 @@ class ChatHistoryManager:
         """Get the full file path for a chat JSON file"""
         return os.path.join(self.history_dir, session_id, f"{chat_id}.json")
     
-    def _save_image(self, chat_id: str, message_id: str, image_data: str) -> str:
+    def _save_image(self, chat_id: str, message_id: str, image_data) -> str:
         """
-        Save image data to a file and return the relative path.
+        Save image data to the content-addressed blob store and return the relative
+        path (images/blobs/<digest[:2]>/<digest><ext>, with the extension of the
+        detected image type).
         
         Args:
             chat_id: The chat ID
             message_id: The message ID
-            image_data: Base64 encoded image data
+            image_data: ChatImage or base64 encoded image data
         
         Returns:
             str: Relative path to the saved image
         """
-        # Create chat-specific image directory
-        chat_images_dir = os.path.join(self.images_dir, chat_id)
-        os.makedirs(chat_images_dir, exist_ok=True)
-        
-        # Save image to file
-        image_path = os.path.join(chat_images_dir, f"{message_id}.png")
         try:
-            # Extract the actual base64 data and mime type
-            base64_string = image_data
-            if ',' in base64_string:
-                header, base64_data = base64_string.split(',', 1)
-                mime_type = header.split(':')[1].split(';')[0]
-            else:
-                base64_data = base64_string
-                mime_type = 'image/jpeg'  # default to JPEG if no header
-            
-            # Decode base64 to bytes
-            image_bytes = base64.b64decode(base64_data)
-            
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
+            image = ChatImage.coerce(image_data)
+
+            # Content addressed: identical images are only stored once
+            _, image_path = self.blob_store.put(image.data, image.mime_type)
             
             # Return relative path from chat history root
             return os.path.relpath(image_path, self.history_dir)
@@ -87,12 +105,9 @@ class ChatHistoryManager:
             traceback.print_exc()
         return None
     
-    def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
-        """Save a chat to both memory and file, handling images separately"""
-        chat_dir = os.path.join(self.history_dir,session_id)
-        os.makedirs(chat_dir, exist_ok=True)
-        
-        # Process messages to save images separately
+    @traced_method("history.save_images")
+    def _extract_images(self, chat_to_save: Dict) -> None:
+        """Save message images to files and replace them with their paths"""
         for message in chat_to_save["messages"]:
             if "image" in message and message["image"] is not None:
                 #print("image:",message["image"])
@@ -105,6 +120,15 @@ class ChatHistoryManager:
                 if image_path:
                     message["image_path"] = image_path
                 del message["image"]
+
+    @traced_method("history.save")
+    def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
+        """Save a chat to both memory and file, handling images separately"""
+        chat_dir = os.path.join(self.history_dir,session_id)
+        os.makedirs(chat_dir, exist_ok=True)
+        
+        # Process messages to save images separately
+        self._extract_images(chat_to_save)
         
         # Save chat data
         filepath = self._get_chat_filepath(chat_to_save["chat_id"], session_id)
@@ -116,6 +140,7 @@ class ChatHistoryManager:
             traceback.print_exc()
             raise e
 
+    @traced_method("history.load")
     def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
         """Get a specific chat by ID"""
         filepath = os.path.join(self.history_dir,session_id,f"{chat_id}.json")
@@ -128,8 +153,19 @@ class ChatHistoryManager:
             traceback.print_exc()
         return chat_data
     
-    def get_recent_chats(self, session_id: str, limit: Optional[int] = None) -> List[Dict]:
-        """Get recent chats, optionally limited to a specific number"""        
+    @traced_method("history.list")
+    def get_recent_chats(self, session_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """
+        Get summaries (chat_id, title, dts, cursor) of recent chats, newest first.
+
+        Args:
+            session_id: The session the chats belong to
+            limit: Optional maximum number of chats to return
+            before: Optional cursor of the last chat of the previous page
+
+        Raises:
+            ValueError: If before is not a valid cursor
+        """
         chat_dir = os.path.join(self.history_dir,session_id)
         os.makedirs(chat_dir, exist_ok=True)
         recent_chats = []
@@ -138,14 +174,460 @@ class ChatHistoryManager:
             try:
                 with open(filepath, 'r', encoding='utf-8') as f:
                     chat_data = json.load(f)        
-                    recent_chats.append(chat_data)
+                    recent_chats.append(chat_summary(chat_data))
             except Exception as e:
                 print(f"Error loading chat history from {filepath}: {str(e)}")
                 traceback.print_exc()
 
-        # Sort by dts
-        recent_chats.sort(key=lambda x: x.get('dts', 0), reverse=True)
+        return page_chats(recent_chats, limit, before)
+
+
+class SQLiteChatHistoryManager(ChatHistoryManager):
+    def __init__(self, model, history_dir: str = "chat-history", db_path: Optional[str] = None):
+        """
+        Chat history manager that stores chats in SQLite (WAL mode) instead of one
+        JSON file per chat. Images are still saved as files under history_dir.
+        """
+        super().__init__(model, history_dir)
+        self.db_path = db_path or os.path.join(history_dir, CHAT_HISTORY_DB_NAME)
+        self._local = threading.local()
+        self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (requests are served from a thread pool)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @traced_method("history.save")
+    def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
+        """Save a chat to the database, handling images separately"""
+        self._extract_images(chat_to_save)
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO chats (model, session_id, chat_id, title, dts, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        self.model,
+                        session_id,
+                        chat_to_save["chat_id"],
+                        chat_to_save.get("title"),
+                        chat_to_save.get("dts", 0),
+                        json.dumps(chat_to_save, ensure_ascii=False),
+                    )
+                )
+        except Exception as e:
+            print(f"Error saving chat {chat_to_save['chat_id']}: {str(e)}")
+            traceback.print_exc()
+            raise e
+
+    @traced_method("history.load")
+    def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
+        """Get a specific chat by ID"""
+        row = self._connection().execute(
+            "SELECT data FROM chats WHERE model = ? AND session_id = ? AND chat_id = ?",
+            (self.model, session_id, chat_id)
+        ).fetchone()
+        if row is None:
+            print(f"Chat {chat_id} not found for session {session_id}")
+            return {}
+        return json.loads(row[0])
+
+    @traced_method("history.list")
+    def get_recent_chats(self, session_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """Get summaries of recent chats, newest first, using the (model, session_id, dts, chat_id) index"""
+        query = "SELECT chat_id, title, dts FROM chats WHERE model = ? AND session_id = ?"
+        params = [self.model, session_id]
+        if before is not None:
+            query += " AND (dts, chat_id) < (?, ?)"
+            params.extend(decode_chat_cursor(before))
+        query += " ORDER BY dts DESC, chat_id DESC"
         if limit:
-            return recent_chats[:limit]
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = self._connection().execute(query, params).fetchall()
+        return [
+            {"chat_id": chat_id, "title": title, "dts": dts, "cursor": encode_chat_cursor(dts, chat_id)}
+            for chat_id, title, dts in rows
+        ]
+
+    def import_json_history(self) -> int:
+        """
+        Import the chats stored as JSON files (history_dir/<session_id>/<chat_id>.json)
+        for this model into the database.
+
+        Returns:
+            int: Number of chats imported
+        """
+        imported = 0
+        for filepath in glob.glob(os.path.join(self.history_dir, "*", "*.json")):
+            session_id = os.path.basename(os.path.dirname(filepath))
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    chat_data = json.load(f)
+                self.save_chat(chat_data, session_id)
+                imported += 1
+            except Exception as e:
+                print(f"Error importing chat history from {filepath}: {str(e)}")
+                traceback.print_exc()
+        return imported
+
+
+class JSONLChatHistoryManager(ChatHistoryManager):
+    def __init__(
+        self,
+        model,
+        history_dir: str = "chat-history",
+        fsync_interval: float = CHAT_LOG_FSYNC_INTERVAL,
+        compact_threshold: int = CHAT_LOG_COMPACT_THRESHOLD,
+        compact_interval: float = CHAT_LOG_COMPACT_INTERVAL,
+    ):
+        """
+        Chat history manager that appends each new message to a per-chat log
+        (<chat_id>.jsonl) instead of rewriting the whole chat on every turn.
+
+        Log records are fsynced in batches every fsync_interval seconds (0 fsyncs
+        every append). A background compactor folds logs with at least
+        compact_threshold records into the <chat_id>.json snapshot, which uses the
+        same format as ChatHistoryManager so existing chats keep working. Listing
+        is served from a per-session index of chat summaries, loaded once from the
+        snapshots and logs and kept up to date on append.
+        """
+        super().__init__(model, history_dir)
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+        self._locks = [threading.Lock() for _ in range(64)]
+        self._state_lock = threading.Lock()
+        # (session_id, chat_id) -> message ids already persisted (bounded LRU)
+        self._persisted_ids: "OrderedDict[tuple, set]" = OrderedDict()
+        # (session_id, chat_id) -> records in the log since the last compaction
+        self._log_records: Dict[tuple, int] = {}
+        # session_id -> chat_id -> summary (bounded LRU), and the saves made while
+        # a session's index is being loaded
+        self._indexes: "OrderedDict[str, Dict[str, Dict]]" = OrderedDict()
+        self._loading_indexes: Dict[str, Dict[str, Dict]] = {}
+        self._index_lock = threading.Lock()
+        self._dirty_logs: set = set()
+        self._background = None
+        self._stop = threading.Event()
+
+    def _get_log_filepath(self, chat_id: str, session_id: str) -> str:
+        return os.path.join(self.history_dir, session_id, f"{chat_id}.jsonl")
+
+    def _lock_for(self, key: tuple) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _ensure_background(self) -> None:
+        with self._state_lock:
+            if self._background is None:
+                self._background = threading.Thread(
+                    target=self._background_loop,
+                    name=f"chat-log-{self.model}",
+                    daemon=True
+                )
+                self._background.start()
+
+    def _background_loop(self) -> None:
+        """Flush dirty logs in batches and compact long logs"""
+        next_compaction = time.monotonic() + self.compact_interval
+        while not self._stop.wait(self.fsync_interval or self.compact_interval):
+            self.flush()
+            if time.monotonic() >= next_compaction:
+                self.compact()
+                next_compaction = time.monotonic() + self.compact_interval
+
+    def _read_log(self, filepath: str) -> List[Dict]:
+        records = []
+        if not os.path.exists(filepath):
+            return records
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A crash mid-append can leave a partial last line
+                    print(f"Skipping partial record in {filepath}")
+        return records
+
+    def _load_chat(self, chat_id: str, session_id: str) -> Tuple[Dict, int]:
+        """Rebuild a chat from its snapshot and log, returning it and the log length"""
+        chat_data = {}
+        snapshot_path = self._get_chat_filepath(chat_id, session_id)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'r', encoding='utf-8') as f:
+                chat_data = json.load(f)
+        records = self._read_log(self._get_log_filepath(chat_id, session_id))
+        if records:
+            chat_data.setdefault("messages", [])
+            message_ids = {message.get("message_id") for message in chat_data["messages"]}
+            for record in records:
+                if record["type"] == "chat":
+                    chat_data.update({k: v for k, v in record.items() if k != "type"})
+                elif record["type"] == "message" and record["message"].get("message_id") not in message_ids:
+                    # Messages can already be in the snapshot if a compaction was interrupted
+                    chat_data["messages"].append(record["message"])
+                    message_ids.add(record["message"].get("message_id"))
+        return chat_data, len(records)
+
+    def _remember_ids(self, key: tuple, message_ids: set) -> None:
+        self._persisted_ids[key] = message_ids
+        self._persisted_ids.move_to_end(key)
+        while len(self._persisted_ids) > CHAT_LOG_MAX_TRACKED_CHATS:
+            self._persisted_ids.popitem(last=False)
+
+    @traced_method("history.save")
+    def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
+        """Append the chat's new messages (and its title/dts) to its log"""
+        chat_dir = os.path.join(self.history_dir, session_id)
+        os.makedirs(chat_dir, exist_ok=True)
+        self._extract_images(chat_to_save)
+
+        chat_id = chat_to_save["chat_id"]
+        key = (session_id, chat_id)
+        with self._lock_for(key):
+            with self._state_lock:
+                persisted_ids = self._persisted_ids.get(key)
+            log_records = None
+            if persisted_ids is None:
+                # Only paid once per chat per process
+                stored_chat, log_records = self._load_chat(chat_id, session_id)
+                persisted_ids = {message.get("message_id") for message in stored_chat.get("messages", [])}
+
+            records = [{
+                "type": "chat",
+                "chat_id": chat_id,
+                "title": chat_to_save.get("title"),
+                "dts": chat_to_save.get("dts", 0),
+            }]
+            for message in chat_to_save["messages"]:
+                if message.get("message_id") not in persisted_ids:
+                    records.append({"type": "message", "message": message})
+
+            log_path = self._get_log_filepath(chat_id, session_id)
+            data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            try:
+                with open(log_path, 'a', encoding='utf-8') as f:
+                    f.write(data)
+                    if not self.fsync_interval:
+                        f.flush()
+                        os.fsync(f.fileno())
+            except Exception as e:
+                print(f"Error saving chat {chat_id}: {str(e)}")
+                traceback.print_exc()
+                raise e
+
+            summary = chat_summary(records[0])
+            with self._state_lock:
+                persisted_ids.update(record["message"].get("message_id") for record in records[1:])
+                self._remember_ids(key, persisted_ids)
+                for index in (self._indexes.get(session_id), self._loading_indexes.get(session_id)):
+                    if index is not None:
+                        index[chat_id] = summary
+                if log_records is not None:
+                    self._log_records[key] = log_records
+                self._log_records[key] = self._log_records.get(key, 0) + len(records)
+                if self.fsync_interval:
+                    self._dirty_logs.add(log_path)
+        self._ensure_background()
+
+    @traced_method("history.load")
+    def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
+        """Get a specific chat by ID, replaying its log on top of the snapshot"""
+        key = (session_id, chat_id)
+        try:
+            with self._lock_for(key):
+                chat_data, log_records = self._load_chat(chat_id, session_id)
+            if log_records:
+                with self._state_lock:
+                    self._log_records[key] = log_records
+        except Exception as e:
+            print(f"Error loading chat {chat_id}: {str(e)}")
+            traceback.print_exc()
+            chat_data = {}
+        return chat_data
+
+    def _chat_ids(self, session_id: str) -> set:
+        chat_dir = os.path.join(self.history_dir, session_id)
+        return {
+            os.path.splitext(os.path.basename(filepath))[0]
+            for pattern in ("*.json", "*.jsonl")
+            for filepath in glob.glob(os.path.join(chat_dir, pattern))
+        }
+
+    def _session_index(self, session_id: str) -> Dict[str, Dict]:
+        """The session's chat summaries, loaded from the snapshots and logs on first use"""
+        with self._state_lock:
+            index = self._indexes.get(session_id)
+            if index is not None:
+                self._indexes.move_to_end(session_id)
+                return index
+
+        with self._index_lock:
+            with self._state_lock:
+                index = self._indexes.get(session_id)
+                if index is not None:
+                    return index
+                # Chats saved while loading are recorded here, they are newer than what was read
+                self._loading_indexes[session_id] = {}
+
+            index = {}
+            try:
+                for chat_id in self._chat_ids(session_id):
+                    key = (session_id, chat_id)
+                    try:
+                        with self._lock_for(key):
+                            chat_data, log_records = self._load_chat(chat_id, session_id)
+                    except Exception as e:
+                        print(f"Error loading chat {chat_id}: {str(e)}")
+                        traceback.print_exc()
+                        continue
+                    if chat_data:
+                        index[chat_id] = chat_summary(chat_data)
+                    if log_records:
+                        with self._state_lock:
+                            self._log_records.setdefault(key, log_records)
+            finally:
+                with self._state_lock:
+                    index.update(self._loading_indexes.pop(session_id))
+                    self._indexes[session_id] = index
+                    while len(self._indexes) > CHAT_LOG_MAX_INDEXED_SESSIONS:
+                        self._indexes.popitem(last=False)
+            return index
+
+    @traced_method("history.list")
+    def get_recent_chats(self, session_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """Get summaries (chat_id, title, dts, cursor) of recent chats, newest first, from the session index"""
+        index = self._session_index(session_id)
+        with self._state_lock:
+            summaries = list(index.values())
+        return page_chats(summaries, limit, before)
+
+    def flush(self) -> None:
+        """fsync every log appended to since the last flush"""
+        with self._state_lock:
+            dirty_logs, self._dirty_logs = self._dirty_logs, set()
+        for log_path in dirty_logs:
+            try:
+                fd = os.open(log_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except FileNotFoundError:
+                # Compacted in the meantime, the snapshot is already synced
+                pass
+
+    def compact_chat(self, chat_id: str, session_id: str) -> None:
+        """Fold a chat's log into its snapshot and remove the log"""
+        key = (session_id, chat_id)
+        with self._lock_for(key):
+            chat_data, log_records = self._load_chat(chat_id, session_id)
+            if not log_records:
+                return
+            snapshot_path = self._get_chat_filepath(chat_id, session_id)
+            tmp_path = snapshot_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(chat_data, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, snapshot_path)
+            os.remove(self._get_log_filepath(chat_id, session_id))
+            with self._state_lock:
+                self._log_records.pop(key, None)
+
+    def _count_log_records(self, log_path: str) -> int:
+        with open(log_path, 'rb') as f:
+            return f.read().count(b"\n")
+
+    def compact(self, threshold: Optional[int] = None) -> int:
+        """
+        Compact every log on disk with at least threshold records (defaults to
+        compact_threshold). Logs this process has not appended to (e.g. written
+        before a restart) are counted from disk the first time they are seen.
+
+        Returns:
+            int: Number of chats compacted
+        """
+        threshold = self.compact_threshold if threshold is None else threshold
+        candidates = []
+        for log_path in glob.glob(os.path.join(self.history_dir, "*", "*.jsonl")):
+            key = (os.path.basename(os.path.dirname(log_path)), os.path.splitext(os.path.basename(log_path))[0])
+            with self._state_lock:
+                records = self._log_records.get(key)
+            if records is None:
+                try:
+                    records = self._count_log_records(log_path)
+                except FileNotFoundError:
+                    # Compacted in the meantime
+                    continue
+                with self._state_lock:
+                    records = self._log_records.setdefault(key, records)
+            if records >= threshold:
+                candidates.append(key)
+        for session_id, chat_id in candidates:
+            try:
+                self.compact_chat(chat_id, session_id)
+            except Exception as e:
+                print(f"Error compacting chat {chat_id}: {str(e)}")
+                traceback.print_exc()
+        return len(candidates)
+
+    def close(self) -> None:
+        """Stop the background thread after a final flush"""
+        self._stop.set()
+        self.flush()
+
+
+def chat_summary(chat: Dict) -> Dict:
+    """The fields of a chat needed to list it"""
+    return {"chat_id": chat.get("chat_id"), "title": chat.get("title"), "dts": chat.get("dts", 0)}
+
+
+def encode_chat_cursor(dts: int, chat_id: str) -> str:
+    """Opaque cursor of a chat's position in the newest-first listing"""
+    return base64.urlsafe_b64encode(f"{dts}:{chat_id}".encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_chat_cursor(cursor: str) -> Tuple[int, str]:
+    """
+    The (dts, chat_id) key of a cursor. dts alone share a second with other chats,
+    so pages are keyed on both. A plain dts (the cursor of older clients) is accepted
+    and returns the chats older than it.
+
+    Raises:
+        ValueError: If the cursor is not valid
+    """
+    cursor = str(cursor)
+    if cursor.isdigit():
+        return int(cursor), ""
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        dts, chat_id = decoded.split(":", 1)
+        return int(dts), chat_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Invalid chat cursor: {cursor}")
+
+
+def page_chats(summaries: List[Dict], limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+    """Order chat summaries newest first (ties by chat_id) and cut the page after the before cursor"""
+    if before is not None:
+        key = decode_chat_cursor(before)
+        summaries = [chat for chat in summaries if (chat["dts"], chat["chat_id"]) < key]
+    summaries.sort(key=lambda chat: (chat["dts"], chat["chat_id"]), reverse=True)
+    if limit:
+        summaries = summaries[:limit]
+    return [{**chat, "cursor": encode_chat_cursor(chat["dts"], chat["chat_id"])} for chat in summaries]
+
 
-        return recent_chats
+def create_chat_history_manager(model, history_dir: str = "chat-history") -> ChatHistoryManager:
+    """Create the chat history manager for the backend set by CHAT_HISTORY_BACKEND"""
+    if CHAT_HISTORY_BACKEND == "sqlite":
+        return SQLiteChatHistoryManager(model, history_dir)
+    if CHAT_HISTORY_BACKEND == "jsonl":
+        return JSONLChatHistoryManager(model, history_dir)
+    return ChatHistoryManager(model, history_dir)
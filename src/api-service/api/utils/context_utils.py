@@ -0,0 +1,245 @@
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+# Budget (estimated tokens) for the retrieved chunks added to a RAG prompt
+RAG_CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKEN_BUDGET", 2000))
+# A chunk is dropped when this fraction of its word shingles is already in the context
+RAG_CONTEXT_DUPLICATE_THRESHOLD = float(os.environ.get("RAG_CONTEXT_DUPLICATE_THRESHOLD", 0.8))
+# Words two chunks must share at their boundary to count as overlapping (splitter overlap)
+RAG_CONTEXT_MIN_OVERLAP_WORDS = int(os.environ.get("RAG_CONTEXT_MIN_OVERLAP_WORDS", 8))
+
+# Rough size of a Gemini token in characters of English text. Good enough to
+# budget prompts locally without a tokenizer round trip.
+CHARS_PER_TOKEN = 4
+SHINGLE_WORDS = 5
+
+WORD_PATTERN = re.compile(r"\S+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of model tokens of a text"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _spans(text: str) -> List[Tuple[int, int]]:
+    """Character spans of the words of a text (the words of text.split())"""
+    return [match.span() for match in WORD_PATTERN.finditer(text)]
+
+
+def _shingles(words: Sequence[str]) -> set:
+    if len(words) < SHINGLE_WORDS:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def _boundary_overlap(first: List[str], second: List[str], min_words: int) -> int:
+    """Number of words at the end of first that repeat at the start of second"""
+    if len(first) < min_words or len(second) < min_words:
+        return 0
+    head = second[:min_words]
+    # Candidate starts of the overlap in first, longest overlap first
+    start = max(0, len(first) - len(second))
+    last = len(first) - min_words
+    while start <= last:
+        try:
+            start = first.index(head[0], start, last + 1)
+        except ValueError:
+            return 0
+        if first[start:start + min_words] == head and first[start:] == second[:len(first) - start]:
+            return len(first) - start
+        start += 1
+    return 0
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """The longest run of whole words from the start of text within max_tokens"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    end = 0
+    for _, word_end in _spans(text):
+        if word_end > max_chars:
+            break
+        end = word_end
+    return text[:end]
+
+
+def re_rank_results(results, weights=(0.6, 0.4)):
+    """
+    Re-rank the results of a batched query based on weighted scores from each query.
+
+    Args:
+    - results (dict): Results of collection.query with one row of ids, distances and documents per query vector.
+    - weights (tuple): The weight to apply to each query's distances (default 0.6 combined, 0.4 text).
+
+    Returns:
+    - ranked_results (list): Unique documents sorted by the combined weighted score, as dicts with id, score and document.
+    """
+    rows = [row for row in range(len(results["ids"])) if results["ids"][row]]
+    if not rows:
+        return []
+    ids = np.concatenate([np.asarray(results["ids"][row], dtype=str) for row in rows])
+    distances = np.concatenate([np.asarray(results["distances"][row], dtype=np.float64) * weights[row] for row in rows])
+    documents = [document for row in rows for document in results["documents"][row]]
+
+    # Sum the weighted scores of documents returned by several queries (lower distances mean better matches)
+    unique_ids, first_index, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    scores = np.bincount(inverse.ravel(), weights=distances)
+    # Ties keep the order the documents were first returned in
+    order = np.lexsort((first_index, scores))
+
+    return [
+        {"id": str(unique_ids[i]), "score": float(scores[i]), "document": documents[first_index[i]]}
+        for i in order
+    ]
+
+
+def query_ranked(collection: Any, query_embeddings: List[List[float]], weights: Sequence[float], n_results: int = 5) -> List[Dict[str, Any]]:
+    """
+    Query the vector DB with several vectors in one round trip and fuse the results.
+
+    Args:
+        collection: The Chroma collection
+        query_embeddings: One vector per query
+        weights: The weight of each query's distances
+        n_results: Results per query
+
+    Returns:
+        List[Dict[str, Any]]: Unique documents, best first (see re_rank_results)
+    """
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        n_results=n_results,
+        include=["documents", "distances"]
+    )
+    return re_rank_results(results, weights=weights)
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        token_budget: int = RAG_CONTEXT_TOKEN_BUDGET,
+        duplicate_threshold: float = RAG_CONTEXT_DUPLICATE_THRESHOLD,
+        min_overlap_words: int = RAG_CONTEXT_MIN_OVERLAP_WORDS,
+    ):
+        """
+        Assembles the retrieved chunks of a RAG prompt. Chunks are taken best fused
+        score first; near duplicates of chunks already taken are dropped, the text a
+        chunk shares with a neighbouring chunk of the same source (splitter overlap)
+        is only kept once, and chunks are packed until the token budget is used. The
+        best chunk is truncated rather than dropped if it alone exceeds the budget.
+        """
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.min_overlap_words = min_overlap_words
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._chunks_retrieved = 0
+        self._chunks_used = 0
+        self._chunks_deduplicated = 0
+        self._chunks_over_budget = 0
+        self._tokens_retrieved = 0
+        self._tokens_used = 0
+
+    def build(self, ranked_results: List[Dict[str, Any]], token_budget: Optional[int] = None) -> Tuple[str, Dict[str, int]]:
+        """
+        Build the context text from ranked chunks.
+
+        Args:
+            ranked_results: Dicts with 'document' and 'score' (lower is better), e.g. re_rank_results
+            token_budget: Overrides the builder's budget
+
+        Returns:
+            Tuple[str, Dict[str, int]]: The context and the request's token accounting
+        """
+        budget = self.token_budget if token_budget is None else token_budget
+        ranked = sorted(ranked_results, key=lambda result: result.get("score", 0.0))
+
+        parts: List[str] = []
+        taken_words: List[List[str]] = []
+        taken_shingles: set = set()
+        tokens_retrieved = 0
+        used = 0
+        deduplicated = 0
+        over_budget = 0
+        for result in ranked:
+            text = result.get("document") or ""
+            tokens_retrieved += estimate_tokens(text)
+            if used >= budget:
+                over_budget += 1
+                continue
+            words = text.casefold().split()
+            if not words:
+                continue
+
+            shingles = _shingles(words)
+            if shingles and len(shingles & taken_shingles) >= self.duplicate_threshold * len(shingles):
+                deduplicated += 1
+                continue
+
+            # Cut the words this chunk repeats from a chunk already taken
+            start_word, end_word = 0, len(words)
+            for taken in taken_words:
+                start_word = max(start_word, _boundary_overlap(taken, words, self.min_overlap_words))
+                end_word = min(end_word, len(words) - _boundary_overlap(words, taken, self.min_overlap_words))
+            if start_word >= end_word:
+                deduplicated += 1
+                continue
+            if start_word or end_word < len(words):
+                spans = _spans(text)
+                text = text[spans[start_word][0]:spans[end_word - 1][1]]
+
+            tokens = estimate_tokens(text)
+            if used + tokens > budget:
+                if parts:
+                    over_budget += 1
+                    continue
+                # Better a truncated best chunk than no context at all
+                text = _truncate(text, budget)
+                tokens = estimate_tokens(text)
+                if not text:
+                    over_budget += 1
+                    continue
+
+            parts.append(text)
+            taken_words.append(words)
+            taken_shingles |= shingles
+            used += tokens
+
+        context = ' '.join(parts)
+        report = {
+            "chunks_retrieved": len(ranked),
+            "chunks_used": len(parts),
+            "chunks_deduplicated": deduplicated,
+            "chunks_over_budget": over_budget,
+            "tokens_retrieved": tokens_retrieved,
+            "tokens_used": estimate_tokens(context),
+        }
+        report["tokens_saved"] = max(0, tokens_retrieved - report["tokens_used"])
+        with self._lock:
+            self._requests += 1
+            self._chunks_retrieved += report["chunks_retrieved"]
+            self._chunks_used += report["chunks_used"]
+            self._chunks_deduplicated += deduplicated
+            self._chunks_over_budget += over_budget
+            self._tokens_retrieved += tokens_retrieved
+            self._tokens_used += report["tokens_used"]
+        return context, report
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "token_budget": self.token_budget,
+                "requests": self._requests,
+                "chunks_retrieved": self._chunks_retrieved,
+                "chunks_used": self._chunks_used,
+                "chunks_deduplicated": self._chunks_deduplicated,
+                "chunks_over_budget": self._chunks_over_budget,
+                "tokens_retrieved": self._tokens_retrieved,
+                "tokens_used": self._tokens_used,
+                "tokens_saved": max(0, self._tokens_retrieved - self._tokens_used),
+            }
+
+
+context_builder = ContextBuilder()
@@ -0,0 +1,258 @@
+import os
+import glob
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, Optional
+from api.utils.session_utils import SessionCache
+from api.utils.image_utils import ChatImage
+from api.utils.singleflight_utils import InFlightCalls
+from api.utils.rate_limit_utils import rate_limited
+from api.utils.tracing_utils import traced
+
+# Persistent store of generated image descriptions, shared by the API workers
+DESCRIPTION_STORE_DB = os.environ.get("DESCRIPTION_STORE_DB", "description-store/descriptions.db")
+DESCRIPTION_CACHE_MAX_ENTRIES = int(os.environ.get("DESCRIPTION_CACHE_MAX_ENTRIES", 5000))
+DESCRIPTION_CACHE_MAX_BYTES = int(os.environ.get("DESCRIPTION_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Descriptions generated offline by image_descriptions/cli.py are stored under this
+# version. They are used when no description exists for the live prompt.
+OFFLINE_PROMPT_VERSION = "offline"
+DESCRIPTION_USE_OFFLINE = os.environ.get("DESCRIPTION_USE_OFFLINE", "1") == "1"
+
+# Request sent with the image to the description model
+DESCRIPTION_REQUEST = "Please analyze this crochet item and provide a detailed description of the crochet item."
+
+DESCRIPTION_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS descriptions (
+    image_digest TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    description TEXT NOT NULL,
+    source TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (image_digest, prompt_version)
+);
+"""
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def prompt_version(*parts: Any) -> str:
+    """Short hash identifying a description prompt (model, instructions, settings)"""
+    raw = "\0".join(str(part) for part in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class DescriptionStore:
+    def __init__(
+        self,
+        db_path: Optional[str] = DESCRIPTION_STORE_DB,
+        max_entries: int = DESCRIPTION_CACHE_MAX_ENTRIES,
+        max_bytes: int = DESCRIPTION_CACHE_MAX_BYTES,
+        use_offline: bool = DESCRIPTION_USE_OFFLINE,
+    ):
+        """
+        Image descriptions keyed by (image SHA-256, prompt version), kept in SQLite
+        with an in-process LRU in front. Can be seeded with the descriptions the
+        training pipeline generated offline.
+        """
+        self.db_path = db_path or None
+        self.use_offline = use_offline
+        self._memory = SessionCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl_seconds=float("inf"),
+            size_fn=lambda description: len(description.encode("utf-8")),
+        )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._offline_hits = 0
+        self._misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (descriptions are generated from a thread pool)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Created on first use, so importing the module has no side effects
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(DESCRIPTION_STORE_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _lookup(self, image_digest: str, version: str) -> Optional[str]:
+        key = (image_digest, version)
+        description = self._memory.get(key)
+        if description is not None or not self.db_path:
+            return description
+        try:
+            row = self._connection().execute(
+                "SELECT description FROM descriptions WHERE image_digest = ? AND prompt_version = ?",
+                (image_digest, version),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Description store read failed: {str(e)}")
+            return None
+        if row:
+            self._memory.put(key, row[0])
+            return row[0]
+        return None
+
+    def get(self, image_digest: str, version: str) -> Optional[str]:
+        """
+        Get the description of an image for a prompt version, falling back to the
+        offline description of the same image.
+
+        Args:
+            image_digest: SHA-256 of the image bytes
+            version: Prompt version (see prompt_version)
+
+        Returns:
+            Optional[str]: The description, or None if the image was never described
+        """
+        description = self._lookup(image_digest, version)
+        offline = False
+        if description is None and self.use_offline and version != OFFLINE_PROMPT_VERSION:
+            description = self._lookup(image_digest, OFFLINE_PROMPT_VERSION)
+            offline = description is not None
+        with self._lock:
+            if description is None:
+                self._misses += 1
+            elif offline:
+                self._offline_hits += 1
+            else:
+                self._hits += 1
+        return description
+
+    def in_memory(self, image_digest: str, version: str) -> bool:
+        """Whether get would find the description without reading SQLite (safe on the event loop)"""
+        if (image_digest, version) in self._memory:
+            return True
+        return self.use_offline and version != OFFLINE_PROMPT_VERSION and (image_digest, OFFLINE_PROMPT_VERSION) in self._memory
+
+    def get_latest(self, image_digest: str) -> Optional[str]:
+        """The most recently stored description of an image, of any prompt version"""
+        if not self.db_path:
+            return None
+        try:
+            row = self._connection().execute(
+                "SELECT description FROM descriptions WHERE image_digest = ? ORDER BY created DESC LIMIT 1",
+                (image_digest,),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Description store read failed: {str(e)}")
+            return None
+        return row[0] if row else None
+
+    def put(self, image_digest: str, version: str, description: str, source: str = "") -> None:
+        """Store a description (source records the model that generated it)"""
+        self._memory.put((image_digest, version), description)
+        if not self.db_path:
+            return
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO descriptions (image_digest, prompt_version, description, source, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (image_digest, version, description, source, time.time()),
+                )
+        except sqlite3.Error as e:
+            # The store is an optimization, never fail the request because of it
+            print(f"Description store write failed: {str(e)}")
+
+    def seed_offline(self, images_dir: str, descriptions_dir: str) -> int:
+        """
+        Import the offline descriptions (image_descriptions_txt/<name>.txt) of the
+        training images (<images_dir>/<name>.png), keyed by the image file's hash.
+
+        Returns:
+            int: The number of descriptions imported
+        """
+        seeded = 0
+        for image_path in sorted(glob.glob(os.path.join(images_dir, "*"))):
+            name, extension = os.path.splitext(os.path.basename(image_path))
+            description_path = os.path.join(descriptions_dir, f"{name}.txt")
+            if extension.lower() not in IMAGE_EXTENSIONS or not os.path.exists(description_path):
+                continue
+            with open(description_path, "r") as f:
+                description = f.read().strip()
+            # Skip the placeholders image_descriptions/cli.py writes on failures
+            if not description or description.startswith(("Error generating", "Failed to generate", "No description")):
+                continue
+            with open(image_path, "rb") as f:
+                image_digest = hashlib.sha256(f.read()).hexdigest()
+            self.put(image_digest, OFFLINE_PROMPT_VERSION, description, source="image_descriptions")
+            seeded += 1
+        return seeded
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._offline_hits + self._misses
+            return {
+                "hits": self._hits,
+                "offline_hits": self._offline_hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits + self._offline_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+# Shared by the Gemini and LLaMA chat paths
+description_store = DescriptionStore()
+_describing = InFlightCalls()
+
+
+def description_calls(image: Optional[ChatImage], version: str) -> int:
+    """
+    Gemini calls describe_image makes for an image (for admitting its quota up front):
+    none when the description is held in memory, otherwise one. A description found
+    in SQLite after all leaves the token unused, and admitted gives it back.
+    """
+    if image is None or description_store.in_memory(image.digest, version):
+        return 0
+    return 1
+
+
+@traced("image.description")
+def describe_image(image: ChatImage, model: Any, version: str, generation_config: Optional[Dict] = None) -> str:
+    """
+    Describe an image with the description model, reusing a stored description of
+    the same image and prompt version when there is one.
+
+    Args:
+        image: The uploaded image
+        model: The description GenerativeModel
+        version: Version of the model's prompt (see prompt_version)
+        generation_config: Generation settings for the description call
+
+    Returns:
+        str: The image description
+    """
+    description = description_store.get(image.digest, version)
+    if description is not None:
+        return description
+    # A preprocessing request may already be describing this image
+    return _describing.run((image.digest, version), _generate_description, image, model, version, generation_config)
+
+
+def _generate_description(image: ChatImage, model: Any, version: str, generation_config: Optional[Dict]) -> str:
+    from vertexai.generative_models import Part
+
+    model_image = image.normalized("llm")
+    description_parts = [
+        Part.from_data(model_image.data, mime_type=model_image.mime_type),
+        DESCRIPTION_REQUEST
+    ]
+    with rate_limited("gemini"):
+        description_response = model.start_chat().send_message(
+            description_parts,
+            generation_config=generation_config
+        )
+    description = description_response.text
+    description_store.put(image.digest, version, description, source=getattr(model, "_model_name", ""))
+    return description
@@ -0,0 +1,217 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+from api.utils.session_utils import SessionCache
+from api.utils.rate_limit_utils import rate_limited
+from api.utils.tracing_utils import traced
+
+# In-process tier, bounded by entries and approximate bytes. Embeddings of a given
+# model never change, so entries do not expire.
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 10000))
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Shared on-disk tier (all API workers on the host), set to an empty string to disable
+EMBEDDING_CACHE_DB = os.environ.get("EMBEDDING_CACHE_DB", "embedding-cache/embeddings.db")
+
+EMBEDDING_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    cache_key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    task_type TEXT NOT NULL,
+    dimensionality INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a query so trivially different spellings share a cache entry"""
+    text = unicodedata.normalize("NFKC", text)
+    return WHITESPACE_PATTERN.sub(" ", text).strip().casefold()
+
+
+def embedding_cache_key(model: str, task_type: str, dimensionality: Optional[int], text: str) -> str:
+    raw = "\0".join([model, task_type, str(dimensionality or 0), normalize_text(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        db_path: Optional[str] = EMBEDDING_CACHE_DB,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+    ):
+        """
+        Two-tier cache for text embeddings, keyed by (model, task type,
+        dimensionality, normalized text): an in-process LRU in front of an optional
+        SQLite store that is shared by the API workers.
+        """
+        self.db_path = db_path or None
+        self._memory = SessionCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl_seconds=float("inf"),
+            size_fn=lambda vector: 8 * len(vector),
+        )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._compute_seconds = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (embeddings are computed from a thread pool)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Created on first use, so importing the module has no side effects
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(EMBEDDING_CACHE_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _disk_get(self, key: str) -> Optional[List[float]]:
+        try:
+            row = self._connection().execute(
+                "SELECT vector FROM embeddings WHERE cache_key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Embedding cache read failed: {str(e)}")
+            return None
+        return np.frombuffer(row[0], dtype=np.float64).tolist() if row else None
+
+    def _disk_put(self, key: str, model: str, task_type: str, dimensionality: Optional[int], text: str, vector: List[float]) -> None:
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO embeddings (cache_key, model, task_type, dimensionality, text, vector, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, model, task_type, dimensionality or 0, normalize_text(text),
+                     np.asarray(vector, dtype=np.float64).tobytes(), time.time()),
+                )
+        except sqlite3.Error as e:
+            # The cache is an optimization, never fail the request because of it
+            print(f"Embedding cache write failed: {str(e)}")
+
+    def in_memory(self, model: str, task_type: str, dimensionality: Optional[int], text: str) -> bool:
+        """Whether the embedding is in the in-process tier (no SQLite read, safe on the event loop)"""
+        return embedding_cache_key(model, task_type, dimensionality, text) in self._memory
+
+    def get_or_compute(
+        self,
+        model: str,
+        task_type: str,
+        dimensionality: Optional[int],
+        text: str,
+        compute: Callable[[str], List[float]],
+    ) -> List[float]:
+        """
+        Get the embedding of a text, computing and caching it on a miss.
+
+        Args:
+            model: Embedding model name
+            task_type: Embedding task type (e.g. 'RETRIEVAL_DOCUMENT')
+            dimensionality: Output dimensionality (None for the model default)
+            text: The text to embed
+            compute: Called with the text on a miss, returns the embedding
+
+        Returns:
+            List[float]: The embedding (a copy, callers may modify it)
+        """
+        key = embedding_cache_key(model, task_type, dimensionality, text)
+        vector = self._memory.get(key)
+        if vector is not None:
+            with self._lock:
+                self._memory_hits += 1
+            return list(vector)
+
+        if self.db_path:
+            vector = self._disk_get(key)
+            if vector is not None:
+                self._memory.put(key, vector)
+                with self._lock:
+                    self._disk_hits += 1
+                return list(vector)
+
+        start = time.perf_counter()
+        vector = list(compute(text))
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._misses += 1
+            self._compute_seconds += elapsed
+        self._memory.put(key, vector)
+        if self.db_path:
+            self._disk_put(key, model, task_type, dimensionality, text, vector)
+        return list(vector)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self._memory_hits + self._disk_hits
+            lookups = hits + self._misses
+            mean_compute_ms = self._compute_seconds * 1000 / self._misses if self._misses else 0.0
+            return {
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "mean_compute_ms": mean_compute_ms,
+                # Embedding round trips avoided, at the average cost of a miss
+                "saved_ms": hits * mean_compute_ms,
+                "disk_enabled": bool(self.db_path),
+            }
+
+
+# Shared by the RAG router and the semantic response cache
+query_embedding_cache = EmbeddingCache()
+
+
+# Model used to compare prompts (e.g. by the semantic response cache)
+SIMILARITY_EMBEDDING_MODEL = "text-embedding-004"
+SIMILARITY_EMBEDDING_DIMENSION = 256
+_text_embedding_models: Dict[str, Any] = {}
+_text_embedding_models_lock = threading.Lock()
+
+
+def get_text_embedding_model(model: str) -> Any:
+    """Load a Vertex AI text embedding model once per process"""
+    with _text_embedding_models_lock:
+        if model not in _text_embedding_models:
+            from vertexai.language_models import TextEmbeddingModel
+            _text_embedding_models[model] = TextEmbeddingModel.from_pretrained(model)
+        return _text_embedding_models[model]
+
+
+@traced("text.embedding")
+def embed_text(
+    text: str,
+    task_type: str = "SEMANTIC_SIMILARITY",
+    model: str = SIMILARITY_EMBEDDING_MODEL,
+    dimensionality: Optional[int] = SIMILARITY_EMBEDDING_DIMENSION,
+) -> List[float]:
+    """Embed a text with Vertex AI, through the shared embedding cache"""
+    def compute(value: str) -> List[float]:
+        from vertexai.language_models import TextEmbeddingInput
+        kwargs = dict(output_dimensionality=dimensionality) if dimensionality else {}
+        with rate_limited("embedding"):
+            embeddings = get_text_embedding_model(model).get_embeddings(
+                [TextEmbeddingInput(task_type=task_type, text=value)], **kwargs
+            )
+        return embeddings[0].values
+
+    return query_embedding_cache.get_or_compute(model, task_type, dimensionality, text, compute)
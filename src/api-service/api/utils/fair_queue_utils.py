@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, Set
+from fastapi import HTTPException
+from api.utils.backend_utils import get_backend_executor, run_in_backend, stream_in_backend
+from api.utils.metrics_utils import Histogram, registry
+from api.utils.rate_limit_utils import admitted, quota_usage
+
+# Generations one chat session may run at once per backend, and may have waiting
+# beyond that (more are rejected with 429)
+SESSION_MAX_CONCURRENCY = int(os.environ.get("SESSION_MAX_CONCURRENCY", 4))
+SESSION_MAX_QUEUED = int(os.environ.get("SESSION_MAX_QUEUED", 32))
+
+# Requests without an X-Session-ID share one queue
+ANONYMOUS_SESSION = ""
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        session_max_concurrency: int = SESSION_MAX_CONCURRENCY,
+        session_max_queued: int = SESSION_MAX_QUEUED,
+    ):
+        """
+        Shares a backend's generation slots fairly between chat sessions. Waiting
+        requests are queued per session and free slots are handed out round robin
+        across the sessions with waiting requests, so a session with a burst of
+        requests takes one turn per round instead of the whole backend. Each session
+        also runs at most session_max_concurrency generations at once.
+
+        Used from the event loop.
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.session_max_concurrency = session_max_concurrency
+        self.session_max_queued = session_max_queued
+        self._lock = threading.Lock()
+        self._active = 0
+        self._running: Dict[str, int] = {}
+        # Sessions with waiting requests, in round robin order
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._granted = 0
+        self._queued = 0
+        self._rejected = 0
+        self.wait_time = Histogram(f"{name}_fair_queue_wait_seconds")
+
+    def _dispatch(self) -> None:
+        """Hand free slots to the next sessions in round robin order (lock held)"""
+        while self._active < self.max_concurrency:
+            for session_id, waiters in self._waiting.items():
+                if self._running.get(session_id, 0) < self.session_max_concurrency:
+                    break
+            else:
+                # Every waiting session is at its own limit
+                return
+            future = waiters.popleft()
+            if waiters:
+                # The session goes to the back of the round
+                self._waiting.move_to_end(session_id)
+            else:
+                del self._waiting[session_id]
+            if future.done():
+                continue
+            self._active += 1
+            self._running[session_id] = self._running.get(session_id, 0) + 1
+            self._granted += 1
+            future.set_result(None)
+
+    def _release(self, session_id: str) -> None:
+        with self._lock:
+            self._active -= 1
+            self._running[session_id] -= 1
+            if not self._running[session_id]:
+                del self._running[session_id]
+            self._dispatch()
+
+    async def acquire(self, session_id: Optional[str]) -> str:
+        """
+        Wait for a slot for a session.
+
+        Returns:
+            str: The session the slot is held for (pass it to release)
+
+        Raises:
+            HTTPException: 429 if the session already has too many requests waiting
+        """
+        session_id = session_id or ANONYMOUS_SESSION
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        with self._lock:
+            waiters = self._waiting.get(session_id)
+            if waiters is not None and len(waiters) >= self.session_max_queued:
+                self._rejected += 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many requests in progress for this session",
+                    headers={"Retry-After": "1"},
+                )
+            if waiters is None:
+                waiters = self._waiting[session_id] = deque()
+            waiters.append(future)
+            self._queued += 1
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = future.done() and not future.cancelled()
+                if not granted:
+                    future.cancel()
+            if granted:
+                # The slot was handed over as the request was cancelled
+                self._release(session_id)
+            raise
+        self.wait_time.observe(time.perf_counter() - start)
+        return session_id
+
+    def release(self, session_id: str) -> None:
+        self._release(session_id)
+
+    @asynccontextmanager
+    async def slot(self, session_id: Optional[str]) -> AsyncIterator[None]:
+        """Hold one of the backend's generation slots for a session"""
+        session_id = await self.acquire(session_id)
+        try:
+            yield
+        finally:
+            self.release(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "max_concurrency": self.max_concurrency,
+                "session_max_concurrency": self.session_max_concurrency,
+                "active": self._active,
+                "active_sessions": len(self._running),
+                "waiting": sum(len(waiters) for waiters in self._waiting.values()),
+                "waiting_sessions": len(self._waiting),
+                "granted": self._granted,
+                "queued": self._queued,
+                "rejected": self._rejected,
+            }
+        stats["wait_seconds"] = self.wait_time.snapshot()
+        return stats
+
+
+_schedulers: Dict[str, FairScheduler] = {}
+_schedulers_lock = threading.Lock()
+# Keeps background preprocessing tasks alive until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def get_fair_scheduler(backend: str) -> FairScheduler:
+    """Get (or lazily create) the scheduler of a backend, sized like its pool"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(backend)
+        if scheduler is None:
+            scheduler = FairScheduler(backend, get_backend_executor(backend).max_concurrency)
+            registry.register("fair_queue_wait_seconds", scheduler.wait_time, "Time generations waited for a slot", backend=backend)
+            _schedulers[backend] = scheduler
+        return scheduler
+
+
+async def run_fairly(backend: str, session_id: Optional[str], func: Callable, *args, **kwargs) -> Any:
+    """
+    run_in_backend, taking the session's turn in the backend's fair queue first and
+    then waiting on the event loop for the upstream quota the call uses (see uses_quotas)
+    """
+    async with get_fair_scheduler(backend).slot(session_id), admitted(quota_usage(func, *args, **kwargs)):
+        return await run_in_backend(backend, func, *args, **kwargs)
+
+
+async def stream_fairly(backend: str, session_id: Optional[str], func: Callable, *args, **kwargs) -> AsyncIterator:
+    """stream_in_backend, holding a fair queue slot for the whole stream (quota as for run_fairly)"""
+    async with get_fair_scheduler(backend).slot(session_id), admitted(quota_usage(func, *args, **kwargs)):
+        async for item in stream_in_backend(backend, func, *args, **kwargs):
+            yield item
+
+
+def submit_fairly(backend: str, session_id: Optional[str], func: Callable, *args, **kwargs) -> asyncio.Task:
+    """
+    Start a backend call in the background (e.g. speculative preprocessing) through
+    the fair queue. Failures are logged.
+    """
+    def log_failure(task: asyncio.Task) -> None:
+        _background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background {backend} call {getattr(func, '__name__', func)} failed: {task.exception()}")
+
+    task = asyncio.ensure_future(run_fairly(backend, session_id, func, *args, **kwargs))
+    _background_tasks.add(task)
+    task.add_done_callback(log_failure)
+    return task
+
+
+def fair_queue_stats() -> Dict[str, Dict[str, Any]]:
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.name: scheduler.stats() for scheduler in schedulers}
@@ -0,0 +1,263 @@
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from api.utils.context_utils import estimate_tokens
+
+# Turns of a live chat session re-sent to the model verbatim
+HISTORY_KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", 4))
+# Older turns keep their text but their images are replaced by descriptions
+HISTORY_DESCRIBED_TURNS = int(os.environ.get("HISTORY_DESCRIBED_TURNS", 4))
+# Turns older than that are folded into a rolling summary of at most this many tokens
+HISTORY_SUMMARY_MAX_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", 600))
+# Ceiling (estimated tokens) on the history plus the new message sent to the model
+HISTORY_TOKEN_CEILING = int(os.environ.get("HISTORY_TOKEN_CEILING", 12000))
+
+# Gemini bills an inline image as a fixed number of input tokens
+IMAGE_TOKENS = 258
+# Characters of a message (or image description) kept in the summary
+SUMMARY_LINE_CHARS = 240
+DESCRIPTION_CHARS = 600
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+# Stands in for an image of an earlier turn (rebuilt from storage or compacted) when
+# no description of the image is stored
+IMAGE_PLACEHOLDER = "[The user shared an image of a crochet item.]"
+
+
+def _part_text(part: Any) -> Optional[str]:
+    try:
+        return part.text
+    except (AttributeError, ValueError):
+        return None
+
+
+def _part_image(part: Any) -> Optional[bytes]:
+    """The bytes of an inline image part (b"" for an image referenced by URI)"""
+    try:
+        mime_type = part.mime_type
+    except (AttributeError, ValueError):
+        return None
+    if not mime_type or not mime_type.startswith("image/"):
+        return None
+    try:
+        return part.inline_data.data or b""
+    except (AttributeError, ValueError):
+        return b""
+
+
+def _is_summary(part: Any) -> bool:
+    text = _part_text(part)
+    return bool(text) and text.startswith(SUMMARY_HEADER)
+
+
+def _with_parts(content: Any, parts: List[Any]) -> Any:
+    """A copy of a model turn (vertexai Content) with other parts"""
+    return type(content)(role=content.role, parts=parts)
+
+
+def _shorten(text: str, max_chars: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + "..."
+
+
+def estimate_content_tokens(contents: Sequence[Any]) -> int:
+    """Estimated input tokens of model turns (or of the parts of a new message)"""
+    tokens = 0
+    for content in contents:
+        parts = getattr(content, "parts", None) or [content]
+        for part in parts:
+            if isinstance(part, str):
+                tokens += estimate_tokens(part)
+            elif _part_image(part) is not None:
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += estimate_tokens(_part_text(part) or "")
+    return tokens
+
+
+def described_image(description: Optional[str]) -> str:
+    """The text standing in for an image in the history: its description, or the placeholder"""
+    if not description:
+        return IMAGE_PLACEHOLDER
+    return f"[The user shared an image of a crochet item: {_shorten(description, DESCRIPTION_CHARS)}]"
+
+
+class HistoryCompactor:
+    def __init__(
+        self,
+        keep_turns: int = HISTORY_KEEP_TURNS,
+        described_turns: int = HISTORY_DESCRIBED_TURNS,
+        summary_max_tokens: int = HISTORY_SUMMARY_MAX_TOKENS,
+        token_ceiling: int = HISTORY_TOKEN_CEILING,
+    ):
+        """
+        Bounds the history a live chat session re-sends to the model on every turn.
+        The last keep_turns turns are kept verbatim, the described_turns before them
+        keep their text with images swapped for their cached descriptions, and older
+        turns are folded into a rolling summary carried by the first kept turn. When
+        the history and the new message exceed token_ceiling, less is kept (the
+        text of the last turn always is).
+        """
+        self.keep_turns = max(1, keep_turns)
+        self.described_turns = max(0, described_turns)
+        self.summary_max_tokens = summary_max_tokens
+        self.token_ceiling = token_ceiling
+        self._lock = threading.Lock()
+        self._compactions = 0
+        self._turns_summarized = 0
+        self._images_described = 0
+        self._tokens_before = 0
+        self._tokens_after = 0
+
+    def _describe_image(self, data: bytes, describe: Optional[Callable[[bytes], Optional[str]]]) -> str:
+        return described_image(describe(data) if describe and data else None)
+
+    def _without_images(self, content: Any, describe: Optional[Callable[[bytes], Optional[str]]]) -> Tuple[Any, int]:
+        parts = []
+        described = 0
+        for part in content.parts:
+            data = _part_image(part)
+            if data is None:
+                parts.append(part)
+            else:
+                parts.append(type(part).from_text(self._describe_image(data, describe)))
+                described += 1
+        return (_with_parts(content, parts) if described else content), described
+
+    def _summary_lines(self, content: Any, describe: Optional[Callable[[bytes], Optional[str]]]) -> Tuple[List[str], int]:
+        """Summary lines of a folded turn, and the number of images it had"""
+        speaker = "User" if content.role == "user" else "Assistant"
+        texts = []
+        images = 0
+        for part in content.parts:
+            data = _part_image(part)
+            if data is not None:
+                texts.append(self._describe_image(data, describe))
+                images += 1
+                continue
+            text = _part_text(part)
+            if text:
+                texts.append(text)
+        text = " ".join(texts)
+        return ([f"- {speaker}: {_shorten(text, SUMMARY_LINE_CHARS)}"] if text.strip() else []), images
+
+    def _roll(self, lines: List[str], max_tokens: int) -> List[str]:
+        """Drop the oldest summary lines beyond the summary budget"""
+        while lines and estimate_tokens("\n".join([SUMMARY_HEADER] + lines)) > max_tokens:
+            lines = lines[1:]
+        return lines
+
+    def _compact(
+        self,
+        turns: List[List[Any]],
+        keep: int,
+        described: int,
+        summary_max_tokens: int,
+        describe: Optional[Callable[[bytes], Optional[str]]],
+    ) -> Tuple[List[Any], int, int]:
+        described_from = max(0, len(turns) - keep - described)
+        recent_from = max(0, len(turns) - keep)
+
+        summary_lines: List[str] = []
+        contents: List[Any] = []
+        images = 0
+        for index, turn in enumerate(turns):
+            for content in turn:
+                # The previous summary rolls forward instead of being summarized again
+                summary_parts = [part for part in content.parts if _is_summary(part)]
+                if summary_parts:
+                    for part in summary_parts:
+                        summary_lines.extend(part.text.splitlines()[1:])
+                    content = _with_parts(content, [part for part in content.parts if not _is_summary(part)])
+
+                if index < described_from:
+                    lines, content_images = self._summary_lines(content, describe)
+                    summary_lines.extend(lines)
+                    images += content_images
+                elif index < recent_from:
+                    content, content_images = self._without_images(content, describe)
+                    images += content_images
+                    contents.append(content)
+                else:
+                    contents.append(content)
+
+        summary_lines = self._roll(summary_lines, summary_max_tokens)
+        if summary_lines and contents:
+            first = contents[0]
+            summary = type(first.parts[0]).from_text("\n".join([SUMMARY_HEADER] + summary_lines))
+            contents[0] = _with_parts(first, [summary] + list(first.parts))
+        return contents, described_from, images
+
+    def compact(
+        self,
+        history: List[Any],
+        new_message: Sequence[Any] = (),
+        describe: Optional[Callable[[bytes], Optional[str]]] = None,
+    ) -> Tuple[Optional[List[Any]], Dict[str, int]]:
+        """
+        Compact a chat session's history before sending a new message.
+
+        Args:
+            history: The session's turns
+            new_message: Parts of the message about to be sent (counted against the ceiling)
+            describe: Returns the cached description of an image's bytes, if any
+
+        Returns:
+            Tuple[Optional[List[Any]], Dict[str, int]]: The compacted history (None if
+            it is unchanged) and the request's token accounting
+        """
+        tokens_before = estimate_content_tokens(history)
+        message_tokens = estimate_content_tokens(new_message)
+        report = {"tokens_before": tokens_before, "tokens_after": tokens_before, "tokens_avoided": 0, "turns_summarized": 0, "images_described": 0}
+
+        # Turns start at a user content (a leading model content belongs to the first)
+        turns: List[List[Any]] = []
+        for content in history:
+            if content.role == "user" or not turns:
+                turns.append([])
+            turns[-1].append(content)
+
+        if len(turns) <= self.keep_turns and tokens_before + message_tokens <= self.token_ceiling:
+            return None, report
+
+        # (verbatim turns, described turns, summary budget), least compacted first: over
+        # the ceiling fewer turns are kept, then the last turn's images are described
+        # and finally the summary is dropped
+        policies = [(keep, self.described_turns, self.summary_max_tokens) for keep in range(self.keep_turns, 0, -1)]
+        policies += [(1, 0, self.summary_max_tokens), (0, 1, self.summary_max_tokens), (0, 1, 0)]
+        for keep, described, summary_max_tokens in policies:
+            contents, summarized, images = self._compact(turns, keep, described, summary_max_tokens, describe)
+            tokens_after = estimate_content_tokens(contents)
+            if tokens_after + message_tokens <= self.token_ceiling:
+                break
+
+        report.update({
+            "tokens_after": tokens_after,
+            "tokens_avoided": max(0, tokens_before - tokens_after),
+            "turns_summarized": summarized,
+            "images_described": images,
+        })
+        with self._lock:
+            self._compactions += 1
+            self._turns_summarized += summarized
+            self._images_described += images
+            self._tokens_before += tokens_before
+            self._tokens_after += tokens_after
+        return contents, report
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "keep_turns": self.keep_turns,
+                "described_turns": self.described_turns,
+                "token_ceiling": self.token_ceiling,
+                "compactions": self._compactions,
+                "turns_summarized": self._turns_summarized,
+                "images_described": self._images_described,
+                "tokens_before": self._tokens_before,
+                "tokens_after": self._tokens_after,
+                "tokens_avoided": max(0, self._tokens_before - self._tokens_after),
+            }
+
+
+history_compactor = HistoryCompactor()
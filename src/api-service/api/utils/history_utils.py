@@ -0,0 +1,76 @@
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+from api.utils.description_utils import description_store
+from api.utils.history_compaction_utils import described_image
+from api.utils.image_utils import BLOB_NAME_PATTERN, ChatImage
+
+# Stands in for an assistant reply that was not stored (e.g. a failed generation),
+# so the rebuilt history still alternates and ends with a model turn
+MISSING_REPLY_PLACEHOLDER = "[No reply was given to this message.]"
+
+
+def image_digest(message: Dict) -> Optional[str]:
+    """SHA-256 of a message's image: of the upload, or from the name of its stored blob"""
+    if message.get("image"):
+        return ChatImage.coerce(message["image"]).digest
+    match = BLOB_NAME_PATTERN.match(os.path.basename(message.get("image_path") or ""))
+    return match.group(1) if match else None
+
+
+def stored_image_description(message: Dict) -> Optional[str]:
+    """The description generated for a message's image, if it was ever described (reads SQLite)"""
+    digest = image_digest(message)
+    return description_store.get_latest(digest) if digest else None
+
+
+def message_text(message: Dict, describe: Optional[Callable[[Dict], Optional[str]]] = stored_image_description) -> str:
+    """
+    Text of a stored chat message as sent to the model.
+
+    Args:
+        message: Dict from ChatHistoryManager with 'role', 'content' and optionally 'image_path'
+        describe: Returns the description of the message's image (None if unknown)
+
+    Returns:
+        str: The message text, preceded for a user message with an image by the
+        image's description (or a placeholder if it was never described)
+    """
+    text = message.get("content") or ""
+    if message["role"] == "user" and (message.get("image_path") or message.get("image")):
+        image_text = described_image(describe(message) if describe else None)
+        text = f"{image_text}\n{text}" if text else image_text
+    return text
+
+
+def history_turns(chat_history: List[Dict], describe: Optional[Callable[[Dict], Optional[str]]] = stored_image_description) -> List[Tuple[str, str]]:
+    """
+    The (role, text) turns of a stored chat, in the shape Gemini accepts as history:
+    roles alternate between 'user' and 'model' and the last turn is a model turn.
+    Empty assistant messages are skipped, the user messages around them are merged
+    into one turn, and an unanswered last user message gets a placeholder reply.
+    Images are replaced by their stored descriptions (see message_text).
+    """
+    turns: List[Tuple[str, str]] = []
+    for message in chat_history:
+        role = "user" if message["role"] == "user" else "model"
+        text = message_text(message, describe)
+        if not text:
+            continue
+        if turns and turns[-1][0] == role:
+            turns[-1] = (role, f"{turns[-1][1]}\n\n{text}")
+        else:
+            turns.append((role, text))
+    if turns and turns[-1][0] == "user":
+        turns.append(("model", MISSING_REPLY_PLACEHOLDER))
+    return turns
+
+
+def build_chat_history(chat_history: List[Dict]) -> List["Content"]:
+    """
+    Build the model's conversation history directly from stored chat messages,
+    so restoring a session does not replay any turns through the model. Reads the
+    image descriptions from the description store: call it off the event loop.
+    """
+    from vertexai.generative_models import Content, Part
+
+    return [Content(role=role, parts=[Part.from_text(text)]) for role, text in history_turns(chat_history)]
@@ -0,0 +1,348 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+import httpx
+from fastapi import HTTPException
+from api.utils.metrics_utils import Histogram, registry
+
+# Statuses worth retrying: rate limited, or the upstream (e.g. a Modal container that
+# is still starting) failed
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Errors raised before the request reached the upstream, always safe to retry
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        """
+        Fails fast after failure_threshold consecutive failures. After reset_seconds a
+        single trial call is let through (half open); it closes the circuit on
+        success and re-opens it on failure.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._opens = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if now - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def retry_after(self) -> float:
+        """Seconds until a trial call will be allowed"""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError if the call should not be attempted.
+
+        Returns:
+            bool: Whether the call is the half open trial; it must end with
+            record_success, record_failure or release_trial
+        """
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self._rejected += 1
+        raise CircuitOpenError()
+
+    def release_trial(self) -> None:
+        """Let another call be the trial, when the trial ended without an outcome (e.g. cancelled)"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_running:
+                    self._opens += 1
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._state(time.monotonic()),
+                "consecutive_failures": self._failures,
+                "opens": self._opens,
+                "rejected": self._rejected,
+            }
+
+
+class BackendHTTPClient:
+    def __init__(
+        self,
+        name: str,
+        connect_timeout: float = 10,
+        read_timeout: float = 300,
+        write_timeout: float = 60,
+        pool_timeout: float = 30,
+        max_connections: int = 32,
+        max_keepalive_connections: int = 16,
+        keepalive_expiry: float = 60,
+        max_retries: int = 2,
+        backoff_seconds: float = 0.5,
+        max_backoff_seconds: float = 8,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        """
+        Shared async HTTP client for a model backend: keep-alive connection pooling,
+        connect/read timeouts, retries with exponential backoff and full jitter on
+        429/5xx and connection errors, a circuit breaker and latency histograms.
+        """
+        self.name = name
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._transport = transport
+        # httpx clients are bound to the event loop they were first used in
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+        self.latency = Histogram(f"{name}_request_seconds")
+        self.attempt_latency = Histogram(f"{name}_attempt_seconds")
+        self._requests = 0
+        self._retries = 0
+        self._failures = 0
+
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                # Drop clients of event loops that no longer run (e.g. test clients)
+                for stale_loop in [stale for stale in self._clients if stale.is_closed()]:
+                    del self._clients[stale_loop]
+                client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, transport=self._transport)
+                self._clients[loop] = client
+            return client
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        if response is not None and response.headers.get("retry-after", "").isdigit():
+            return min(float(response.headers["retry-after"]), self.max_backoff_seconds)
+        # Full jitter: spreads out the retries of concurrent requests
+        return random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+
+    def _unavailable(self) -> HTTPException:
+        retry_after = max(1, int(self.circuit_breaker.retry_after() + 0.5))
+        return HTTPException(
+            status_code=503,
+            detail=f"{self.name} backend is unavailable (starting up or failing), retry in {retry_after}s",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    async def _send(self, method: str, url: str, stream: bool, **kwargs) -> httpx.Response:
+        """Send with retries; the returned response is successful (2xx-4xx other than 429)"""
+        try:
+            trial = self.circuit_breaker.before_call()
+        except CircuitOpenError:
+            raise self._unavailable()
+
+        try:
+            return await self._send_with_retries(method, url, stream, **kwargs)
+        except BaseException:
+            # A trial that was cancelled (e.g. the client disconnected) or failed
+            # unexpectedly must not keep the circuit half open forever
+            if trial:
+                self.circuit_breaker.release_trial()
+            raise
+
+    async def _send_with_retries(self, method: str, url: str, stream: bool, **kwargs) -> httpx.Response:
+        client = self._client()
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            response = None
+            error = None
+            try:
+                request = client.build_request(method, url, **kwargs)
+                response = await client.send(request, stream=stream)
+            except RETRY_ERRORS as e:
+                error = e
+            except httpx.TimeoutException as e:
+                # The upstream took the request but is not answering; retrying would
+                # only pile more work onto it
+                self.attempt_latency.observe(time.perf_counter() - start)
+                self._record_failure()
+                raise HTTPException(status_code=504, detail=f"{self.name} backend timed out: {type(e).__name__}")
+            except httpx.HTTPError as e:
+                self.attempt_latency.observe(time.perf_counter() - start)
+                self._record_failure()
+                raise HTTPException(status_code=502, detail=f"{self.name} backend request failed: {str(e)}")
+            self.attempt_latency.observe(time.perf_counter() - start)
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                self.circuit_breaker.record_success()
+                return response
+
+            if attempt >= self.max_retries:
+                self._record_failure()
+                if error is not None:
+                    raise HTTPException(status_code=502, detail=f"{self.name} backend unreachable: {str(error)}")
+                status_code = response.status_code
+                await response.aclose()
+                raise HTTPException(
+                    status_code=429 if status_code == 429 else 502,
+                    detail=f"{self.name} backend returned {status_code}",
+                    headers={"Retry-After": response.headers["retry-after"]} if "retry-after" in response.headers else None,
+                )
+
+            delay = self._backoff(attempt, response)
+            if response is not None:
+                await response.aclose()
+            print(f"Retrying {self.name} request in {delay:.2f}s ({error or response.status_code})")
+            with self._lock:
+                self._retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _record_failure(self) -> None:
+        self.circuit_breaker.record_failure()
+        with self._lock:
+            self._failures += 1
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send a request (arguments as for httpx.AsyncClient.request).
+
+        Raises:
+            HTTPException: 503 while the circuit is open, 504 on a read timeout,
+            502/429 once retries are exhausted
+        """
+        with self._lock:
+            self._requests += 1
+        start = time.perf_counter()
+        try:
+            return await self._send(method, url, stream=False, **kwargs)
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """Send a request and stream the response body (only the connection is retried)"""
+        with self._lock:
+            self._requests += 1
+        start = time.perf_counter()
+        response = await self._send(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        except httpx.TimeoutException as e:
+            self._record_failure()
+            raise HTTPException(status_code=504, detail=f"{self.name} backend timed out: {type(e).__name__}")
+        finally:
+            await response.aclose()
+            self.latency.observe(time.perf_counter() - start)
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients = list(self._clients.items())
+            self._clients.clear()
+        for loop, client in clients:
+            if not loop.is_closed():
+                await client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {
+                "requests": self._requests,
+                "retries": self._retries,
+                "failures": self._failures,
+            }
+        return {
+            **counters,
+            "circuit": self.circuit_breaker.stats(),
+            "latency_seconds": self.latency.snapshot(),
+            "attempt_latency_seconds": self.attempt_latency.snapshot(),
+        }
+
+
+_clients: Dict[str, BackendHTTPClient] = {}
+_clients_lock = threading.Lock()
+
+
+def _env(name: str, key: str, default: float) -> float:
+    return float(os.environ.get(f"{name.upper().replace('-', '_')}_{key}", default))
+
+
+def get_http_client(name: str) -> BackendHTTPClient:
+    """
+    Get (or lazily create) the HTTP client of a backend, configured from
+    <NAME>_CONNECT_TIMEOUT, <NAME>_READ_TIMEOUT, <NAME>_MAX_RETRIES,
+    <NAME>_CIRCUIT_FAILURES and <NAME>_CIRCUIT_RESET_SECONDS (e.g. MODAL_READ_TIMEOUT)
+    """
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = BackendHTTPClient(
+                name,
+                connect_timeout=_env(name, "CONNECT_TIMEOUT", 10),
+                read_timeout=_env(name, "READ_TIMEOUT", 300),
+                max_connections=int(_env(name, "MAX_CONNECTIONS", 32)),
+                max_retries=int(_env(name, "MAX_RETRIES", 2)),
+                circuit_breaker=CircuitBreaker(
+                    failure_threshold=int(_env(name, "CIRCUIT_FAILURES", 5)),
+                    reset_seconds=_env(name, "CIRCUIT_RESET_SECONDS", 30),
+                ),
+            )
+            registry.register("upstream_request_seconds", client.latency, "Latency of upstream HTTP calls including retries", backend=name)
+            registry.register("upstream_attempt_seconds", client.attempt_latency, "Latency of each upstream HTTP attempt", backend=name)
+            _clients[name] = client
+        return client
+
+
+def http_client_stats() -> Dict[str, Dict[str, Any]]:
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.name: client.stats() for client in clients}
+
+
+async def close_http_clients() -> None:
+    with _clients_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        await client.aclose()
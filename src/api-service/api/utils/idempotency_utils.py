@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from fastapi import HTTPException, Response
+from api.utils.session_utils import SessionCache
+from api.utils.singleflight_utils import AsyncInFlightCalls
+
+# Completed chat responses are replayed for retries with the same Idempotency-Key
+# within this window
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 60 * 60))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", 10000))
+IDEMPOTENCY_MAX_BYTES = int(os.environ.get("IDEMPOTENCY_MAX_BYTES", 64 * 1024 * 1024))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Set on responses that were replayed instead of generated
+IDEMPOTENT_REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def _result_size(entry: Dict) -> int:
+    return len(json.dumps(entry["result"], ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS,
+        max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+        max_bytes: int = IDEMPOTENCY_MAX_BYTES,
+    ):
+        """
+        Results of requests sent with an Idempotency-Key. A retry while the first
+        attempt is still running awaits it; a retry after it completed gets the
+        stored result. Failed attempts are not stored, so they can be retried.
+        """
+        self.ttl_seconds = ttl_seconds
+        self._results = SessionCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl_seconds=ttl_seconds,
+            size_fn=_result_size,
+        )
+        self._in_flight = AsyncInFlightCalls()
+        self._lock = threading.Lock()
+        self._executed = 0
+        self._replayed = 0
+        self._joined = 0
+
+    def _get(self, key: Hashable) -> Optional[Dict]:
+        entry = self._results.get(key)
+        if entry is not None and time.time() - entry["created"] > self.ttl_seconds:
+            self._results.pop(key)
+            return None
+        return entry
+
+    async def _execute(self, key: Hashable, func: Callable[..., Awaitable], args: tuple, kwargs: Dict) -> Any:
+        # The first attempt may have completed after the caller's lookup
+        entry = self._get(key)
+        if entry is not None:
+            return entry["result"]
+        result = await func(*args, **kwargs)
+        self._results.put(key, {"result": result, "created": time.time()})
+        with self._lock:
+            self._executed += 1
+        return result
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        Await func(*args, **kwargs) once per key.
+
+        Returns:
+            Tuple[Any, bool]: The result, and whether it was replayed from an earlier attempt
+        """
+        entry = self._get(key)
+        if entry is not None:
+            with self._lock:
+                self._replayed += 1
+            return entry["result"], True
+        result, joined = await self._in_flight.run(key, self._execute, key, func, args, kwargs)
+        if joined:
+            with self._lock:
+                self._joined += 1
+        return result, joined
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._results),
+                "executed": self._executed,
+                "replayed": self._replayed,
+                "joined_in_flight": self._joined,
+            }
+
+
+# Shared by all chat routers, keys include the backend
+idempotency_store = IdempotencyStore()
+
+
+async def run_idempotent(
+    key: Tuple,
+    idempotency_key: str,
+    response: Response,
+    func: Callable[..., Awaitable],
+    *args,
+    **kwargs
+) -> Any:
+    """
+    Run a chat request handler at most once per Idempotency-Key.
+
+    Args:
+        key: Scope of the idempotency key (backend, session, chat)
+        idempotency_key: The client's Idempotency-Key header
+        response: The endpoint's response, marked when the result is replayed
+        func: The handler to run
+        *args, **kwargs: Arguments passed to func
+
+    Returns:
+        Any: The handler's result, or the result of the earlier attempt
+    """
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    result, replayed = await idempotency_store.run(key + (idempotency_key,), func, *args, **kwargs)
+    if replayed:
+        print(f"Replaying idempotent response for {idempotency_key}")
+        response.headers[IDEMPOTENT_REPLAYED_HEADER] = "true"
+    return result
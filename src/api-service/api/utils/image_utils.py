@@ -0,0 +1,415 @@
+import os
+import io
+import re
+import base64
+import binascii
+import hashlib
+import tempfile
+import threading
+import mimetypes
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from PIL import Image, ImageOps
+from api.utils.backend_utils import run_in_backend
+from api.utils.session_utils import SessionCache
+from api.utils.singleflight_utils import InFlightCalls
+
+# Image URLs are content addressed, so clients may cache them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+MIME_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/heic": ".heic",
+    "image/bmp": ".bmp",
+}
+EXTENSION_MIMES = {extension: mime_type for mime_type, extension in MIME_EXTENSIONS.items()}
+
+BLOB_NAME_PATTERN = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]+)?$")
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Longest image edge sent to each backend. Gemini tiles images at 768 px, the
+# LLaMA vision encoder works at 560 px and the Swinv2 embedding model squashes
+# images to 256x256 (at 512, twice that, both edges of photos up to 2:1 are still
+# downsampled rather than upscaled), so full resolution phone photos only add
+# upload latency.
+IMAGE_MAX_EDGE = {
+    "llm": int(os.environ.get("LLM_IMAGE_MAX_EDGE", 1024)),
+    "llm-rag": int(os.environ.get("LLM_RAG_IMAGE_MAX_EDGE", 1024)),
+    "llm-llama": int(os.environ.get("LLM_LLAMA_IMAGE_MAX_EDGE", 560)),
+    "embedding": int(os.environ.get("EMBEDDING_IMAGE_MAX_EDGE", 512)),
+}
+DEFAULT_IMAGE_MAX_EDGE = 1024
+IMAGE_NORMALIZE_FORMAT = os.environ.get("IMAGE_NORMALIZE_FORMAT", "JPEG")  # or WEBP
+IMAGE_NORMALIZE_QUALITY = int(os.environ.get("IMAGE_NORMALIZE_QUALITY", 85))
+NORMALIZED_IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get("NORMALIZED_IMAGE_CACHE_MAX_ENTRIES", 512))
+NORMALIZED_IMAGE_CACHE_MAX_BYTES = int(os.environ.get("NORMALIZED_IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+NORMALIZED_IMAGE_CACHE_TTL_SECONDS = float(os.environ.get("NORMALIZED_IMAGE_CACHE_TTL_SECONDS", 60 * 60))
+EXIF_ORIENTATION = 0x0112
+
+
+def sniff_image_mime(data: bytes) -> Optional[str]:
+    """Detect the image type from its leading bytes (the data URL header can be wrong)"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    return None
+
+
+class ChatImage:
+    def __init__(self, data: bytes, mime_type: Optional[str] = None):
+        """
+        An uploaded image, decoded once per request. The same bytes are shared by the
+        description model, the embedding model, the Modal call and the history store.
+
+        Args:
+            data: The raw image bytes
+            mime_type: Declared MIME type, used only if the type cannot be detected
+        """
+        self.data = data
+        self.mime_type = sniff_image_mime(data) or mime_type or "image/jpeg"
+        self._digest = None
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 of the image bytes (computed once)"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    @classmethod
+    def from_data_url(cls, image_data: str) -> "ChatImage":
+        """Decode a base64 image, with or without a data URL header"""
+        try:
+            if ',' in image_data:
+                header, base64_data = image_data.split(',', 1)
+                mime_type = header.split(':')[1].split(';')[0]
+            else:
+                base64_data = image_data
+                mime_type = 'image/jpeg'  # default to JPEG if no header
+            data = base64.b64decode(base64_data)
+            if not data:
+                raise ValueError("Empty image")
+            return cls(data, mime_type)
+        except (ValueError, IndexError, binascii.Error) as e:
+            raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
+
+    @classmethod
+    def coerce(cls, image) -> "ChatImage":
+        """Accept either a ChatImage or a base64 string"""
+        return image if isinstance(image, cls) else cls.from_data_url(image)
+
+    def normalized(self, backend: str) -> "ChatImage":
+        """The image oriented, downscaled and re-encoded for a backend (cached per image hash)"""
+        return normalize_image(self, backend)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def _encode_image(image: ChatImage, max_edge: int, image_format: str, quality: int) -> bytes:
+    with Image.open(io.BytesIO(image.data)) as img:
+        # Let the JPEG decoder downscale by a power of two while decoding
+        img.draft("RGB", (max_edge, max_edge))
+        rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+        transposed = ImageOps.exif_transpose(img)
+        resized = max(transposed.size) > max_edge
+        if resized:
+            transposed.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if transposed.mode not in ("RGB", "L"):
+            # Flatten transparency onto white, JPEG has no alpha channel
+            rgba = transposed.convert("RGBA")
+            transposed = Image.new("RGB", rgba.size, (255, 255, 255))
+            transposed.paste(rgba, mask=rgba.split()[-1])
+        output = io.BytesIO()
+        transposed.save(output, format=image_format, quality=quality, optimize=True)
+
+    data = output.getvalue()
+    if not (resized or rotated) and len(data) >= len(image.data) and image.mime_type in ("image/jpeg", "image/png", "image/webp"):
+        # Already small enough, re-encoding would only cost quality
+        return image.data
+    return data
+
+
+class ImageNormalizer:
+    def __init__(
+        self,
+        max_edges: Dict[str, int] = IMAGE_MAX_EDGE,
+        image_format: str = IMAGE_NORMALIZE_FORMAT,
+        quality: int = IMAGE_NORMALIZE_QUALITY,
+    ):
+        """
+        Normalizes uploaded images before they are sent to a model: applies the EXIF
+        orientation, resizes to the backend's maximum edge and re-encodes as JPEG (or
+        WebP). Results are cached per (image digest, backend).
+        """
+        self.max_edges = max_edges
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.mime_type = "image/webp" if self.image_format == "WEBP" else "image/jpeg"
+        self._cache = SessionCache(
+            max_entries=NORMALIZED_IMAGE_CACHE_MAX_ENTRIES,
+            max_bytes=NORMALIZED_IMAGE_CACHE_MAX_BYTES,
+            ttl_seconds=NORMALIZED_IMAGE_CACHE_TTL_SECONDS,
+            size_fn=len,
+        )
+        self._in_flight = InFlightCalls()
+        self._lock = threading.Lock()
+        self._images = 0
+        self._failures = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+
+    def _normalize(self, image: ChatImage, backend: str) -> Optional[ChatImage]:
+        max_edge = self.max_edges.get(backend, DEFAULT_IMAGE_MAX_EDGE)
+        try:
+            data = _encode_image(image, max_edge, self.image_format, self.quality)
+        except Exception as e:
+            # e.g. HEIC without a decoder, the backend can still take the original
+            print(f"Image normalization failed, sending the original: {str(e)}")
+            with self._lock:
+                self._failures += 1
+            return None
+        normalized = image if data is image.data else ChatImage(data, self.mime_type)
+        self._cache.put((image.digest, backend), normalized)
+        return normalized
+
+    def normalize(self, image: ChatImage, backend: str) -> ChatImage:
+        """
+        Args:
+            image: The uploaded image
+            backend: Backend the image is sent to (selects the maximum edge)
+
+        Returns:
+            ChatImage: The normalized image, or the original if it cannot be decoded
+        """
+        key = (image.digest, backend)
+        normalized = self._cache.get(key)
+        if normalized is None:
+            # A preprocessing request may already be normalizing this image
+            normalized = self._in_flight.run(key, self._normalize, image, backend)
+            if normalized is None:
+                return image
+
+        saved = len(image) - len(normalized)
+        with self._lock:
+            self._images += 1
+            self._bytes_in += len(image)
+            self._bytes_out += len(normalized)
+        print(f"Normalized image for {backend}: {len(image)} -> {len(normalized)} bytes ({saved} saved)")
+        return normalized
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "images": self._images,
+                "failures": self._failures,
+                "bytes_in": self._bytes_in,
+                "bytes_out": self._bytes_out,
+                "bytes_saved": self._bytes_in - self._bytes_out,
+            }
+        cache = self._cache.stats()
+        stats["cache"] = {key: cache[key] for key in ("entries", "bytes", "hits", "misses", "hit_rate")}
+        return stats
+
+
+# Shared by all chat routers
+image_normalizer = ImageNormalizer()
+
+
+def normalize_image(image: ChatImage, backend: str) -> ChatImage:
+    """Normalize an image for a backend with the shared normalizer"""
+    return image_normalizer.normalize(image, backend)
+
+
+class BlobStore:
+    def __init__(self, root_dir: str):
+        """
+        Content-addressed image store. Each image is saved once under its SHA-256
+        digest (root_dir/<digest[:2]>/<digest><ext>), so identical uploads are
+        deduplicated and the stored file never changes.
+        """
+        self.root_dir = root_dir
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._dedupe_hits = 0
+        self._bytes_saved = 0
+
+    def _blob_path(self, digest: str, extension: str) -> str:
+        return os.path.join(self.root_dir, digest[:2], f"{digest}{extension}")
+
+    def put(self, data: bytes, mime_type: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Store image bytes.
+
+        Args:
+            data: The image bytes
+            mime_type: Declared MIME type, used only if the type cannot be detected
+
+        Returns:
+            Tuple[str, str]: The SHA-256 digest and the path of the stored blob
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        mime_type = sniff_image_mime(data) or mime_type or "application/octet-stream"
+        path = self._blob_path(digest, MIME_EXTENSIONS.get(mime_type, ""))
+        if os.path.exists(path):
+            with self._lock:
+                self._dedupe_hits += 1
+                self._bytes_saved += len(data)
+            return digest, path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so a blob is never seen half written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._writes += 1
+        return digest, path
+
+    def resolve(self, shard: str, blob_name: str) -> Optional[str]:
+        """Path of a blob from its URL parts, or None if the name is invalid or unknown"""
+        match = BLOB_NAME_PATTERN.match(blob_name)
+        if not match or shard != blob_name[:2]:
+            return None
+        path = self._blob_path(match.group(1), match.group(2) or "")
+        return path if os.path.exists(path) else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "writes": self._writes,
+                "dedupe_hits": self._dedupe_hits,
+                "bytes_saved": self._bytes_saved,
+            }
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def image_file_response(request: Request, path: str, etag: str, media_type: Optional[str] = None) -> Response:
+    """
+    Serve an image file with a strong ETag, long-lived cache headers,
+    If-None-Match (304) and single byte-range (206) support.
+
+    Args:
+        request: The incoming request (for conditional and range headers)
+        path: Path of the image file
+        etag: Strong ETag of the file, without quotes
+        media_type: Content type (detected from the extension if not given)
+    """
+    etag = f'"{etag}"'
+    if media_type is None:
+        media_type = EXTENSION_MIMES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    size = os.path.getsize(path)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    match = RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if match and (not if_range or if_range.strip() == etag):
+        start, end = match.groups()
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        elif end:
+            # Suffix range: the last N bytes
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = size
+        if start >= size or start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        with open(path, "rb") as f:
+            f.seek(start)
+            content = f.read(end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return Response(content=content, status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def _blob_image_response(request: Request, blob_store: BlobStore, shard: str, blob_name: str) -> Response:
+    image_path = blob_store.resolve(shard, blob_name)
+    if not image_path:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image_file_response(request, image_path, etag=os.path.splitext(blob_name)[0])
+
+
+def _legacy_image_response(request: Request, images_dir: str, chat_id: str, message_id: str) -> Response:
+    image_path = Path(images_dir, chat_id, f"{message_id}.png").resolve()
+    # Security check: ensure the requested file is within the images directory
+    if Path(images_dir).resolve() not in image_path.parents:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not image_path.exists():
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # Legacy files are saved as .png whatever their real type
+    with open(image_path, "rb") as f:
+        content_type = sniff_image_mime(f.read(16))
+    if not content_type:
+        content_type, _ = mimetypes.guess_type(str(image_path))
+
+    # Files are written once per message, so size and mtime identify the content
+    stat = image_path.stat()
+    return image_file_response(
+        request,
+        str(image_path),
+        etag=f"{stat.st_size:x}-{stat.st_mtime_ns:x}",
+        media_type=content_type or "application/octet-stream"
+    )
+
+
+async def chat_image_blob_response(request: Request, blob_store: BlobStore, shard: str, blob_name: str) -> Response:
+    """
+    Response for GET /images/blobs/{shard}/{blob_name} of a chat router. The file
+    checks and reads run in the history pool, off the event loop.
+    """
+    return await run_in_backend("history", _blob_image_response, request, blob_store, shard, blob_name)
+
+
+async def legacy_chat_image_response(request: Request, images_dir: str, chat_id: str, message_id: str) -> Response:
+    """
+    Response for GET /images/{chat_id}/{message_id}.png of a chat router (images
+    saved before the blob store). The file checks and reads run in the history pool.
+    """
+    try:
+        return await run_in_backend("history", _legacy_image_response, request, images_dir, chat_id, message_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error serving image: {str(e)}"
+        )
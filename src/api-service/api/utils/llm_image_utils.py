@@ -1,57 +1,215 @@
-from transformers import AutoImageProcessor, TFAutoModel
-from PIL import Image
-import tensorflow as tf
+import os
 import io
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+from PIL import Image
 import numpy as np
+from api.utils.image_utils import ChatImage
+from api.utils.session_utils import SessionCache
+from api.utils.singleflight_utils import InFlightCalls
+from api.utils.tracing_utils import traced
+
+# Must be the encoder and pooling src/image_2_vector/cli.py indexed the vector DB with:
+# query vectors are only comparable with the stored ones if they come from the same model
+IMAGE_MODEL = "microsoft/swinv2-base-patch4-window8-256"
+IMAGE_EMBEDDING_DIMENSION = 1024
+# Concurrent requests that arrive within the batch window share one forward pass
+IMAGE_BATCH_WINDOW_MS = float(os.environ.get("IMAGE_BATCH_WINDOW_MS", 10))
+IMAGE_MAX_BATCH_SIZE = int(os.environ.get("IMAGE_MAX_BATCH_SIZE", 16))
+# Vectors of recent uploads, so a preprocessed image is not embedded again
+IMAGE_VECTOR_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_VECTOR_CACHE_MAX_ENTRIES", 2000))
+
+
+class ImageEmbeddingEngine:
+    def __init__(
+        self,
+        model_name: str = IMAGE_MODEL,
+        output_dim: int = IMAGE_EMBEDDING_DIMENSION,
+        batch_window_ms: float = IMAGE_BATCH_WINDOW_MS,
+        max_batch_size: int = IMAGE_MAX_BATCH_SIZE,
+    ):
+        """
+        Process-wide image embedding model. The Swinv2 model is loaded once, and
+        concurrent requests are grouped into micro-batches by a worker thread so they
+        share a single forward pass.
+        """
+        self.model_name = model_name
+        self.output_dim = output_dim
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self.processor = None
+        self.model = None
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._max_batch = 0
+        self._batch_seconds = 0.0
+        self._last_batch_ms = 0.0
+        self._max_batch_ms = 0.0
+
+    def _load_model(self):
+        """Load the image processor and model, returns the size of their pooled features"""
+        from transformers import AutoImageProcessor, Swinv2Model
+
+        self.processor = AutoImageProcessor.from_pretrained(self.model_name)
+        self.model = Swinv2Model.from_pretrained(self.model_name)
+        self.model.eval()
+        return self.model.config.hidden_size
+
+    def _features(self, images: List[Image.Image]) -> np.ndarray:
+        """Mean pooled Swinv2 features for a batch of images, shape (batch, hidden_size)"""
+        import torch
+
+        inputs = self.processor(images=images, return_tensors="pt")
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+        return outputs.last_hidden_state.mean(dim=1).numpy()
+
+    def start(self) -> "ImageEmbeddingEngine":
+        """Load the model and start the batching worker (idempotent)"""
+        with self._load_lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                feature_dim = self._load_model()
+                if feature_dim != self.output_dim:
+                    raise ValueError(f"Image model {self.model_name} has {feature_dim} features, the vector DB expects {self.output_dim}")
+                self._loaded = True
+                print(f"Loaded image embedding model {self.model_name} in {time.perf_counter() - start:.1f}s")
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="image-embedding", daemon=True)
+                self._worker.start()
+        return self
+
+    def embed_batch(self, images: List[Image.Image]) -> np.ndarray:
+        """Embed a batch of images directly, shape (batch, output_dim)"""
+        self.start()
+        return self._features(images).astype(np.float32)
+
+    def embed(self, image: Image.Image) -> np.ndarray:
+        """
+        Embed one image, batched with other concurrent calls.
+
+        Args:
+            image: An RGB image
+
+        Returns:
+            np.ndarray: A output_dim image vector
+        """
+        self.start()
+        future: Future = Future()
+        self._queue.put((image, future))
+        return future.result()
+
+    def _next_batch(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                vectors = self.embed_batch([image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+            self._record_batch(len(batch), time.perf_counter() - start)
+
+    def _record_batch(self, size: int, seconds: float):
+        with self._stats_lock:
+            self._batches += 1
+            self._images += size
+            self._max_batch = max(self._max_batch, size)
+            self._batch_seconds += seconds
+            self._last_batch_ms = seconds * 1000
+            self._max_batch_ms = max(self._max_batch_ms, seconds * 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "loaded": self._loaded,
+                "batches": self._batches,
+                "images": self._images,
+                "mean_batch_size": self._images / self._batches if self._batches else 0.0,
+                "max_batch_size": self._max_batch,
+                "mean_batch_ms": self._batch_seconds * 1000 / self._batches if self._batches else 0.0,
+                "last_batch_ms": self._last_batch_ms,
+                "max_batch_ms": self._max_batch_ms,
+                "queued": self._queue.qsize(),
+            }
+
+
+# Shared by the RAG router, started when the router is loaded
+image_embedding_engine = ImageEmbeddingEngine()
+
 
 def image_to_vector(image_path: str) -> np.ndarray:
     """
-    Convert an image to a vector using a pre-trained Vision Transformer model with TensorFlow.
-    
+    Convert an image to a vector using the pre-trained Swinv2 model the vector DB was indexed with.
+
     Args:
         image_path (str): The path to the image file.
-    
+
     Returns:
         np.ndarray: A 1024-dimensional image vector.
     """
-    processor = AutoImageProcessor.from_pretrained("google/vit-base-patch16-224")
-    model = TFAutoModel.from_pretrained("google/vit-base-patch16-224")
-
-    # Add a dense layer to ensure output vector size is 1024
-    dense_layer = tf.keras.layers.Dense(1024, activation=None)
-
     image = Image.open(image_path).convert("RGB")
-    inputs = processor(images=image, return_tensors="tf")
-    outputs = model(**inputs)
-    
-    # Use dense layer to reshape the vector
-    pooled_output = tf.reduce_mean(outputs.last_hidden_state, axis=1)
-    reshaped_output = dense_layer(pooled_output)
-
-    return reshaped_output.numpy().squeeze()
+    return image_embedding_engine.embed(image)
 
 def image_to_vector_from_bytes(image_bytes: bytes) -> np.ndarray:
     """
-    Convert an image from bytes to a vector using a pre-trained Vision Transformer model with TensorFlow.
-    
+    Convert an image from bytes to a vector using the pre-trained Swinv2 model the vector DB was indexed with.
+
     Args:
         image_bytes (bytes): The byte data of the image.
-    
+
     Returns:
         np.ndarray: A 1024-dimensional image vector.
     """
-    processor = AutoImageProcessor.from_pretrained("google/vit-base-patch16-224")
-    model = TFAutoModel.from_pretrained("google/vit-base-patch16-224")
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    return image_embedding_engine.embed(image)
 
-    # Add a dense layer to ensure output vector size is 1024
-    dense_layer = tf.keras.layers.Dense(1024, activation=None)
 
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    inputs = processor(images=image, return_tensors="tf")
-    outputs = model(**inputs)
+_image_vectors = SessionCache(
+    max_entries=IMAGE_VECTOR_CACHE_MAX_ENTRIES,
+    max_bytes=IMAGE_VECTOR_CACHE_MAX_ENTRIES * IMAGE_EMBEDDING_DIMENSION * 4,
+    ttl_seconds=float("inf"),
+    size_fn=lambda vector: vector.nbytes,
+)
+_embedding = InFlightCalls()
+
 
-    # Use dense layer to reshape the vector
-    pooled_output = tf.reduce_mean(outputs.last_hidden_state, axis=1)
-    reshaped_output = dense_layer(pooled_output)
+def _embed_uncached(image: ChatImage) -> np.ndarray:
+    vector = image_to_vector_from_bytes(image.normalized("embedding").data)
+    _image_vectors.put(image.digest, vector)
+    return vector
 
-    return reshaped_output.numpy().squeeze()
+@traced("image.embedding")
+def embed_image(image: ChatImage) -> np.ndarray:
+    """
+    Vector of an uploaded image, cached by its hash. Joins the embedding of the
+    same image if a preprocessing request is already computing it.
+    """
+    vector = _image_vectors.get(image.digest)
+    if vector is None:
+        vector = _embedding.run(image.digest, _embed_uncached, image)
+    return vector
@@ -1,11 +1,19 @@
 import os
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, AsyncIterator, List, Optional
 from fastapi import HTTPException
 import base64
 from PIL import Image
 import traceback
 from vertexai.generative_models import GenerativeModel, ChatSession, Part
-import requests
+from api.utils.session_utils import chat_sessions
+from api.utils.history_utils import build_chat_history
+from api.utils.description_utils import describe_image, description_calls, prompt_version
+from api.utils.image_utils import MIME_EXTENSIONS, ChatImage
+from api.utils.backend_utils import run_in_backend
+from api.utils.http_utils import get_http_client
+from api.utils.rate_limit_utils import rate_limited_async, uses_quotas
+from api.utils.startup_utils import lazy_resource
+from api.utils.tracing_utils import span, traced
 
 # Setup
 GCP_PROJECT = os.environ["GCP_PROJECT"]
@@ -13,8 +21,16 @@ GCP_LOCATION = "us-central1"
 EMBEDDING_MODEL = "text-embedding-004"
 EMBEDDING_DIMENSION = 256
 MODAL_API_URL = "https://wwww0203--llama-predict2-llamamodel-predict.modal.run"
+MODAL_STREAM_API_URL = os.environ.get(
+    "MODAL_STREAM_API_URL",
+    "https://wwww0203--llama-predict2-llamamodel-predict-stream.modal.run"
+)
 GENERATIVE_MODEL = "gemini-1.5-flash-002"
 
+# Pooled keep-alive client for the Modal endpoints. Timeouts, retries and the
+# circuit breaker are configured with MODAL_* environment variables (see http_utils).
+modal_client = get_http_client("modal")
+
 # Configuration settings for the content generation
 generation_config = {
     "max_output_tokens": 3000,  # Maximum number of tokens for output
@@ -40,10 +56,11 @@ When generating crochet instructions:
 
 You are a crochet expert, and your role is to create detailed, accurate, and original crochet instructions.
 """
-generative_model = GenerativeModel(
+# Created on first use (or by the startup warmup), not at import
+generative_model = lazy_resource("llm-llama.generative_model", lambda: GenerativeModel(
 	GENERATIVE_MODEL,
 	system_instruction=[SYSTEM_INSTRUCTION]
-)
+))
 
 DESCRIPTION_PROMPT = '''
 You are an expert in textile arts with a specialization in crochet. 
@@ -75,124 +92,143 @@ Structured Format: Present the information in a well-organized manner, possibly
 '''
 
 # Keep the existing Gemini model for image description
-description_model = GenerativeModel(
+description_model = lazy_resource("llm-llama.description_model", lambda: GenerativeModel(
     "gemini-1.5-flash-002",
     system_instruction=[DESCRIPTION_PROMPT]
-)
+))
 
-# Initialize chat sessions
-chat_sessions: Dict[str, ChatSession] = {}
+# Stored descriptions are reused only for the same model, prompt and settings
+DESCRIPTION_VERSION = prompt_version("gemini-1.5-flash-002", DESCRIPTION_PROMPT, generation_config)
 
 def create_chat_session() -> ChatSession:
     """Create a new chat session with the model"""
     return generative_model.start_chat()
 
-def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
+def build_modal_request(message: Dict) -> Dict:
+    """
+    Build the Modal LLaMA API request for a message. For image messages the image
+    is first described by Gemini and the description is added to the prompt.
+    
+    Args:
+        message: Dict containing 'content' (text) and optionally 'image' (ChatImage or base64 string)
+    
+    Returns:
+        Dict: Keyword arguments ('data' and optionally 'files') for the Modal API call
+    """
+    if not message.get("image"):
+        # For text-only messages, call Modal API directly
+        return {"data": {'description': message.get('content', '')}}
+
+    try:
+        # Image decoded once by the router
+        image = ChatImage.coerce(message["image"])
+
+        # Step 1: Generate image description (skipped if this image was described before)
+        generated_description = describe_image(image, description_model, DESCRIPTION_VERSION, generation_config)
+
+        # Create prompt combining description and user message
+        prompt = f"""
+        Based on this image and the following description:
+
+        {generated_description}
+
+        {message.get('content', '')}
+
+        Please provide detailed crochet instructions for recreating this crocheted item in the image.
+        And remember to add the abbreviation for 'next line' when finishing each round of instruction.
+        """
+        print(">>>", prompt)
+
+        # The Modal container writes the upload to disk, send it at the size LLaMA uses
+        modal_image = image.normalized("llm-llama")
+
+        return {
+            "files": {'image': ('image' + MIME_EXTENSIONS.get(modal_image.mime_type, '.jpg'), modal_image.data, modal_image.mime_type)},
+            "data": {'description': prompt}
+        }
+        
+    except ValueError as e:
+        print(f"Error processing image: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
+
+def generation_quotas(chat_session: ChatSession, message: Dict) -> Dict[str, int]:
+    """
+    Gemini calls of a generation: the image description unless stored (it runs in a
+    worker thread). The Modal call waits for its quota on the event loop itself.
+    """
+    image = ChatImage.coerce(message["image"]) if message.get("image") else None
+    return {"gemini": description_calls(image, DESCRIPTION_VERSION)}
+
+def preprocess_quotas(image: ChatImage) -> Dict[str, int]:
+    return {"gemini": description_calls(image, DESCRIPTION_VERSION)}
+
+@uses_quotas(generation_quotas)
+@traced("generation", backend="llm-llama")
+async def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
     """
     Generate a response using the chat session to maintain history.
     Handles both text and image inputs.
     
     Args:
         chat_session: The Vertex AI chat session
-        message: Dict containing 'content' (text) and optionally 'image' (base64 string)
+        message: Dict containing 'content' (text) and optionally 'image' (ChatImage or base64 string)
     
     Returns:
         str: The model's response
     """
     try:
-        message_parts = []
-        generated_description = None
-        
-        if message.get("image"):
-            try:
-                # Extract base64 data and mime type
-                base64_string = message.get("image")
-                if ',' in base64_string:
-                    header, base64_data = base64_string.split(',', 1)
-                    mime_type = header.split(':')[1].split(';')[0]
-                else:
-                    base64_data = base64_string
-                    mime_type = 'image/jpeg'
-                
-                image_bytes = base64.b64decode(base64_data)
-                image_part = Part.from_data(image_bytes, mime_type=mime_type)
-
-                # Step 1: Generate image description
-                # Add a text prompt along with the image
-                description_parts = [
-                    image_part,
-                    "Please analyze this crochet item and provide a detailed description of the crochet item."
-                ]
-                description_response = description_model.start_chat().send_message(
-                    description_parts,
-                    generation_config=generation_config
-                )
-                generated_description = description_response.text
-
-                # Prepare data for Modal LLaMA API
-                base64_string = message.get("image")
-                if ',' in base64_string:
-                    _, base64_data = base64_string.split(',', 1)
-                else:
-                    base64_data = base64_string
-
-                # Create prompt combining description and user message
-                prompt = f"""
-                Based on this image and the following description:
-
-                {generated_description}
-
-                {message.get('content', '')}
-
-                Please provide detailed crochet instructions for recreating this crocheted item in the image.
-                And remember to add the abbreviation for 'next line' when finishing each round of instruction.
-                """
-
-                # prompt = f"""
-                # Here is the user prompt:
-
-                # {message.get('content')}
-
-                # Please provide detailed crochet instructions for recreating this crocheted item in the image.
-                # """
-                print(">>>", prompt)
-                
-                # Modal API call
-                response = requests.post(
-                    MODAL_API_URL,
-                    files={'image': ('image.jpg', base64.b64decode(base64_data), mime_type)},  
-                    data={'description': prompt} 
-                )
-                
-                print("--output response---------------------")
-                print(response.json()['output'])
-
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail="Failed to get response from Modal API"
-                    )
-                
-                return response.json()['output']
-                
-            except ValueError as e:
-                print(f"Error processing image: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
-        else:
-            # For text-only messages, call Modal API directly
-            response = requests.post(
-                MODAL_API_URL,
-                data={'description': message.get('content', '')}
+        # Describing the image calls Gemini, keep it off the event loop
+        modal_request = await run_in_backend("llm-llama", build_modal_request, message)
+
+        # Modal API call, within the Modal request quota
+        async with rate_limited_async("modal"):
+            with span("model.call"):
+                response = await modal_client.post(MODAL_API_URL, **modal_request)
+
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail="Failed to get response from Modal API"
             )
+        
+        output = response.json()['output']
+        print("--output response---------------------")
+        print(output)
+        return output
             
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail="Failed to get response from Modal API"
-                )
-            
-            return response.json()['output']
-            
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to generate response: {str(e)}"
+        )
+
+@uses_quotas(generation_quotas)
+@traced("generation", backend="llm-llama")
+async def generate_chat_response_stream(chat_session: ChatSession, message: Dict) -> AsyncIterator[str]:
+    """
+    Stream a response as text chunks as they arrive from the Modal LLaMA
+    streaming endpoint. Takes the same arguments as generate_chat_response.
+    """
+    try:
+        modal_request = await run_in_backend("llm-llama", build_modal_request, message)
+        async with rate_limited_async("modal"):
+            with span("model.call"):
+                async with modal_client.stream("POST", MODAL_STREAM_API_URL, **modal_request) as response:
+                    if response.status_code != 200:
+                        raise HTTPException(
+                            status_code=response.status_code,
+                            detail="Failed to get response from Modal API"
+                        )
+                    async for chunk in response.aiter_text():
+                        if chunk:
+                            yield chunk
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
@@ -201,17 +237,15 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
             detail=f"Failed to generate response: {str(e)}"
         )
 
+@uses_quotas(preprocess_quotas)
+def preprocess_image(image: ChatImage) -> None:
+    """
+    Run the image steps of a chat message ahead of time (POST /images), so the
+    message that uses the image finds their results cached or in flight.
+    """
+    describe_image(image, description_model, DESCRIPTION_VERSION, generation_config)
+    image.normalized("llm-llama")
+
 def rebuild_chat_session(chat_history: List[Dict]) -> ChatSession:
-    """Rebuild a chat session with complete context"""
-    new_session = create_chat_session()
-    
-    for message in chat_history:
-        if message["role"] == "user":
-            generate_chat_response(new_session, message)
-        # 
-        #     response = new_session.send_message(
-        #         message["content"],
-        #         generation_config=generation_config
-        #     )
-    
-    return new_session
\ No newline at end of file
+    """Rebuild a chat session from the stored history without calling the model"""
+    return generative_model.start_chat(history=build_chat_history(chat_history))
@@ -1,14 +1,24 @@
 import os
-from typing import Dict, Any, List, Optional
+import hashlib
+from typing import Dict, Any, Iterator, List, Optional
 from fastapi import HTTPException
 import base64
 from PIL import Image
 from pathlib import Path
 import traceback
-import chromadb
 from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
 from vertexai.generative_models import GenerativeModel, ChatSession, Part
-from api.utils.llm_image_utils import image_to_vector, image_to_vector_from_bytes  
+from api.utils.session_utils import SESSION_CACHE_TTL_SECONDS, SessionCache, chat_sessions
+from api.utils.history_utils import build_chat_history
+from api.utils.history_compaction_utils import history_compactor
+from api.utils.description_utils import description_store
+from api.utils.image_utils import ChatImage
+from api.utils.rate_limit_utils import rate_limited, uses_quotas
+from api.utils.startup_utils import lazy_resource
+from api.utils.tracing_utils import span, traced
+from api.utils.context_utils import context_builder, query_ranked
+from api.utils.embedding_utils import query_embedding_cache
+from api.utils.llm_image_utils import embed_image, image_embedding_engine, image_to_vector
 
 # Setup
 GCP_PROJECT = os.environ["GCP_PROJECT"]
@@ -54,72 +64,175 @@ Here is the format:
 - Ensure each step is on its own line without excessive line breaks.
 """
 
-generative_model = GenerativeModel(
+# Models and connections are created on first use (or by the startup warmup), not
+# at import, so the service starts quickly and survives Chroma being briefly down
+generative_model = lazy_resource("llm-rag.generative_model", lambda: GenerativeModel(
 	GENERATIVE_MODEL,
 	system_instruction=[SYSTEM_INSTRUCTION]
-)
-
-embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+))
 
-# Initialize chat sessions
-chat_sessions: Dict[str, ChatSession] = {}
+embedding_model = lazy_resource("llm-rag.embedding_model", lambda: TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL))
 
-# Connect to chroma DB
-client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
 collection_name = "semantic-text-image-collection"
 
-# Get the collection
-collection = client.get_collection(name=collection_name)
-
-def re_rank_results(text_results, image_results, text_weight=0.6, image_weight=0.4):
-    """
-    Re-rank results based on weighted scores from both text and image searches.
-
-    Args:
-    - text_results (dict): The results from the text query.
-    - image_results (dict): The results from the image query.
-    - text_weight (float): The weight to apply to text scores (default 0.6).
-    - image_weight (float): The weight to apply to image scores (default 0.4).
-
-    Returns:
-    - ranked_results (list): List of documents sorted by the combined weighted score.
-    """
-    result_scores = {}
-
-    # Combine scores from text results
-    for idx, doc_id in enumerate(text_results["ids"][0]):  # Access list inside "ids"
-        score = text_results["distances"][0][idx] * text_weight  # Access corresponding score
-        if doc_id not in result_scores:
-            result_scores[doc_id] = score
-        else:
-            result_scores[doc_id] += score  # If doc already exists, sum up the scores
+def connect_collection():
+	import chromadb
 
-    # Combine scores from image results
-    for idx, doc_id in enumerate(image_results["ids"][0]):  # Access list inside "ids"
-        score = image_results["distances"][0][idx] * image_weight  # Access corresponding score
-        if doc_id not in result_scores:
-            result_scores[doc_id] = score
-        else:
-            result_scores[doc_id] += score  # If doc already exists, sum up the scores
+	# Connect to chroma DB and get the collection
+	client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+	return client.get_collection(name=collection_name)
 
-    # Sort the documents based on the combined score (lower distances mean better matches)
-    sorted_results = sorted(result_scores.items(), key=lambda item: item[1])
+# Not required for readiness: the other chat routers work without Chroma, and the
+# warmup keeps retrying the connection
+collection = lazy_resource("chromadb.collection", connect_collection, required=False)
 
-    # Convert the sorted results into a list of dictionaries for better readability
-    ranked_results = [{"id": doc_id, "score": score} for doc_id, score in sorted_results]
+# Load the image embedding model once, not on every request
+image_embedding_model = lazy_resource("llm-rag.image_embedding_model", image_embedding_engine.start)
 
-    return ranked_results
-
-def generate_query_embedding(query):
+@traced("chroma.query")
+def retrieve_chunks(query_embedding, image_embedding=None, n_results=5):
+    """
+    Retrieve and rank chunks for a query in a single round trip to the vector DB: the
+    text+image vector and the text-only vector are sent as one batched query.
+    """
+    # Zero image vector for text-only retrieval (and when no image was provided)
+    dummy_image_embedding = [0.0] * 1024
+    combined_embedding = query_embedding + (image_embedding if image_embedding is not None else dummy_image_embedding)
+    return query_ranked(
+        collection,
+        [combined_embedding, query_embedding + dummy_image_embedding],
+        weights=(0.6, 0.4),
+        n_results=n_results,
+    )
+
+def embed_query(query):
 	query_embedding_inputs = [TextEmbeddingInput(task_type='RETRIEVAL_DOCUMENT', text=query)]
 	kwargs = dict(output_dimensionality=EMBEDDING_DIMENSION) if EMBEDDING_DIMENSION else {}
-	embeddings = embedding_model.get_embeddings(query_embedding_inputs, **kwargs)
+	with rate_limited("embedding"):
+		embeddings = embedding_model.get_embeddings(query_embedding_inputs, **kwargs)
 	return embeddings[0].values
 
+@traced("text.embedding")
+def generate_query_embedding(query):
+	# Repeated prompts skip the Vertex AI round trip
+	return query_embedding_cache.get_or_compute(EMBEDDING_MODEL, 'RETRIEVAL_DOCUMENT', EMBEDDING_DIMENSION, query, embed_query)
+
+# Digest of each normalized image sent to Gemini -> digest of the upload, under which
+# its description is stored (used when the image is compacted out of the history)
+_sent_image_digests = SessionCache(
+    max_entries=10000,
+    max_bytes=10000 * 128,
+    ttl_seconds=SESSION_CACHE_TTL_SECONDS,
+    size_fn=len,
+)
+
+def cached_image_description(data: bytes) -> Optional[str]:
+    """Stored description of an image in a session's history, if it was ever described"""
+    digest = hashlib.sha256(data).hexdigest()
+    return description_store.get_latest(_sent_image_digests.get(digest) or digest)
+
+@traced("history.compact")
+def compact_history(chat_session: ChatSession, model_input: List) -> None:
+    """
+    Apply the history policy to a session before sending a message, so each turn
+    re-sends a bounded history instead of every earlier turn and image.
+    """
+    compacted, report = history_compactor.compact(chat_session.history, model_input, describe=cached_image_description)
+    if compacted is not None:
+        chat_session.history[:] = compacted
+        print(
+            f"History compacted: {report['tokens_before']} -> {report['tokens_after']} tokens "
+            f"({report['turns_summarized']} turns summarized, {report['images_described']} images described)"
+        )
+
 def create_chat_session() -> ChatSession:
     """Create a new chat session with the model"""
     return generative_model.start_chat()
 
+def build_model_input(message: Dict) -> List:
+    """
+    Build the model input for a message: the image (if any) plus the user's text
+    augmented with chunks retrieved from the vector DB.
+    
+    Args:
+        message: Dict containing 'content' (text) and optionally 'image' (ChatImage or base64 string) or 'image_path'
+    
+    Returns:
+        List: Parts to send to the chat session
+    """
+    # Initialize parts list for the message
+    message_parts = []
+    image_part = None
+    image_embedding = None
+    
+    # Process image if present
+    if message.get("image"):
+        try:
+            # Image decoded once by the router
+            image = ChatImage.coerce(message["image"])
+            model_image = image.normalized("llm-rag")
+            image_part = Part.from_data(model_image.data, mime_type=model_image.mime_type)
+            _sent_image_digests.put(model_image.digest, image.digest)
+            
+            # Convert the image bytes to a vector (used for retrieval only, not stored with the message)
+            image_embedding = embed_image(image).tolist()
+
+        except ValueError as e:
+            print(f"Error processing image: {str(e)}")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Image processing failed: {str(e)}"
+            )
+
+    # Process image path if present
+    if message.get("image_path"):
+        image_path = message["image_path"]
+        # Convert the image to a vector
+        image_embedding = image_to_vector(image_path).tolist()
+
+    # Add text content if present
+    if message.get("content"):
+        # Create embeddings for the message content
+        query_embedding = generate_query_embedding(message["content"])
+
+        # One batched query for the combined and the text-only vectors, ranked locally
+        ranked_results = retrieve_chunks(query_embedding, image_embedding)
+        # Deduplicated chunks, best first, within the context token budget
+        combined_text_chunks, context_report = context_builder.build(ranked_results)
+        print(
+            f"RAG context: {context_report['chunks_used']}/{context_report['chunks_retrieved']} chunks, "
+            f"{context_report['tokens_used']} tokens ({context_report['tokens_saved']} saved)"
+        )
+
+        if ranked_results:
+            INPUT_PROMPT = f"""
+            {message["content"]}
+            {combined_text_chunks}
+            """
+            message_parts.append(INPUT_PROMPT)
+        else:
+            message_parts.append("No relevant results found.")
+
+    if not message_parts:
+        raise ValueError("Message must contain either text content or image")
+
+    print(f"Message parts: {message['content']}")
+    model_input = [image_part] + message_parts if image_part else message_parts
+    return model_input
+
+def generation_quotas(chat_session: ChatSession, message: Dict) -> Dict[str, int]:
+    """
+    Upstream calls of a generation: the query embedding (unless cached) and the reply.
+    Image embeddings are computed locally; preprocess_image makes no upstream call.
+    """
+    quotas = {"gemini": 1}
+    content = message.get("content")
+    if content and not query_embedding_cache.in_memory(EMBEDDING_MODEL, 'RETRIEVAL_DOCUMENT', EMBEDDING_DIMENSION, content):
+        quotas["embedding"] = 1
+    return quotas
+
+@uses_quotas(generation_quotas)
+@traced("generation", backend="llm-rag")
 def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
     """
     Generate a response using the chat session to maintain history.
@@ -127,114 +240,58 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
     
     Args:
         chat_session: The Vertex AI chat session
-        message: Dict containing 'content' (text) and optionally 'image' (base64 string or image path)
+        message: Dict containing 'content' (text) and optionally 'image' (ChatImage or base64 string) or 'image_path'
     
     Returns:
         str: The model's response
     """
     try:
-        # Initialize parts list for the message
-        message_parts = []
-        
-        # Process image if present
-        if message.get("image"):
-            try:
-                # Extract the actual base64 data and mime type
-                base64_string = message.get("image")
-                if ',' in base64_string:
-                    header, base64_data = base64_string.split(',', 1)
-                    mime_type = header.split(':')[1].split(';')[0]
-                else:
-                    base64_data = base64_string
-                    mime_type = 'image/jpeg'  # default to JPEG if no header
-                
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(base64_data)
-                image_part = Part.from_data(image_bytes, mime_type=mime_type)
-                
-                # Convert the image bytes to a vector
-                image_vector = image_to_vector_from_bytes(image_bytes)
-
-                # Add the image vector to the message
-                message["image_embedding"] = image_vector.tolist() 
-
-            except ValueError as e:
-                print(f"Error processing image: {str(e)}")
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Image processing failed: {str(e)}"
-                )
-
-        # Process image path if present
-        if message.get("image_path"):
-            image_path = message["image_path"]
-            # Convert the image to a vector
-            image_vector = image_to_vector(image_path)
-
-            # Add the image vector to the message
-            message["image_embedding"] = image_vector.tolist()  
-
-        # Add text content if present
-        if message.get("content"):
-            # Create embeddings for the message content
-            query_embedding = generate_query_embedding(message["content"])
-            
-            # Create a dummy image embedding if not provided
-            dummy_image_embedding = [0.0] * 1024
-
-            # Retrieve the image embedding from the message
-            image_embedding = message.get("image_embedding", dummy_image_embedding) 
-
-            # Concatenate the query embedding and image embedding
-            combined_embedding = query_embedding + image_embedding
-
-            # Perform the text query with the combined embedding
-            combined_results = collection.query(
-                query_embeddings=[combined_embedding],
-                n_results=5
-            )
-
-            # Perform the image query with only query embedding
-            text_results = collection.query(
-                query_embeddings=[query_embedding+dummy_image_embedding],
-                n_results=5
+        model_input = build_model_input(message)
+        compact_history(chat_session, model_input)
+
+        # Send message with all parts to the model, within the Gemini quota
+        with rate_limited("gemini"), span("model.call"):
+            response = chat_session.send_message(
+                model_input,
+                generation_config=generation_config
             )
-
-            # Re-rank the results based on both text and image queries
-            ranked_results = re_rank_results(combined_results, text_results, text_weight=0.6, image_weight=0.4)
-
-            # Extract document IDs from ranked results
-            result_ids = [result['id'] for result in ranked_results]
-            retrieved_data = collection.get(ids=result_ids, include=['documents', 'embeddings'])
-            embedded_texts = retrieved_data['documents']
-            combined_text_chunks = ' '.join(embedded_texts)
-
-            # Extract the top-ranked document
-            if ranked_results:
-                top_result = ranked_results[0]['id']
-                INPUT_PROMPT = f"""
-                {message["content"]}
-                {combined_text_chunks}
-                """
-                message_parts.append(INPUT_PROMPT)
-            else:
-                message_parts.append("No relevant results found.")
-
-        if not message_parts:
-            raise ValueError("Message must contain either text content or image")
-
-        print(f"Message parts: {message["content"]}")
-        model_input = [image_part] + message_parts if image_part else message_parts
-
-        # Send message with all parts to the model
-        response = chat_session.send_message(
-            model_input,
-            generation_config=generation_config
-        )
         
         print(f"Response: {response.text}")
         return response.text
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to generate response: {str(e)}"
+        )
+
+@uses_quotas(generation_quotas)
+@traced("generation", backend="llm-rag")
+def generate_chat_response_stream(chat_session: ChatSession, message: Dict) -> Iterator[str]:
+    """
+    Stream a response as text chunks as they arrive from the model.
+    Takes the same arguments as generate_chat_response; the chat session's history
+    is updated once the stream has been fully consumed.
+    """
+    try:
+        model_input = build_model_input(message)
+        compact_history(chat_session, model_input)
+        with rate_limited("gemini"), span("model.call"):
+            responses = chat_session.send_message(
+                model_input,
+                generation_config=generation_config,
+                stream=True
+            )
+            for response in responses:
+                if response.candidates and response.candidates[0].content.parts:
+                    yield response.text
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
@@ -243,12 +300,14 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
             detail=f"Failed to generate response: {str(e)}"
         )
 
+def preprocess_image(image: ChatImage) -> None:
+    """
+    Run the image steps of a chat message ahead of time (POST /images), so the
+    message that uses the image finds their results cached or in flight.
+    """
+    image.normalized("llm-rag")
+    embed_image(image)
+
 def rebuild_chat_session(chat_history: List[Dict]) -> ChatSession:
-    """Rebuild a chat session with complete context"""
-    new_session = create_chat_session()
-    
-    for message in chat_history:
-        if message["role"] == "user":
-            generate_chat_response(new_session, message)
-    
-    return new_session
\ No newline at end of file
+    """Rebuild a chat session from the stored history without calling the model"""
+    return generative_model.start_chat(history=build_chat_history(chat_history))
@@ -1,5 +1,5 @@
 import os
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterator, List, Optional
 from fastapi import HTTPException
 import base64
 import io
@@ -7,6 +7,13 @@ from PIL import Image
 from pathlib import Path
 import traceback
 from vertexai.generative_models import GenerativeModel, ChatSession, Part
+from api.utils.session_utils import chat_sessions
+from api.utils.history_utils import build_chat_history
+from api.utils.description_utils import describe_image, description_calls, prompt_version
+from api.utils.image_utils import ChatImage
+from api.utils.rate_limit_utils import rate_limited, uses_quotas
+from api.utils.startup_utils import lazy_resource
+from api.utils.tracing_utils import span, traced
 
 # Setup
 GCP_PROJECT = os.environ["GCP_PROJECT"]
@@ -52,10 +59,11 @@ Here is the format:
 - Use clear and concise language to guide the user through the crochet process.
 """
 
-generative_model = GenerativeModel(
+# Created on first use (or by the startup warmup), not at import
+generative_model = lazy_resource("llm.generative_model", lambda: GenerativeModel(
 	MODEL_ENDPOINT,
 	system_instruction=[SYSTEM_INSTRUCTION]
-)
+))
 
 DESCRIPTION_PROMPT = '''
 You are an expert in textile arts with a specialization in crochet. 
@@ -88,18 +96,77 @@ Structured Format: Present the information in a well-organized manner, possibly
 '''
 
 # Keep the existing Gemini model for image description
-description_model = GenerativeModel(
+description_model = lazy_resource("llm.description_model", lambda: GenerativeModel(
     "gemini-1.5-flash-002",
     system_instruction=[DESCRIPTION_PROMPT]
-)
+))
 
-# Initialize chat sessions
-chat_sessions: Dict[str, ChatSession] = {}
+# Stored descriptions are reused only for the same model, prompt and settings
+DESCRIPTION_VERSION = prompt_version("gemini-1.5-flash-002", DESCRIPTION_PROMPT, generation_config)
 
 def create_chat_session() -> ChatSession:
     """Create a new chat session with the model"""
     return generative_model.start_chat()
 
+def build_model_input(message: Dict) -> List:
+    """
+    Build the model input for a message: the image plus a prompt that combines a
+    generated description of the image with the user's instructions.
+    
+    Args:
+        message: Dict containing 'content' (text) and optionally 'image' (ChatImage or base64 string)
+    
+    Returns:
+        List: Parts to send to the generative model
+    """
+    # Initialize parts list for the message
+    message_parts = []
+    
+    # Process image if present
+    if message.get("image"):
+        try:
+            # Image decoded once by the router
+            image = ChatImage.coerce(message["image"])
+            model_image = image.normalized("llm")
+            image_part = Part.from_data(model_image.data, mime_type=model_image.mime_type)
+
+            # First call to generate description (skipped if this image was described before)
+            generated_description = describe_image(image, description_model, DESCRIPTION_VERSION, generation_config)
+
+            # Step 2: Generate crochet instructions using both image and description
+            instruction_prompt = f"""
+            Based on this image and the following description:
+
+            {generated_description}
+
+            User Instructions:
+
+            {message.get('content', 'Please provide detailed crochet instructions for recreating this item.')}
+            """
+            
+            # description-based prompt
+            message_parts = instruction_prompt
+            
+        except ValueError as e:
+            print(f"Error processing image: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
+
+    if not message_parts:
+        raise ValueError("Message must contain either text content or image")
+
+    print("Message parts:", message_parts)
+    return [image_part, message_parts]
+
+def generation_quotas(chat_session: ChatSession, message: Dict) -> Dict[str, int]:
+    """Gemini calls of a generation: the image description (unless stored) and the reply"""
+    image = ChatImage.coerce(message["image"]) if message.get("image") else None
+    return {"gemini": description_calls(image, DESCRIPTION_VERSION) + 1}
+
+def preprocess_quotas(image: ChatImage) -> Dict[str, int]:
+    return {"gemini": description_calls(image, DESCRIPTION_VERSION)}
+
+@uses_quotas(generation_quotas)
+@traced("generation", backend="llm")
 def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
     """
     Generate a response using the chat session to maintain history.
@@ -107,81 +174,26 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
     
     Args:
         chat_session: The Vertex AI chat session
-        message: Dict containing 'content' (text) and optionally 'image' (base64 string)
+        message: Dict containing 'content' (text) and optionally 'image' (ChatImage or base64 string)
     
     Returns:
         str: The model's response
     """
-    # response = chat_session.send_message(
-    #     message,
-    #     generation_config=generation_config
-    # )
-    # return response.text
     try:
-        # Initialize parts list for the message
-        message_parts = []
-        
-        
-        # Process image if present
-        if message.get("image"):
-            try:
-                # Extract base64 data and mime type
-                base64_string = message.get("image")
-                if ',' in base64_string:
-                    header, base64_data = base64_string.split(',', 1)
-                    mime_type = header.split(':')[1].split(';')[0]
-                else:
-                    base64_data = base64_string
-                    mime_type = 'image/jpeg'
-                
-                image_bytes = base64.b64decode(base64_data)
-                image_part = Part.from_data(image_bytes, mime_type=mime_type)
-
-                
-                # First call to generate description
-                description_parts = [
-                    image_part,
-                    "Please analyze this crochet item and provide a detailed description of the crochet item."
-                ]
-                description_response = description_model.start_chat().send_message(
-                    description_parts,
-                    generation_config=generation_config
-                )
-                generated_description = description_response.text
-
-                # Step 2: Generate crochet instructions using both image and description
-                instruction_prompt = f"""
-                Based on this image and the following description:
-
-                {generated_description}
-
-                User Instructions:
-
-                {message.get('content', 'Please provide detailed crochet instructions for recreating this item.')}
-                """
-                
-                # description-based prompt
-                message_parts = instruction_prompt
-                
-            except ValueError as e:
-                print(f"Error processing image: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
-
-        if not message_parts:
-            raise ValueError("Message must contain either text content or image")
-
-        print("Message parts:", message_parts)
-
-        # Send message with all parts to the model
-        response = generative_model.generate_content(
-            # [message_parts],  
-            [image_part, message_parts],
-            generation_config=generation_config, 
-            stream=False, 
-        )
+        model_input = build_model_input(message)
+
+        # Send message with all parts to the model, within the Gemini quota
+        with rate_limited("gemini"), span("model.call"):
+            response = generative_model.generate_content(
+                model_input,
+                generation_config=generation_config, 
+                stream=False, 
+            )
 
         return response.text
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
@@ -190,17 +202,44 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
             detail=f"Failed to generate response: {str(e)}"
         )
 
+@uses_quotas(generation_quotas)
+@traced("generation", backend="llm")
+def generate_chat_response_stream(chat_session: ChatSession, message: Dict) -> Iterator[str]:
+    """
+    Stream a response as text chunks as they arrive from the model.
+    Takes the same arguments as generate_chat_response.
+    """
+    try:
+        model_input = build_model_input(message)
+        with rate_limited("gemini"), span("model.call"):
+            responses = generative_model.generate_content(
+                model_input,
+                generation_config=generation_config,
+                stream=True,
+            )
+            for response in responses:
+                if response.candidates and response.candidates[0].content.parts:
+                    yield response.text
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to generate response: {str(e)}"
+        )
+
+@uses_quotas(preprocess_quotas)
+def preprocess_image(image: ChatImage) -> None:
+    """
+    Run the image steps of a chat message ahead of time (POST /images), so the
+    message that uses the image finds their results cached or in flight.
+    """
+    image.normalized("llm")
+    describe_image(image, description_model, DESCRIPTION_VERSION, generation_config)
+
 def rebuild_chat_session(chat_history: List[Dict]) -> ChatSession:
-    """Rebuild a chat session with complete context"""
-    new_session = create_chat_session()
-    
-    for message in chat_history:
-        if message["role"] == "user":
-            generate_chat_response(new_session, message)
-        # 
-        #     response = new_session.send_message(
-        #         message["content"],
-        #         generation_config=generation_config
-        #     )
-    
-    return new_session
\ No newline at end of file
+    """Rebuild a chat session from the stored history without calling the model"""
+    return generative_model.start_chat(history=build_chat_history(chat_history))
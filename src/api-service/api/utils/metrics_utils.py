@@ -0,0 +1,127 @@
+import bisect
+import threading
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets, from a cached lookup to a
+# long LLaMA generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class Histogram:
+    def __init__(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """Fixed-bucket histogram (cumulative counts, like Prometheus) with quantile estimates"""
+        self.name = name
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # One count per bucket plus the overflow (+Inf) bucket
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def _quantile(self, q: float) -> Optional[float]:
+        if not self._count:
+            return None
+        rank = q * self._count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self._max
+                # Interpolate linearly inside the bucket
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self._max
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+                cumulative += count
+                buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            return {
+                "count": self._count,
+                "sum": self._sum,
+                "max": self._max,
+                "p50": self._quantile(0.5),
+                "p95": self._quantile(0.95),
+                "p99": self._quantile(0.99),
+                "buckets": buckets,
+            }
+
+
+# Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_PREFIX = "api_"
+
+
+def _label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{_label_value(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        """Histograms by metric name and labels, rendered in the Prometheus text format"""
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], Histogram]] = {}
+        self._help: Dict[str, str] = {}
+
+    def histogram(self, name: str, help: str = "", **labels: str) -> Histogram:
+        """Get (or create) the histogram of a metric for a set of labels"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(name)
+                if help:
+                    self._help.setdefault(name, help)
+            return histogram
+
+    def register(self, name: str, histogram: Histogram, help: str = "", **labels: str) -> Histogram:
+        """Export an existing histogram (the latest one registered for the labels wins)"""
+        with self._lock:
+            self._histograms.setdefault(name, {})[tuple(sorted(labels.items()))] = histogram
+            if help:
+                self._help.setdefault(name, help)
+        return histogram
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted((name, sorted(series.items())) for name, series in self._histograms.items())
+            help_texts = dict(self._help)
+        lines = []
+        for name, series in metrics:
+            metric = self.prefix + name
+            if name in help_texts:
+                lines.append(f"# HELP {metric} {help_texts[name]}")
+            lines.append(f"# TYPE {metric} histogram")
+            for labels, histogram in series:
+                snapshot = histogram.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    bucket_labels = _format_labels(labels, 'le="%s"' % bound)
+                    lines.append(f"{metric}_bucket{bucket_labels} {count}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {snapshot['sum']}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {snapshot['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry served by /metrics
+registry = MetricsRegistry()
@@ -0,0 +1,313 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+
+# Profiling is opt-in: unless enabled, no middleware or admin endpoints are installed
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+# Fraction of requests profiled without being asked to (X-Profile: 1 asks)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0))
+# Seconds between stack samples of a profiled request's threads
+PROFILE_INTERVAL_SECONDS = float(os.environ.get("PROFILE_INTERVAL_SECONDS", 0.002))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Oldest profiles are deleted beyond this many
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 50))
+# When set, X-Profile-Token must carry it to request a profile. The admin endpoints
+# always require it (they refuse every request while it is not set).
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+
+PROFILE_HEADER = "x-profile"
+PROFILE_TOKEN_HEADER = "x-profile-token"
+PROFILE_EXTENSION = ".speedscope.json"
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class RequestProfile:
+    def __init__(self, profile_id: str, name: str):
+        """
+        Statistical profile of one request: the stacks of the backend worker threads
+        running the request's calls, and of the event loop thread while it runs the
+        request's coroutines (the loop is shared with concurrent requests, whose
+        samples are left out), sampled periodically.
+        """
+        self.profile_id = profile_id
+        self.name = name
+        self._lock = threading.Lock()
+        # Thread id -> [thread name, number of calls of the request it is running]
+        self._threads: Dict[int, List[Any]] = {}
+        # The event loop running the request, its thread and the request's outermost frame
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._loop_thread_name = ""
+        self._root_frame: Any = None
+        self._frames: List[Dict[str, Any]] = []
+        self._frame_index: Dict[Tuple[str, str, int], int] = {}
+        # Thread name -> (samples, weights)
+        self._samples: Dict[str, Tuple[List[List[int]], List[float]]] = {}
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self._last_sample = self.start
+
+    def add_thread(self) -> None:
+        """Sample the calling thread until the matching remove_thread"""
+        ident = threading.get_ident()
+        with self._lock:
+            entry = self._threads.setdefault(ident, [threading.current_thread().name, 0])
+            entry[1] += 1
+
+    def remove_thread(self) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            entry = self._threads.get(ident)
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._threads[ident]
+
+    def add_event_loop(self, root_frame: Any) -> None:
+        """Sample the running event loop while it runs this request (root_frame is the request's outermost frame)"""
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            self._loop_thread_name = threading.current_thread().name
+            self._root_frame = root_frame
+
+    def remove_event_loop(self) -> None:
+        with self._lock:
+            self._loop = None
+            self._loop_thread = None
+            self._root_frame = None
+
+    def _runs_request(self, frame: Any) -> bool:
+        """Whether the event loop, whose current frame is given, is running this request"""
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            return False
+        if task is None:
+            return False
+        get_context = getattr(task, "get_context", None)
+        if get_context is not None:
+            # Python 3.12+: tasks the request started (e.g. to stream the response)
+            # inherit its context
+            return get_context().get(_current_profile) is self
+        # The request's own task: its outermost frame is on the stack
+        while frame is not None:
+            if frame is self._root_frame:
+                return True
+            frame = frame.f_back
+        return False
+
+    def _frame(self, frame: Any) -> int:
+        code = frame.f_code
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        index = self._frame_index.get(key)
+        if index is None:
+            index = self._frame_index[key] = len(self._frames)
+            self._frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+        return index
+
+    def _record(self, thread_name: str, frame: Any, weight: float) -> None:
+        stack = []
+        while frame is not None:
+            stack.append(self._frame(frame))
+            frame = frame.f_back
+        stack.reverse()
+        samples, weights = self._samples.setdefault(thread_name, ([], []))
+        samples.append(stack)
+        weights.append(weight)
+
+    def sample(self, frames: Dict[int, Any], now: float) -> None:
+        """Record the current stack of each of the request's threads"""
+        with self._lock:
+            weight = now - self._last_sample
+            self._last_sample = now
+            for ident, (thread_name, _) in self._threads.items():
+                self._record(thread_name, frames.get(ident), weight)
+            if self._loop_thread is not None:
+                frame = frames.get(self._loop_thread)
+                if frame is not None and self._runs_request(frame):
+                    self._record(self._loop_thread_name, frame, weight)
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+
+    def to_speedscope(self) -> Dict[str, Any]:
+        """The profile in the speedscope file format (https://www.speedscope.app)"""
+        with self._lock:
+            profiles = [
+                {
+                    "type": "sampled",
+                    "name": thread_name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+                for thread_name, (samples, weights) in self._samples.items()
+            ]
+            return {
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "name": self.name,
+                "exporter": "api-service",
+                "activeProfileIndex": 0,
+                "shared": {"frames": list(self._frames)},
+                "profiles": profiles,
+            }
+
+
+class Sampler:
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS):
+        """Background thread sampling the stacks of every active request profile"""
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profiles: List[RequestProfile] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._profiles.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: RequestProfile) -> None:
+        with self._lock:
+            if profile in self._profiles:
+                self._profiles.remove(profile)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                profiles = list(self._profiles)
+                if not profiles:
+                    # Stops when no request is profiled
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            for profile in profiles:
+                profile.sample(frames, now)
+            del frames
+            time.sleep(self.interval)
+
+
+_current_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("current_profile", default=None)
+sampler = Sampler()
+
+
+def current_profile() -> Optional[RequestProfile]:
+    """Profile of the current request, if it is profiled (backend workers join it)"""
+    return _current_profile.get()
+
+
+def profile_path(profile_id: str) -> str:
+    return os.path.join(PROFILE_DIR, profile_id + PROFILE_EXTENSION)
+
+
+def save_profile(profile: RequestProfile) -> str:
+    """Write a profile and delete the oldest ones beyond PROFILE_MAX_FILES"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profile_path(profile.profile_id)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(profile.to_speedscope(), f)
+    profiles = list_profiles()
+    for stale in profiles[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(profile_path(stale["profile_id"]))
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Saved profiles, newest first"""
+    profiles = []
+    if not os.path.isdir(PROFILE_DIR):
+        return profiles
+    for filename in os.listdir(PROFILE_DIR):
+        if not filename.endswith(PROFILE_EXTENSION):
+            continue
+        path = os.path.join(PROFILE_DIR, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        profiles.append({
+            "profile_id": filename[:-len(PROFILE_EXTENSION)],
+            "size": stat.st_size,
+            "created": stat.st_mtime,
+        })
+    profiles.sort(key=lambda profile: profile["created"], reverse=True)
+    return profiles
+
+
+def check_profile_token(token: Optional[str]) -> None:
+    """Raise 403 unless PROFILE_TOKEN is set and the admin token matches it"""
+    if not PROFILE_TOKEN:
+        raise HTTPException(status_code=403, detail="Profile endpoints are disabled until PROFILE_TOKEN is set")
+    if token != PROFILE_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+
+def _header(scope: Dict, name: str) -> Optional[str]:
+    encoded = name.encode("latin-1")
+    for key, value in scope["headers"]:
+        if key == encoded:
+            return value.decode("latin-1")
+    return None
+
+
+def should_profile(scope: Dict) -> bool:
+    """Whether a request asked to be profiled (X-Profile: 1) or is sampled"""
+    if _header(scope, PROFILE_HEADER) == "1":
+        return not PROFILE_TOKEN or _header(scope, PROFILE_TOKEN_HEADER) == PROFILE_TOKEN
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: Any):
+        """
+        ASGI middleware profiling requests that ask for it (or are sampled). The
+        profile is saved as a speedscope file whose id is returned in the X-Profile-Id
+        response header. Only installed when PROFILING_ENABLED.
+        """
+        self.app = app
+
+    async def __call__(self, scope: Dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"].strip("/").replace("/", "_") or "root"
+        profile_id = f"{int(time.time() * 1000)}-{scope['method'].lower()}-{re.sub(r'[^A-Za-z0-9_-]', '', path)[:64]}-{random.getrandbits(32):08x}"
+        profile = RequestProfile(profile_id, f"{scope['method']} {scope['path']}")
+
+        async def send_with_profile_id(message: Dict) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode("latin-1"))]
+            await send(message)
+
+        token = _current_profile.set(profile)
+        # The event loop thread runs the request's coroutines, between those of other requests
+        profile.add_event_loop(sys._getframe())
+        sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            sampler.remove(profile)
+            profile.remove_event_loop()
+            profile.finish()
+            _current_profile.reset(token)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, save_profile, profile)
+            except OSError as e:
+                print(f"Saving profile {profile_id} failed: {str(e)}")
@@ -0,0 +1,319 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+from fastapi import HTTPException
+from api.utils.metrics_utils import Histogram, registry
+
+# Upstream quotas the API schedules calls against, in requests per minute, with the
+# number of calls allowed in a burst. Overridable with <NAME>_RPM and <NAME>_BURST
+# environment variables (e.g. GEMINI_RPM=300); an RPM of 0 disables the limit.
+#   gemini: generate_content / send_message (chat, RAG and image descriptions)
+#   embedding: text-embedding-004 (RAG queries and the response cache)
+#   modal: the LLaMA endpoints
+RATE_LIMITS = {
+    "gemini": {"rpm": 200, "burst": 10},
+    "embedding": {"rpm": 600, "burst": 20},
+    "modal": {"rpm": 120, "burst": 4},
+}
+# Calls wait at most this long for quota, and at most this many wait at once;
+# beyond that they are rejected with 503 and Retry-After
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_WAIT_SECONDS", 10))
+RATE_LIMIT_MAX_QUEUE = int(os.environ.get("RATE_LIMIT_MAX_QUEUE", 64))
+# Quota withheld after the upstream answers 429, so a burst does not keep hitting it
+RATE_LIMIT_COOLDOWN_SECONDS = float(os.environ.get("RATE_LIMIT_COOLDOWN_SECONDS", 2))
+# Blocking calls that were not admitted before taking a worker thread wait at most this
+# long in the thread (a sleeping waiter holds a slot of the backend pool)
+RATE_LIMIT_MAX_THREAD_WAIT_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_THREAD_WAIT_SECONDS", 0.5))
+
+
+def is_quota_error(error: BaseException) -> bool:
+    """Whether an upstream error means the quota is exhausted (HTTP 429 / RESOURCE_EXHAUSTED)"""
+    if isinstance(error, HTTPException):
+        return error.status_code == 429
+    # google.api_core.exceptions.ResourceExhausted has code 429
+    return getattr(error, "code", None) == 429 or type(error).__name__ == "ResourceExhausted"
+
+
+class RateLimitExceeded(HTTPException):
+    def __init__(self, backend: str, retry_after: float):
+        seconds = max(1, int(retry_after + 0.999))
+        super().__init__(
+            status_code=503,
+            detail=f"{backend} is at its request quota, retry in {seconds}s",
+            headers={"Retry-After": str(seconds)},
+        )
+
+
+class BackendRateLimiter:
+    def __init__(
+        self,
+        name: str,
+        rpm: float,
+        burst: int,
+        max_wait_seconds: float = RATE_LIMIT_MAX_WAIT_SECONDS,
+        max_queue: int = RATE_LIMIT_MAX_QUEUE,
+        cooldown_seconds: float = RATE_LIMIT_COOLDOWN_SECONDS,
+        max_thread_wait_seconds: float = RATE_LIMIT_MAX_THREAD_WAIT_SECONDS,
+    ):
+        """
+        Token bucket admission control for an upstream quota. Each call reserves a
+        token; calls that find the bucket empty wait their turn (first come, first
+        served) in a bounded queue, and are rejected up front if the queue is full
+        or their wait would exceed max_wait_seconds (max_thread_wait_seconds for
+        blocking calls waiting in a worker thread).
+        """
+        self.name = name
+        self.rate = rpm / 60.0
+        self.burst = max(1, burst)
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue = max_queue
+        self.cooldown_seconds = cooldown_seconds
+        self.max_thread_wait_seconds = max_thread_wait_seconds
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiting = 0
+        self._max_waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._throttled = 0
+        self.wait_time = Histogram(f"{name}_quota_wait_seconds")
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, max_wait_seconds: Optional[float] = None, tokens: int = 1) -> float:
+        """
+        Reserve tokens.
+
+        Args:
+            max_wait_seconds: Overrides max_wait_seconds
+            tokens: Number of upstream calls to reserve quota for
+
+        Returns:
+            float: Seconds to wait before calling the upstream
+
+        Raises:
+            RateLimitExceeded: The queue is full or the wait would be too long
+        """
+        if not self.enabled:
+            return 0.0
+        max_wait_seconds = self.max_wait_seconds if max_wait_seconds is None else max_wait_seconds
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0.0 if self._tokens >= tokens else (tokens - self._tokens) / self.rate
+            if wait > 0 and (wait > max_wait_seconds or self._waiting >= self.max_queue):
+                self._rejected += 1
+                raise RateLimitExceeded(self.name, wait)
+            # Tokens may go negative: later callers queue behind this reservation
+            self._tokens -= tokens
+            self._admitted += 1
+            if wait > 0:
+                self._waiting += 1
+                self._max_waiting = max(self._max_waiting, self._waiting)
+        self.wait_time.observe(wait)
+        return wait
+
+    def _done_waiting(self) -> None:
+        with self._lock:
+            self._waiting -= 1
+
+    def refund(self, tokens: int = 1) -> None:
+        """Give back reserved tokens that were not used"""
+        with self._lock:
+            if self.enabled:
+                self._refill(time.monotonic())
+                self._tokens = min(self.burst, self._tokens + tokens)
+
+    def acquire(self) -> None:
+        """
+        Wait for quota in a worker thread (blocking Vertex AI calls). Uses the token
+        admitted for the request on the event loop if there is one; otherwise waits
+        at most max_thread_wait_seconds, so waiters do not use up the backend pool.
+        """
+        prepaid = _prepaid_tokens.get()
+        if prepaid and prepaid.get(self.name):
+            prepaid[self.name] -= 1
+            return
+        wait = self.reserve(min(self.max_wait_seconds, self.max_thread_wait_seconds))
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._done_waiting()
+
+    async def acquire_async(self, tokens: int = 1) -> None:
+        """Wait for quota on the event loop (async HTTP calls, or tokens admitted for blocking calls)"""
+        wait = self.reserve(tokens=tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._done_waiting()
+
+    def record_throttled(self) -> None:
+        """The upstream rejected a call for quota: withhold tokens for the cooldown"""
+        with self._lock:
+            self._throttled += 1
+            if self.enabled:
+                self._refill(time.monotonic())
+                self._tokens = min(self._tokens, 0.0) - self.rate * self.cooldown_seconds
+
+    def _upstream_error(self, error: BaseException) -> Optional[HTTPException]:
+        if not is_quota_error(error):
+            return None
+        self.record_throttled()
+        print(f"{self.name} quota exhausted upstream: {str(error)}")
+        return RateLimitExceeded(self.name, self.cooldown_seconds)
+
+    @contextmanager
+    def limit(self) -> Iterator[None]:
+        """Admit a blocking upstream call, turning upstream 429s into 503 with Retry-After"""
+        self.acquire()
+        try:
+            yield
+        except Exception as e:
+            error = self._upstream_error(e)
+            if error is None:
+                raise
+            raise error from e
+
+    @asynccontextmanager
+    async def limit_async(self) -> AsyncIterator[None]:
+        """Admit an async upstream call, turning upstream 429s into 503 with Retry-After"""
+        await self.acquire_async()
+        try:
+            yield
+        except Exception as e:
+            error = self._upstream_error(e)
+            if error is None:
+                raise
+            raise error from e
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            stats = {
+                "rpm": self.rate * 60,
+                "burst": self.burst,
+                "tokens": self._tokens,
+                "queue_depth": self._waiting,
+                "max_queue_depth": self._max_waiting,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "upstream_throttled": self._throttled,
+            }
+        stats["wait_seconds"] = self.wait_time.snapshot()
+        return stats
+
+
+_limiters: Dict[str, BackendRateLimiter] = {}
+_limiters_lock = threading.Lock()
+# Quota -> tokens admitted for the current request and not used yet
+_prepaid_tokens: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar("prepaid_tokens", default=None)
+
+
+def get_rate_limiter(name: str) -> BackendRateLimiter:
+    """Get (or lazily create) the rate limiter of an upstream quota"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            defaults = RATE_LIMITS.get(name, {"rpm": 0, "burst": 1})
+            env_name = name.upper().replace("-", "_")
+            limiter = BackendRateLimiter(
+                name,
+                rpm=float(os.environ.get(f"{env_name}_RPM", defaults["rpm"])),
+                burst=int(os.environ.get(f"{env_name}_BURST", defaults["burst"])),
+            )
+            registry.register("quota_wait_seconds", limiter.wait_time, "Time calls waited for upstream quota", quota=name)
+            _limiters[name] = limiter
+        return limiter
+
+
+def rate_limited(name: str):
+    """Context manager admitting a blocking call against an upstream quota"""
+    return get_rate_limiter(name).limit()
+
+
+def rate_limited_async(name: str):
+    """Async context manager admitting a call against an upstream quota"""
+    return get_rate_limiter(name).limit_async()
+
+
+def uses_quotas(usage: Callable[..., Dict[str, int]]) -> Callable:
+    """
+    Decorator declaring the upstream calls a blocking backend function makes, as a
+    function of its arguments returning quota -> tokens. run_fairly and stream_fairly
+    admit them on the event loop before the call takes a worker thread.
+    """
+    def decorator(func: Callable) -> Callable:
+        func.quota_usage = usage
+        return func
+    return decorator
+
+
+def quota_usage(func: Callable, *args, **kwargs) -> Dict[str, int]:
+    """The quota tokens a call of func with these arguments uses (see uses_quotas)"""
+    usage = getattr(func, "quota_usage", None)
+    return usage(*args, **kwargs) if usage is not None else {}
+
+
+@asynccontextmanager
+async def admitted(quotas: Optional[Dict[str, int]]) -> AsyncIterator[None]:
+    """
+    Wait for tokens of upstream quotas on the event loop, before a blocking call
+    takes a worker thread. The call's rate_limited blocks in the worker (which gets
+    a copy of the request context) use these tokens instead of waiting in the thread.
+    Tokens the call did not use are given back.
+
+    Args:
+        quotas: Quota -> tokens (e.g. quota_usage(func, *args)), None admits nothing
+    """
+    reserved: Dict[str, int] = {}
+    try:
+        for name, tokens in (quotas or {}).items():
+            limiter = get_rate_limiter(name)
+            if tokens <= 0 or not limiter.enabled:
+                continue
+            await limiter.acquire_async(tokens)
+            reserved[name] = tokens
+    except BaseException:
+        # Rejected (or cancelled) waiting for a later quota
+        for name, tokens in reserved.items():
+            get_rate_limiter(name).refund(tokens)
+        raise
+    if not reserved:
+        yield
+        return
+    prepaid = dict(_prepaid_tokens.get() or {})
+    for name, tokens in reserved.items():
+        prepaid[name] = prepaid.get(name, 0) + tokens
+    token = _prepaid_tokens.set(prepaid)
+    try:
+        yield
+    finally:
+        try:
+            _prepaid_tokens.reset(token)
+        except ValueError:
+            # Finished in another context (e.g. a stream closed elsewhere)
+            pass
+        for name, tokens in reserved.items():
+            # Tokens already prepaid by an enclosing admission are not this call's to give back
+            unused = min(tokens, prepaid[name])
+            if unused > 0:
+                get_rate_limiter(name).refund(unused)
+
+
+def rate_limit_stats() -> Dict[str, Dict[str, Any]]:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
@@ -0,0 +1,79 @@
+import os
+from typing import Dict
+from fastapi import HTTPException, Request
+from api.utils.image_utils import ChatImage
+from api.utils.session_utils import SessionCache
+from api.utils.tracing_utils import traced
+
+# Images uploaded ahead of their chat message (POST /images), by handle
+UPLOAD_CACHE_MAX_ENTRIES = int(os.environ.get("UPLOAD_CACHE_MAX_ENTRIES", 500))
+UPLOAD_CACHE_MAX_BYTES = int(os.environ.get("UPLOAD_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+UPLOAD_CACHE_TTL_SECONDS = float(os.environ.get("UPLOAD_CACHE_TTL_SECONDS", 30 * 60))
+
+uploaded_images = SessionCache(
+    max_entries=UPLOAD_CACHE_MAX_ENTRIES,
+    max_bytes=UPLOAD_CACHE_MAX_BYTES,
+    ttl_seconds=UPLOAD_CACHE_TTL_SECONDS,
+    size_fn=len,
+)
+
+
+def register_upload(image: ChatImage) -> str:
+    """Keep an uploaded image until its chat message arrives, returns its handle"""
+    uploaded_images.put(image.digest, image)
+    return image.digest
+
+
+def resolve_image_handle(handle: str) -> ChatImage:
+    """The image uploaded with POST /images for a handle"""
+    image = uploaded_images.get(handle)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image handle not found or expired, upload the image again")
+    return image
+
+
+@traced("upload.decode")
+async def read_chat_message(request: Request) -> Dict:
+    """
+    Read a chat message from either a JSON body ({"content": ..., "image": <base64>})
+    or a multipart/form-data body with a 'content' field and a binary 'image' file.
+    Either way the image is decoded exactly once into a ChatImage. Instead of the
+    image, either body may carry the 'image_handle' returned by POST /images.
+
+    Args:
+        request: The incoming request
+
+    Returns:
+        Dict: The message with 'content' and optionally 'image' (ChatImage)
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        form = await request.form()
+        message = {"content": form.get("content") or ""}
+        upload = form.get("image")
+        if upload is not None and hasattr(upload, "read"):
+            data = await upload.read()
+            await upload.close()
+            if data:
+                message["image"] = ChatImage(data, upload.content_type)
+        if form.get("image_handle"):
+            message["image_handle"] = form.get("image_handle")
+        return _resolve_message_image(message)
+
+    try:
+        message = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(message, dict):
+        raise HTTPException(status_code=400, detail="Message must be a JSON object")
+    message.setdefault("content", "")
+    if message.get("image"):
+        message["image"] = ChatImage.from_data_url(message["image"])
+    return _resolve_message_image(message)
+
+
+def _resolve_message_image(message: Dict) -> Dict:
+    handle = message.pop("image_handle", None)
+    if handle and not message.get("image"):
+        message["image"] = resolve_image_handle(handle)
+    return message
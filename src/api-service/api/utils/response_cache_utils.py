@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+import numpy as np
+from api.utils.session_utils import SessionCache
+from api.utils.image_utils import ChatImage
+from api.utils.embedding_utils import embed_text, normalize_text
+from api.utils.fair_queue_utils import run_fairly
+from api.utils.singleflight_utils import AsyncInFlightCalls
+
+# First-turn responses are cached per (backend, image digest, normalized prompt)
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 2000))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 24 * 60 * 60))
+# Reuse the answer to a different prompt about the same image when the prompt
+# embeddings are at least this similar (cosine). 0 disables the semantic tier.
+RESPONSE_CACHE_SEMANTIC_THRESHOLD = float(os.environ.get("RESPONSE_CACHE_SEMANTIC_THRESHOLD", 0))
+RESPONSE_CACHE_SEMANTIC_BUCKET_SIZE = int(os.environ.get("RESPONSE_CACHE_SEMANTIC_BUCKET_SIZE", 64))
+
+# Rough cost of one uncached first turn in USD, used to report savings: two Gemini
+# calls (description + instructions) or a Gemini call plus a Modal H100 generation
+RESPONSE_COST_PER_CALL = {
+    "llm": float(os.environ.get("RESPONSE_COST_LLM", 0.0005)),
+    "llm-rag": float(os.environ.get("RESPONSE_COST_LLM_RAG", 0.0005)),
+    "llm-llama": float(os.environ.get("RESPONSE_COST_LLM_LLAMA", 0.025)),
+}
+
+# Fixed memory cost of an entry besides the response text
+BASE_ENTRY_BYTES = 256
+
+
+def _message_image_digest(message: Dict) -> str:
+    if not message.get("image"):
+        return ""
+    return ChatImage.coerce(message["image"]).digest
+
+
+def response_cache_key(backend: str, message: Dict) -> Tuple[str, str, str]:
+    """(backend, image digest, normalized prompt) of a first-turn message"""
+    return backend, _message_image_digest(message), normalize_text(message.get("content") or "")
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+        semantic_threshold: float = RESPONSE_CACHE_SEMANTIC_THRESHOLD,
+        embed_fn: Callable[[str], List[float]] = embed_text,
+        cost_per_call: Dict[str, float] = RESPONSE_COST_PER_CALL,
+    ):
+        """
+        Cache for first-turn responses. Exact hits match the backend, the image
+        content hash and the normalized prompt. With a semantic threshold set, a
+        prompt about the same image whose embedding is close enough to a cached
+        prompt reuses that answer too.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.semantic_threshold = semantic_threshold
+        self.cost_per_call = cost_per_call
+        self._embed_fn = embed_fn
+        self._entries = SessionCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl_seconds=ttl_seconds,
+            size_fn=lambda entry: BASE_ENTRY_BYTES + len(entry["response"].encode("utf-8")),
+        )
+        self._lock = threading.Lock()
+        # (backend, image digest) -> OrderedDict of cache key -> unit prompt vector
+        self._semantic: Dict[Tuple[str, str], "OrderedDict[Hashable, np.ndarray]"] = {}
+        self._exact_hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._saved_seconds = 0.0
+        self._saved_cost = 0.0
+
+    @property
+    def semantic_enabled(self) -> bool:
+        return self.semantic_threshold > 0
+
+    def _get_entry(self, key: Hashable) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry["created"] > self.ttl_seconds:
+            self._entries.pop(key)
+            return None
+        return entry
+
+    def _prompt_vector(self, prompt: str) -> Optional[np.ndarray]:
+        try:
+            vector = np.asarray(self._embed_fn(prompt), dtype=np.float32)
+        except Exception as e:
+            # The cache is an optimization, never fail the request because of it
+            print(f"Response cache prompt embedding failed: {str(e)}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _nearest(self, bucket_key: Tuple[str, str], vector: np.ndarray) -> Tuple[Optional[Hashable], float]:
+        with self._lock:
+            bucket = self._semantic.get(bucket_key)
+            if not bucket:
+                return None, 0.0
+            keys = list(bucket.keys())
+            similarities = np.stack(list(bucket.values())) @ vector
+        best = int(np.argmax(similarities))
+        return keys[best], float(similarities[best])
+
+    def _record_hit(self, backend: str, entry: Dict, semantic: bool) -> None:
+        with self._lock:
+            if semantic:
+                self._semantic_hits += 1
+            else:
+                self._exact_hits += 1
+            self._saved_seconds += entry["latency"]
+            self._saved_cost += self.cost_per_call.get(backend, 0.0)
+
+    def lookup(self, backend: str, message: Dict) -> Optional[str]:
+        """
+        Find a cached response for a first-turn message.
+
+        Args:
+            backend: The chat backend (router model name)
+            message: Dict containing 'content' and optionally 'image'
+
+        Returns:
+            Optional[str]: The cached response, or None on a miss
+        """
+        key = response_cache_key(backend, message)
+        entry = self._get_entry(key)
+        if entry is not None:
+            self._record_hit(backend, entry, semantic=False)
+            return entry["response"]
+
+        if self.semantic_enabled and key[2]:
+            vector = self._prompt_vector(key[2])
+            if vector is not None:
+                nearest_key, similarity = self._nearest(key[:2], vector)
+                if nearest_key is not None and similarity >= self.semantic_threshold:
+                    entry = self._get_entry(nearest_key)
+                    if entry is not None:
+                        print(f"Semantic response cache hit ({similarity:.3f}): {key[2]!r} ~ {nearest_key[2]!r}")
+                        self._record_hit(backend, entry, semantic=True)
+                        return entry["response"]
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def store(self, backend: str, message: Dict, response: str, latency: float) -> None:
+        """
+        Cache the response generated for a first-turn message.
+
+        Args:
+            backend: The chat backend (router model name)
+            message: Dict containing 'content' and optionally 'image'
+            response: The generated response
+            latency: Seconds it took to generate (reported as saved on hits)
+        """
+        if not response:
+            return
+        key = response_cache_key(backend, message)
+        self._entries.put(key, {"response": response, "latency": latency, "created": time.time()})
+        with self._lock:
+            self._stores += 1
+
+        if self.semantic_enabled and key[2]:
+            vector = self._prompt_vector(key[2])
+            if vector is None:
+                return
+            with self._lock:
+                bucket = self._semantic.setdefault(key[:2], OrderedDict())
+                bucket[key] = vector
+                bucket.move_to_end(key)
+                # Drop prompts whose responses were evicted, then the oldest ones
+                for stale_key in [k for k in bucket if k not in self._entries]:
+                    del bucket[stale_key]
+                while len(bucket) > RESPONSE_CACHE_SEMANTIC_BUCKET_SIZE:
+                    bucket.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self._exact_hits + self._semantic_hits
+            lookups = hits + self._misses
+            return {
+                "enabled": RESPONSE_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "stores": self._stores,
+                "exact_hits": self._exact_hits,
+                "semantic_hits": self._semantic_hits,
+                "misses": self._misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "semantic_threshold": self.semantic_threshold,
+                "saved_seconds": self._saved_seconds,
+                "saved_cost_usd": self._saved_cost,
+            }
+
+
+# Shared by all chat routers, keys include the backend
+response_cache = ResponseCache()
+
+
+def lookup_first_turn(backend: str, message: Dict) -> Optional[str]:
+    """Cached response for the first message of a chat (None if disabled or a miss)"""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    return response_cache.lookup(backend, message)
+
+
+def store_first_turn(backend: str, message: Dict, response: str, latency: float) -> None:
+    """Cache the response to the first message of a chat"""
+    if RESPONSE_CACHE_ENABLED:
+        response_cache.store(backend, message, response, latency)
+
+
+# Identical chat requests in flight at the same time (frontend retries, double
+# clicks) share one generation
+GENERATION_COALESCING_ENABLED = os.environ.get("GENERATION_COALESCING_ENABLED", "1") == "1"
+_generating = AsyncInFlightCalls()
+
+
+def history_fingerprint(chat_history: List[Dict]) -> str:
+    """Hash of the chat messages a turn is generated after ("" for a new chat)"""
+    if not chat_history:
+        return ""
+    turns = [
+        [message.get("message_id"), message.get("role"), message.get("content"), message.get("image_path")]
+        for message in chat_history
+    ]
+    return hashlib.sha256(json.dumps(turns).encode("utf-8")).hexdigest()
+
+
+async def generate_once(
+    backend: str,
+    func: Callable,
+    chat_session: Any,
+    message: Dict,
+    chat_history: List[Dict],
+    session_id: Optional[str] = None,
+) -> Tuple[str, bool]:
+    """
+    Generate the reply to a message, sharing the upstream call with identical
+    requests (same backend, image, normalized prompt and history) already in flight.
+    The generation waits for the session's turn in the backend's fair queue.
+
+    Args:
+        backend: The chat backend (router model name)
+        func: The backend's generate_chat_response
+        chat_session: The chat session to generate in
+        message: Dict containing 'content' and optionally 'image'
+        chat_history: The chat's messages before this one
+        session_id: The requesting session (X-Session-ID)
+
+    Returns:
+        Tuple[str, bool]: The reply, and whether it was generated by another request
+        (whose chat session, not this one, holds the new turn)
+    """
+    if not GENERATION_COALESCING_ENABLED:
+        return await run_fairly(backend, session_id, func, chat_session, message), False
+    key = response_cache_key(backend, message) + (history_fingerprint(chat_history),)
+    response, joined = await _generating.run(key, run_fairly, backend, session_id, func, chat_session, message)
+    if joined:
+        print(f"Collapsed identical {backend} generation into the one in flight")
+    return response, joined
+
+
+def generation_stats() -> Dict[str, Any]:
+    stats = _generating.stats()
+    return {
+        "enabled": GENERATION_COALESCING_ENABLED,
+        "in_flight": stats["in_flight"],
+        "upstream_calls": stats["calls"],
+        "collapsed": stats["joined"],
+    }
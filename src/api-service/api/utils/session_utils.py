@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# Limits for the in-memory chat session cache. Sessions that are evicted are
+# rebuilt from the stored chat history on the next message.
+SESSION_CACHE_MAX_ENTRIES = int(os.environ.get("SESSION_CACHE_MAX_ENTRIES", 1000))
+SESSION_CACHE_MAX_BYTES = int(os.environ.get("SESSION_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get("SESSION_CACHE_TTL_SECONDS", 60 * 60))
+
+# Rough fixed cost of a session object without any history
+BASE_SESSION_BYTES = 2048
+
+
+def _proto_size(obj: Any) -> Optional[int]:
+    """Serialized size of a proto-plus message wrapped by a Vertex AI object"""
+    for attr in ("_raw_content", "_raw_part"):
+        raw = getattr(obj, attr, None)
+        if raw is not None:
+            try:
+                return type(raw).pb(raw).ByteSize()
+            except Exception:
+                return None
+    return None
+
+
+def estimate_session_size(session: Any) -> int:
+    """
+    Approximate the memory held by a chat session.
+
+    Vertex AI sessions keep every turn (including inline image bytes) in their
+    history, so the size is dominated by the serialized history contents.
+    """
+    size = BASE_SESSION_BYTES
+    try:
+        history = getattr(session, "history", None) or []
+    except Exception:
+        history = []
+    for content in history:
+        content_size = _proto_size(content)
+        if content_size is None:
+            content_size = len(str(content))
+        size += content_size
+    return size
+
+
+class SessionCache:
+    def __init__(
+        self,
+        max_entries: int = SESSION_CACHE_MAX_ENTRIES,
+        max_bytes: int = SESSION_CACHE_MAX_BYTES,
+        ttl_seconds: float = SESSION_CACHE_TTL_SECONDS,
+        size_fn: Callable[[Any], int] = estimate_session_size,
+    ):
+        """
+        Bounded LRU cache for chat sessions with an idle TTL.
+
+        Entries are evicted least recently used first once either the entry limit or
+        the approximate byte budget is exceeded, and expire after ttl_seconds idle.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._size_fn = size_fn
+        self._lock = threading.Lock()
+        # key -> (session, size, last_access)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _expire(self, now: float) -> None:
+        # Entries are ordered by last access, so expired ones are at the front
+        while self._entries:
+            key, (_, _, last_access) = next(iter(self._entries.items()))
+            if now - last_access < self.ttl_seconds:
+                break
+            self._remove(key)
+            self._expirations += 1
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self._evictions += 1
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a session, refreshing its LRU position and idle timer"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+            session, size, _ = entry
+            self._entries[key] = (session, size, now)
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return session
+
+    def put(self, key: Hashable, session: Any) -> None:
+        """Add or refresh a session, re-measuring its size since history grows each turn"""
+        size = self._size_fn(session)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (session, size, now)
+            self._bytes += size
+            self._expire(now)
+            self._evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return default
+            session = self._entries[key][0]
+            self._remove(key)
+            return session
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __setitem__(self, key: Hashable, session: Any) -> None:
+        self.put(key, session)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+
+# Shared by all chat routers. Chat ids are uuid4 so keys never collide across models.
+chat_sessions = SessionCache()
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class InFlightCalls:
+    def __init__(self):
+        """
+        Deduplicates concurrent blocking calls by key: while a call is running, other
+        threads asking for the same key wait for its result instead of repeating it.
+        Finished results are not kept, callers cache them where they belong.
+        """
+        self._lock = threading.Lock()
+        self._futures: Dict[Hashable, Future] = {}
+        self._calls = 0
+        self._joined = 0
+
+    def run(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        """Run func(*args, **kwargs), or wait for the in-flight call with the same key"""
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._futures[key] = future
+                self._calls += 1
+            else:
+                self._joined += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    def in_flight(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._futures
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "in_flight": len(self._futures),
+                "calls": self._calls,
+                "joined": self._joined,
+            }
+
+
+class AsyncInFlightCalls:
+    def __init__(self):
+        """
+        Deduplicates concurrent coroutine calls by key on the event loop: requests
+        asking for a key that is already running await that call's result. The call
+        runs as its own task, so it finishes even if the request that started it is
+        cancelled (client disconnected) while others wait for it.
+        """
+        self._lock = threading.Lock()
+        self._tasks: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Task] = {}
+        self._calls = 0
+        self._joined = 0
+
+    def _forget(self, task_key: Tuple[asyncio.AbstractEventLoop, Hashable], task: asyncio.Task) -> None:
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+        if not task.cancelled():
+            # Mark the exception retrieved: if every waiter was cancelled, asyncio would log it
+            task.exception()
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        Await func(*args, **kwargs), or the in-flight call with the same key.
+
+        Returns:
+            Tuple[Any, bool]: The result, and whether it came from another caller's call
+        """
+        loop = asyncio.get_running_loop()
+        task_key = (loop, key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            joined = task is not None
+            if joined:
+                self._joined += 1
+            else:
+                task = loop.create_task(func(*args, **kwargs))
+                self._tasks[task_key] = task
+                self._calls += 1
+        if not joined:
+            task.add_done_callback(lambda done: self._forget(task_key, done))
+        return await asyncio.shield(task), joined
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "in_flight": len(self._tasks),
+                "calls": self._calls,
+                "joined": self._joined,
+            }
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+import traceback
+from typing import Any, Callable, Dict, List, Optional
+
+# Load the models and connections in the background once the server is listening
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+# Seconds between warmup attempts of a dependency that failed (e.g. Chroma down)
+WARMUP_RETRY_SECONDS = float(os.environ.get("WARMUP_RETRY_SECONDS", 10))
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class LazyResource:
+    def __init__(self, name: str, factory: Callable[[], Any], required: bool = True):
+        """
+        A model or client created on first use instead of at import. Attribute access
+        is forwarded to the created object, so it is used like the object itself. A
+        failed creation is retried on the next use.
+
+        Args:
+            name: Name reported by the readiness endpoint
+            factory: Creates the object
+            required: Whether the service is not ready until the object is created
+        """
+        self.name = name
+        self.required = required
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value: Any = None
+        self._state = PENDING
+        self._error: Optional[str] = None
+        self._load_seconds: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def ready(self) -> bool:
+        return self._state == READY
+
+    def get(self) -> Any:
+        """The object, created now if it does not exist yet"""
+        if self._state == READY:
+            return self._value
+        with self._lock:
+            if self._state != READY:
+                self._state = LOADING
+                start = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self._state = FAILED
+                    self._error = f"{type(e).__name__}: {str(e)}"
+                    raise
+                self._load_seconds = time.perf_counter() - start
+                self._error = None
+                self._state = READY
+                print(f"Initialized {self.name} in {self._load_seconds:.2f}s")
+        return self._value
+
+    def __getattr__(self, attr: str) -> Any:
+        # Only called for attributes LazyResource does not have itself
+        if attr.startswith("__") or attr in ("_factory", "_lock", "_value", "_state"):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self._state,
+            "required": self.required,
+            "load_seconds": self._load_seconds,
+            "error": self._error,
+        }
+
+
+_resources: Dict[str, LazyResource] = {}
+_resources_lock = threading.Lock()
+_warmup_thread: Optional[threading.Thread] = None
+
+
+def lazy_resource(name: str, factory: Callable[[], Any], required: bool = True) -> LazyResource:
+    """Register a dependency that is created on first use (or by the warmup)"""
+    resource = LazyResource(name, factory, required=required)
+    with _resources_lock:
+        _resources[name] = resource
+    return resource
+
+
+def get_resources() -> List[LazyResource]:
+    with _resources_lock:
+        return list(_resources.values())
+
+
+def warmup(retry_seconds: float = WARMUP_RETRY_SECONDS, stop: Optional[threading.Event] = None) -> None:
+    """
+    Create every registered dependency, retrying the ones that fail until they are
+    all ready (or stop is set).
+    """
+    stop = stop or threading.Event()
+    start = time.perf_counter()
+    while not stop.is_set():
+        pending = [resource for resource in get_resources() if not resource.ready]
+        for resource in pending:
+            try:
+                resource.get()
+            except Exception as e:
+                print(f"Warmup of {resource.name} failed: {str(e)}")
+                traceback.print_exc()
+        if all(resource.ready for resource in get_resources()):
+            print(f"Warmup finished in {time.perf_counter() - start:.2f}s")
+            return
+        stop.wait(retry_seconds)
+
+
+def start_warmup() -> threading.Thread:
+    """Run the warmup in a background thread (once), so the server listens right away"""
+    global _warmup_thread
+    with _resources_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+            _warmup_thread.start()
+        return _warmup_thread
+
+
+def readiness() -> Dict[str, Any]:
+    """Whether every required dependency is ready, with the state of each dependency"""
+    resources = get_resources()
+    return {
+        "ready": all(resource.ready for resource in resources if resource.required),
+        "dependencies": {resource.name: resource.status() for resource in resources},
+    }
@@ -0,0 +1,33 @@
+import json
+from typing import Any, Optional
+
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+
+# Disable caching and proxy buffering (nginx) so events reach the client immediately
+EVENT_STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def wants_event_stream(accept: Optional[str]) -> bool:
+    """Check whether the client asked for a server-sent event stream"""
+    return bool(accept) and EVENT_STREAM_MEDIA_TYPE in accept
+
+
+def sse_event(data: Any, event: Optional[str] = None) -> str:
+    """
+    Format a server-sent event.
+
+    Args:
+        data: JSON serializable payload of the event
+        event: Optional event name (the client default is 'message')
+
+    Returns:
+        str: The encoded event
+    """
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
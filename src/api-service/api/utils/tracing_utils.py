@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import random
+import threading
+import inspect
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+from api.utils.metrics_utils import registry
+
+# Finished spans are appended to this JSON lines file ("" disables the exporter;
+# the stage histograms are always recorded)
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+# Fraction of traces exported
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+TRACE_FLUSH_SECONDS = float(os.environ.get("TRACE_FLUSH_SECONDS", 1.0))
+TRACE_MAX_BUFFERED_SPANS = int(os.environ.get("TRACE_MAX_BUFFERED_SPANS", 10000))
+
+STAGE_METRIC = "stage_seconds"
+STAGE_METRIC_HELP = "Latency of each stage of a request, by stage and chat backend"
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "backend", "sampled", "attributes", "start", "duration", "error", "_started")
+
+    def __init__(self, name: str, parent: Optional["Span"], backend: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else "%032x" % random.getrandbits(128)
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent.span_id if parent else None
+        # Stages inherit the backend of the request they run for
+        self.backend = backend or (parent.backend if parent else "")
+        self.sampled = parent.sampled if parent else random.random() < TRACE_SAMPLE_RATE
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "backend": self.backend,
+            "start": self.start,
+            "duration_ms": self.duration * 1000 if self.duration is not None else None,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class JsonlSpanExporter:
+    def __init__(self, path: str, flush_seconds: float = TRACE_FLUSH_SECONDS, max_buffered: int = TRACE_MAX_BUFFERED_SPANS):
+        """
+        Appends finished spans to a JSON lines file. Spans are buffered and written
+        by a background thread, so a request only pays for appending to a list.
+        """
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        self._buffer: List[Span] = []
+        self._dropped = 0
+        self._exported = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            if len(self._buffer) >= self.max_buffered:
+                self._dropped += 1
+                return
+            self._buffer.append(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+        if not spans:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans))
+        except OSError as e:
+            print(f"Trace export failed: {str(e)}")
+            return
+        with self._lock:
+            self._exported += len(spans)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"path": self.path, "exported": self._exported, "buffered": len(self._buffer), "dropped": self._dropped}
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+exporter: Optional[JsonlSpanExporter] = JsonlSpanExporter(TRACE_EXPORT_PATH) if TRACE_EXPORT_PATH else None
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, backend: str = "", **attributes: Any) -> Iterator[Span]:
+    """
+    Time a stage of the current request: records it in the stage latency histogram
+    (by stage and backend) and exports it as a span of the request's trace.
+
+    Args:
+        name: The stage (e.g. "chroma.query")
+        backend: The chat backend, inherited from the enclosing span if empty
+        **attributes: Extra span attributes (exported only)
+    """
+    current = Span(name, _current_span.get(), backend, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current._started
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Finished in another context (e.g. a generator closed elsewhere)
+            pass
+        registry.histogram(STAGE_METRIC, STAGE_METRIC_HELP, stage=name, backend=current.backend).observe(current.duration)
+        if exporter is not None and current.sampled:
+            exporter.export(current)
+
+
+def traced(stage: str, backend: str = "") -> Callable:
+    """
+    Decorator running a function in a span. Coroutine functions and generators
+    (sync or async, e.g. streamed responses) are timed until they finish.
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def async_gen_wrapper(*args, **kwargs):
+                with span(stage, backend=backend):
+                    async for item in func(*args, **kwargs):
+                        yield item
+            return async_gen_wrapper
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def gen_wrapper(*args, **kwargs):
+                with span(stage, backend=backend):
+                    yield from func(*args, **kwargs)
+            return gen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage, backend=backend):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, backend=backend):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_method(stage: str, backend_attribute: str = "model") -> Callable:
+    """Decorator running a method in a span labelled with the instance's backend (self.model)"""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with span(stage, backend=getattr(self, backend_attribute, "")):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracingMiddleware:
+    def __init__(self, app: Any, backends: Sequence[str] = ()):
+        """
+        ASGI middleware opening the root span of every HTTP request. Requests under
+        one of the backends' path prefixes (e.g. /llm-rag/...) are labelled with it.
+        """
+        self.app = app
+        self.backends = set(backends)
+
+    async def __call__(self, scope: Dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        prefix = scope["path"].split("/", 2)[1]
+        backend = prefix if prefix in self.backends else ""
+        with span("http.request", backend=backend, method=scope["method"], path=scope["path"]) as request_span:
+            async def send_with_status(message: Dict) -> None:
+                if message["type"] == "http.response.start":
+                    request_span.set("status", message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+
+
+def flush_traces() -> None:
+    """Write the buffered spans (e.g. at shutdown)"""
+    if exporter is not None:
+        exporter.flush()
+
+
+def tracing_stats() -> Dict[str, Any]:
+    return {
+        "exporter": exporter.stats() if exporter is not None else None,
+        "sample_rate": TRACE_SAMPLE_RATE,
+    }
@@ -0,0 +1,212 @@
+import os
+import argparse
+import asyncio
+import base64
+import json
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+import uuid
+from api.utils.chat_utils import ChatHistoryManager, SQLiteChatHistoryManager
+from api.utils.request_utils import read_chat_message
+from api.utils.description_utils import description_store
+
+# Models that have a chat router (and a chat history directory)
+CHAT_MODELS = ["llm", "llm-llama", "llm-rag"]
+
+
+def import_history(history_dir):
+    """Import the JSON chat history of every model into the SQLite store"""
+    for model in CHAT_MODELS:
+        manager = SQLiteChatHistoryManager(model, history_dir)
+        imported = manager.import_json_history()
+        print(f"Imported {imported} chats for {model} into {manager.db_path}")
+
+
+def seed_descriptions(images_dir, descriptions_dir):
+    """Seed the description store with the offline image descriptions"""
+    seeded = description_store.seed_offline(images_dir, descriptions_dir)
+    print(f"Seeded {seeded} image descriptions into {description_store.db_path}")
+
+
+def make_benchmark_chat(index, messages_per_chat):
+    messages = []
+    for turn in range(messages_per_chat // 2):
+        messages.append({"message_id": str(uuid.uuid4()), "role": "user", "content": f"Make a granny square blanket, change {turn}"})
+        messages.append({"message_id": str(uuid.uuid4()), "role": "assistant", "content": "Round 1: ch 4, sl st to form a ring. " * 40})
+    return {
+        "chat_id": str(uuid.uuid4()),
+        "title": f"Granny square blanket {index}...",
+        "dts": 1700000000 + index,
+        "messages": messages,
+    }
+
+
+def time_call(func, repeat):
+    """Best of `repeat` runs, in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_history(num_chats, messages_per_chat=6, limit=20, repeat=3):
+    """Compare listing recent chats with the JSON (glob) and SQLite backends"""
+    history_dir = tempfile.mkdtemp(prefix="chat-history-benchmark-")
+    session_id = "benchmark-session"
+    try:
+        json_manager = ChatHistoryManager("llm", history_dir)
+        sqlite_manager = SQLiteChatHistoryManager("llm", history_dir)
+        for index in range(num_chats):
+            chat = make_benchmark_chat(index, messages_per_chat)
+            json_manager.save_chat(chat, session_id)
+            sqlite_manager.save_chat(chat, session_id)
+
+        json_ms = time_call(lambda: json_manager.get_recent_chats(session_id, limit), repeat)
+        sqlite_ms = time_call(lambda: sqlite_manager.get_recent_chats(session_id, limit), repeat)
+        cursor = sqlite_manager.get_recent_chats(session_id, limit)[-1]["cursor"]
+        sqlite_page_ms = time_call(lambda: sqlite_manager.get_recent_chats(session_id, limit, cursor), repeat)
+
+        print(f"Listing {limit} of {num_chats} chats ({messages_per_chat} messages each):")
+        print(f"  json (glob + parse + sort): {json_ms:.1f} ms")
+        print(f"  sqlite (indexed):           {sqlite_ms:.2f} ms")
+        print(f"  sqlite (next page, before): {sqlite_page_ms:.2f} ms")
+    finally:
+        shutil.rmtree(history_dir)
+
+
+def make_request(body, content_type):
+    """Build a Starlette request that replays `body` in 64 KB chunks (as uvicorn does)"""
+    from starlette.requests import Request
+
+    chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)] or [b""]
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/llm/chats",
+        "headers": [(b"content-type", content_type.encode())],
+    }
+    return Request(scope, receive)
+
+
+def parse_upload(body, content_type, repeat=5):
+    """Parse a chat message body; returns (best milliseconds, peak traced memory in bytes)"""
+    parse = lambda: asyncio.run(read_chat_message(make_request(body, content_type)))
+    elapsed = time_call(parse, repeat)
+    # Measure memory separately, tracing slows the parse down
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def benchmark_upload(image_mb=5):
+    """Compare parsing a chat message with a base64 JSON image and a multipart binary image"""
+    image = b"\xff\xd8\xff\xe0" + os.urandom(image_mb * 1024 * 1024)
+    json_body = json.dumps({
+        "content": "Make this hat",
+        "image": "data:image/jpeg;base64," + base64.b64encode(image).decode(),
+    }).encode()
+
+    boundary = uuid.uuid4().hex
+    multipart_body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"content\"\r\n\r\nMake this hat\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"hat.jpg\"\r\n"
+        f"Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + image + f"\r\n--{boundary}--\r\n".encode()
+
+    json_ms, json_peak = parse_upload(json_body, "application/json")
+    multipart_ms, multipart_peak = parse_upload(multipart_body, f"multipart/form-data; boundary={boundary}")
+
+    print(f"Parsing a chat message with a {image_mb} MB image:")
+    print(f"  json (base64):      {len(json_body) / 1e6:.1f} MB body, {json_ms:.1f} ms, {json_peak / 1e6:.1f} MB peak")
+    print(f"  multipart (binary): {len(multipart_body) / 1e6:.1f} MB body, {multipart_ms:.1f} ms, {multipart_peak / 1e6:.1f} MB peak")
+
+
+def http_status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def benchmark_startup(timeout=300):
+    """
+    Start the API server (uvicorn) and measure the time until it answers requests
+    (listening) and until /readyz reports its dependencies ready
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.service:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL,
+    )
+    listening = ready = None
+    try:
+        while time.perf_counter() - start < timeout and server.poll() is None:
+            if listening is None and http_status(base_url + "/") == 200:
+                listening = time.perf_counter() - start
+            if listening is not None:
+                status = http_status(base_url + "/readyz")
+                # Servers without /readyz are ready once they listen
+                if status in (200, 404):
+                    ready = time.perf_counter() - start
+                    break
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print("API server startup:")
+    print(f"  time to listening: {listening:.2f}s" if listening is not None else "  never listened")
+    print(f"  time to ready:     {ready:.2f}s" if ready is not None else "  never ready")
+
+
+def main(args):
+    if args.import_history:
+        import_history(args.history_dir)
+    if args.benchmark_history:
+        benchmark_history(args.num_chats)
+    if args.benchmark_upload:
+        benchmark_upload()
+    if args.benchmark_startup:
+        benchmark_startup()
+    if args.seed_descriptions:
+        seed_descriptions(args.images_dir, args.descriptions_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API Service Tools")
+    parser.add_argument("--history-dir", default="chat-history", help="Chat history directory")
+    parser.add_argument("--import-history", action="store_true", help="Import JSON chat history into the SQLite store")
+    parser.add_argument("--benchmark-history", action="store_true", help="Benchmark listing chats with the JSON and SQLite stores")
+    parser.add_argument("--benchmark-upload", action="store_true", help="Benchmark parsing base64 JSON and multipart image uploads")
+    parser.add_argument("--benchmark-startup", action="store_true", help="Benchmark the API server's time to listening and to ready")
+    parser.add_argument("--seed-descriptions", action="store_true", help="Seed the image description store with the offline descriptions")
+    parser.add_argument("--images-dir", default="training/images", help="Training images for --seed-descriptions")
+    parser.add_argument("--descriptions-dir", default="training/image_descriptions_txt", help="Offline descriptions for --seed-descriptions")
+    parser.add_argument("--num-chats", type=int, default=10000, help="Number of chats per session for benchmarks")
+    args = parser.parse_args()
+    main(args)
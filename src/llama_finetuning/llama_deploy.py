@@ -1,5 +1,6 @@
 import modal
 from fastapi import Request, UploadFile
+from fastapi.responses import StreamingResponse
 import os
 from PIL import Image
 import requests
@@ -13,6 +14,39 @@ huggingface_secret = modal.Secret.from_name("my-huggingface-secret")
 # Paths for test images
 test_images_path = "test/images"
 
+# Replies end before this section (predict and predict_stream)
+ABBREVIATIONS_MARKER = "Abbreviations:"
+
+
+def partial_marker_length(text, marker):
+    """Length of the longest end of text that is the start of marker"""
+    for length in range(min(len(text), len(marker) - 1), 0, -1):
+        if text.endswith(marker[:length]):
+            return length
+    return 0
+
+
+def stop_at_marker(chunks, marker=ABBREVIATIONS_MARKER):
+    """
+    Yield streamed text up to marker. Text that could be the start of the marker
+    (at most len(marker) - 1 characters) is held back until the next chunk shows
+    whether the marker follows, so no part of it is ever yielded.
+    """
+    pending = ""
+    for text in chunks:
+        pending += text
+        index = pending.find(marker)
+        if index != -1:
+            if index:
+                yield pending[:index]
+            return
+        held = partial_marker_length(pending, marker)
+        if len(pending) > held:
+            yield pending[:len(pending) - held]
+            pending = pending[len(pending) - held:]
+    if pending:
+        yield pending
+
 # Create the Modal image with necessary dependencies
 model_image = modal.Image.debian_slim().pip_install(
     "Pillow",
@@ -68,56 +102,61 @@ class LlamaModel:
             device_map="auto",
         )
 
+    async def _prepare_inputs(self, request: Request):
+        """
+        Parse the form data and build the model inputs for a request.
+        """
+        # Parse form data
+        form = await request.form()
+        user_input = form.get("user_input", "")
+        image_file = form.get("image", None)
+
+        if image_file:
+            # Save the uploaded image to a temporary file
+            image_path = f"/tmp/{image_file.filename}"
+            with open(image_path, "wb") as f:
+                f.write(await image_file.read())
+
+            # Open the image
+            img = Image.open(image_path)
+        else:
+            img = None
+
+        # Dynamic prompt combining user preference and image
+        structured_prompt = f"""
+        Analyze the product shown in the image and provide a detailed crochet pattern.
+
+        Respond in a clear and organized format, including the following sections:
+        - **Crochet Product Name**
+        - **Materials**
+        - **Measurements**
+        - **Abbreviations**
+        - **Instructions**
+
+        Adapt your response based on the user query:
+        - If the user specifies a section (e.g., Materials), provide only that section.
+        - If the user does not specify, provide the complete crochet pattern.
+
+        User Query: {user_input}
+        """
+
+        # Process the input for the model
+        messages = [
+            {"role": "user", "content": [
+                {"type": "image"},
+                {"type": "text", "text": structured_prompt}
+            ]}
+        ]
+        input_text = self.processor.apply_chat_template(messages, add_generation_prompt=True)
+
+        if img:
+            return self.processor(img, input_text, return_tensors="pt").to(self.model.device)
+        return self.processor(text=input_text, return_tensors="pt").to(self.model.device)
+
     @modal.web_endpoint(method="POST")
     async def predict(self, request: Request):
         try:
-            # Parse form data
-            form = await request.form()
-            user_input = form.get("user_input", "")
-            image_file = form.get("image", None)
-
-            if image_file:
-                # Save the uploaded image to a temporary file
-                image_path = f"/tmp/{image_file.filename}"
-                with open(image_path, "wb") as f:
-                    f.write(await image_file.read())
-
-                # Open the image
-                img = Image.open(image_path)
-            else:
-                img = None
-
-            # Dynamic prompt combining user preference and image
-            structured_prompt = f"""
-            Analyze the product shown in the image and provide a detailed crochet pattern.
-
-            Respond in a clear and organized format, including the following sections:
-            - **Crochet Product Name**
-            - **Materials**
-            - **Measurements**
-            - **Abbreviations**
-            - **Instructions**
-
-            Adapt your response based on the user query:
-            - If the user specifies a section (e.g., Materials), provide only that section.
-            - If the user does not specify, provide the complete crochet pattern.
-
-            User Query: {user_input}
-            """
-
-            # Process the input for the model
-            messages = [
-                {"role": "user", "content": [
-                    {"type": "image"},
-                    {"type": "text", "text": structured_prompt}
-                ]}
-            ]
-            input_text = self.processor.apply_chat_template(messages, add_generation_prompt=True)
-
-            if img:
-                inputs = self.processor(img, input_text, return_tensors="pt").to(self.model.device)
-            else:
-                inputs = self.processor(text=input_text, return_tensors="pt").to(self.model.device)
+            inputs = await self._prepare_inputs(request)
 
             # Generate the response
             output = self.model.generate(**inputs, max_new_tokens=1000)
@@ -128,8 +167,8 @@ class LlamaModel:
             delimiter = "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
             if delimiter in decoded_output:
                 relevant_output = decoded_output.split(delimiter, 1)[1].strip()
-                if "Abbreviations:" in relevant_output:
-                    relevant_output = relevant_output.split("Abbreviations:", 1)[0].strip()
+                if ABBREVIATIONS_MARKER in relevant_output:
+                    relevant_output = relevant_output.split(ABBREVIATIONS_MARKER, 1)[0].strip()
             else:
                 relevant_output = "Error: Delimiter not found in output."
 
@@ -139,6 +178,26 @@ class LlamaModel:
             print(f"Error in predict endpoint: {e}")
             return {"error": str(e)}
 
+    @modal.web_endpoint(method="POST")
+    async def predict_stream(self, request: Request):
+        """
+        Same as predict, but streams the generated text as chunked plain text
+        while the model is generating.
+        """
+        from threading import Thread
+        from transformers import TextIteratorStreamer
+
+        inputs = await self._prepare_inputs(request)
+        streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        Thread(
+            target=self.model.generate,
+            kwargs=dict(**inputs, max_new_tokens=1000, streamer=streamer),
+            daemon=True,
+        ).start()
+
+        # Match predict: stop at the abbreviations section
+        return StreamingResponse(stop_at_marker(streamer), media_type="text/plain; charset=utf-8")
+
 
 @app.local_entrypoint()
 def main():
@@ -5,6 +5,7 @@ import numpy as np
 import json
 import glob
 import hashlib
+import functools
 import chromadb
 import shutil
 from google.cloud import storage
@@ -72,10 +73,16 @@ def generate_query_embedding(query):
 	Input: Query string.
 	Output: A list representing the query embedding.
 	'''
+	return list(_cached_query_embedding(" ".join(query.split())))
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_query_embedding(query):
+	# Repeated queries skip the Vertex AI round trip
 	query_embedding_inputs = [TextEmbeddingInput(task_type='RETRIEVAL_DOCUMENT', text=query)]
 	kwargs = dict(output_dimensionality=EMBEDDING_DIMENSION) if EMBEDDING_DIMENSION else {}
 	embeddings = embedding_model.get_embeddings(query_embedding_inputs, **kwargs)
-	return embeddings[0].values
+	return tuple(embeddings[0].values)
 
 
 def generate_text_embeddings(chunks, dimensionality: int = 256, batch_size=250):
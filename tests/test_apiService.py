@@ -0,0 +1,1346 @@
+import json
+import time
+import asyncio
+import threading
+import pytest
+from api.utils.backend_utils import BackendExecutor, run_in_backend, stream_in_backend, backend_stats
+from api.utils.session_utils import SessionCache
+from api.utils import image_utils
+from api.utils.image_utils import BlobStore, ChatImage, ImageNormalizer, chat_image_blob_response, legacy_chat_image_response, sniff_image_mime
+from api.utils.request_utils import read_chat_message, register_upload
+from api.utils.singleflight_utils import InFlightCalls
+from api.utils.llm_image_utils import ImageEmbeddingEngine
+from api.utils.embedding_utils import EmbeddingCache
+from api.utils.response_cache_utils import ResponseCache, generate_once, generation_stats
+from api.utils import description_utils
+from api.utils.description_utils import OFFLINE_PROMPT_VERSION, DescriptionStore, describe_image, description_calls
+from api.utils.http_utils import BackendHTTPClient, CircuitBreaker
+from api.utils.idempotency_utils import IdempotencyStore
+from api.utils.metrics_utils import Histogram, MetricsRegistry, registry
+from api.utils import rate_limit_utils
+from api.utils.rate_limit_utils import BackendRateLimiter, admitted, quota_usage, rate_limited, uses_quotas
+from api.utils.fair_queue_utils import FairScheduler, run_fairly
+from api.utils.startup_utils import LazyResource, lazy_resource, readiness, warmup
+from api.utils import tracing_utils
+from api.utils.tracing_utils import JsonlSpanExporter, span, traced
+from api.utils import profiling_utils
+from api.utils.profiling_utils import ProfilingMiddleware, list_profiles
+from api.utils.context_utils import ContextBuilder, estimate_tokens, query_ranked
+from api.utils.history_compaction_utils import IMAGE_PLACEHOLDER, SUMMARY_HEADER, HistoryCompactor
+from api.utils import history_utils
+from api.utils.history_utils import MISSING_REPLY_PLACEHOLDER, history_turns
+from api.utils.chat_utils import ChatHistoryManager, JSONLChatHistoryManager, SQLiteChatHistoryManager
+
+
+def slow_backend(delay, result):
+    """Stub for a blocking upstream call (Vertex AI, ChromaDB, Modal)."""
+    time.sleep(delay)
+    return result
+
+
+### Unit Tests ###
+
+def test_backend_executor_runs_calls_concurrently():
+    """Dozens of slow generations finish in roughly the time of one."""
+    executor = BackendExecutor("test-concurrent", max_concurrency=32)
+
+    async def run():
+        return await asyncio.gather(*[executor.run(slow_backend, 0.2, i) for i in range(32)])
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+
+    assert results == list(range(32))
+    assert elapsed < 1.0, f"Calls were serialized, took {elapsed:.2f}s"
+
+
+def test_backend_executor_respects_concurrency_limit():
+    """No more than max_concurrency calls run at the same time."""
+    executor = BackendExecutor("test-limit", max_concurrency=2)
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def tracked_call():
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+
+    async def run():
+        await asyncio.gather(*[executor.run(tracked_call) for _ in range(8)])
+
+    asyncio.run(run())
+    stats = executor.stats()
+    executor.shutdown()
+
+    assert state["peak"] == 2
+    assert stats["completed"] == 8
+    assert stats["running"] == 0 and stats["queued"] == 0
+
+
+def test_backend_executor_propagates_errors():
+    """Exceptions raised by the backend reach the awaiting handler."""
+    executor = BackendExecutor("test-errors", max_concurrency=1)
+
+    def failing_call():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        asyncio.run(executor.run(failing_call))
+    assert executor.stats()["failed"] == 1
+    executor.shutdown()
+
+
+def test_stream_in_backend_yields_chunks_as_they_arrive():
+    """Streamed chunks reach the event loop before the backend finishes."""
+
+    def slow_stream():
+        for chunk in ["Round 1: ", "ch 4, ", "sl st"]:
+            time.sleep(0.1)
+            yield chunk
+
+    async def run():
+        start = time.perf_counter()
+        arrivals = []
+        async for chunk in stream_in_backend("test-stream", slow_stream):
+            arrivals.append((chunk, time.perf_counter() - start))
+        return arrivals
+
+    arrivals = asyncio.run(run())
+    assert "".join(chunk for chunk, _ in arrivals) == "Round 1: ch 4, sl st"
+    assert arrivals[0][1] < 0.25, "First chunk waited for the whole stream"
+
+
+def test_session_cache_lru_eviction():
+    """The least recently used session is evicted once max_entries is exceeded."""
+    cache = SessionCache(max_entries=2, max_bytes=10**9, ttl_seconds=3600, size_fn=lambda s: 1)
+    cache["a"] = "session-a"
+    cache["b"] = "session-b"
+    assert cache.get("a") == "session-a"  # "b" is now least recently used
+    cache["c"] = "session-c"
+
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1
+
+
+def test_session_cache_byte_budget():
+    """Sessions are evicted to stay under the approximate byte budget."""
+    cache = SessionCache(max_entries=100, max_bytes=100, ttl_seconds=3600, size_fn=len)
+    cache["a"] = "x" * 60
+    cache["b"] = "y" * 60
+
+    assert len(cache) == 1 and "b" in cache
+    assert cache.stats()["bytes"] == 60
+
+
+def test_session_cache_ttl_expiry():
+    """Idle sessions expire and count as misses."""
+    cache = SessionCache(max_entries=10, max_bytes=10**9, ttl_seconds=0.05, size_fn=lambda s: 1)
+    cache["a"] = "session-a"
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats["expirations"] == 1
+    assert stats["misses"] == 1
+    assert stats["entries"] == 0
+
+
+def test_history_turns_image_only_user_messages():
+    """A user message with only an image becomes a turn with the image placeholder."""
+    turns = history_turns([
+        {"role": "user", "content": "", "image_path": "images/blobs/ab/abc.jpg"},
+        {"role": "assistant", "content": "Round 1: ch 4"},
+        {"role": "user", "content": "Smaller?", "image_path": "images/blobs/cd/cde.jpg"},
+        {"role": "assistant", "content": "Use a 3 mm hook."},
+    ])
+    assert turns == [
+        ("user", IMAGE_PLACEHOLDER),
+        ("model", "Round 1: ch 4"),
+        ("user", f"{IMAGE_PLACEHOLDER}\nSmaller?"),
+        ("model", "Use a 3 mm hook."),
+    ]
+
+
+def test_history_turns_describe_stored_images(tmp_path, monkeypatch):
+    """A rebuilt image turn carries the stored description of the image, found by its blob digest."""
+    store = DescriptionStore(db_path=str(tmp_path / "descriptions.db"))
+    monkeypatch.setattr(history_utils, "description_store", store)
+    image = ChatImage(b"\xff\xd8\xff\xe0" + b"beanie" * 10)
+    store.put(image.digest, "v1", "A red beanie with a pom-pom, worked in rounds.")
+    unknown = "0" * 64
+
+    turns = history_turns([
+        {"role": "user", "content": "Hat pattern?", "image_path": f"images/blobs/{image.digest[:2]}/{image.digest}.jpg"},
+        {"role": "assistant", "content": "Round 1: ch 4"},
+        {"role": "user", "content": "Make it smaller", "image_path": f"images/blobs/00/{unknown}.jpg"},
+        {"role": "assistant", "content": "Use a 3 mm hook."},
+    ])
+    assert turns[0] == ("user", "[The user shared an image of a crochet item: A red beanie with a pom-pom, worked in rounds.]\nHat pattern?")
+    # Images never described keep the placeholder
+    assert turns[2] == ("user", f"{IMAGE_PLACEHOLDER}\nMake it smaller")
+
+
+def test_history_turns_merge_users_around_empty_assistant_messages():
+    """An empty assistant reply does not leave two user turns in a row; an unanswered last message gets a placeholder."""
+    turns = history_turns([
+        {"role": "user", "content": "Hat pattern?"},
+        {"role": "assistant", "content": ""},
+        {"role": "user", "content": "For a baby"},
+        {"role": "assistant", "content": "Chain 40."},
+        {"role": "user", "content": "Thanks"},
+        {"role": "assistant", "content": None},
+    ])
+    assert turns == [
+        ("user", "Hat pattern?\n\nFor a baby"),
+        ("model", "Chain 40."),
+        ("user", "Thanks"),
+        ("model", MISSING_REPLY_PLACEHOLDER),
+    ]
+
+
+def test_history_turns_alternate_roles():
+    """Rebuilt histories always alternate user and model turns and end with the model."""
+    roles = ["user", "assistant", "assistant", "user", "user", "assistant", "user"]
+    contents = ["a", "b", "", "c", "", "d", "e"]
+    turns = history_turns([{"role": role, "content": content} for role, content in zip(roles, contents)])
+    assert [role for role, _ in turns] == ["user", "model"] * (len(turns) // 2)
+    assert turns[1] == ("model", "b") and turns[-2] == ("user", "e")
+    assert history_turns([]) == []
+
+
+def make_chat(chat_id, dts):
+    return {
+        "chat_id": chat_id,
+        "title": f"Chat {chat_id}...",
+        "dts": dts,
+        "messages": [
+            {"message_id": f"{chat_id}-1", "role": "user", "content": "Make a beanie"},
+            {"message_id": f"{chat_id}-2", "role": "assistant", "content": "Round 1: ch 4"},
+        ],
+    }
+
+
+def test_sqlite_history_save_and_get(tmp_path):
+    """Chats saved to the SQLite store are returned unchanged."""
+    manager = SQLiteChatHistoryManager("llm", str(tmp_path))
+    manager.save_chat(make_chat("a", 100), "session")
+
+    assert manager.get_chat("a", "session")["messages"][1]["content"] == "Round 1: ch 4"
+    assert manager.get_chat("a", "other-session") == {}
+
+
+def test_sqlite_history_cursor_pagination(tmp_path):
+    """Recent chats are summaries, newest first, paged with limit and before."""
+    manager = SQLiteChatHistoryManager("llm", str(tmp_path))
+    for index in range(5):
+        manager.save_chat(make_chat(f"chat-{index}", 100 + index), "session")
+
+    first_page = manager.get_recent_chats("session", limit=2)
+    assert [chat["chat_id"] for chat in first_page] == ["chat-4", "chat-3"]
+    assert set(first_page[0]) == {"chat_id", "title", "dts", "cursor"}
+
+    next_page = manager.get_recent_chats("session", limit=2, before=first_page[-1]["cursor"])
+    assert [chat["chat_id"] for chat in next_page] == ["chat-2", "chat-1"]
+    # A plain dts from older clients still pages
+    assert [chat["chat_id"] for chat in manager.get_recent_chats("session", before="102")] == ["chat-1", "chat-0"]
+
+
+@pytest.mark.parametrize("manager_class", [ChatHistoryManager, SQLiteChatHistoryManager, JSONLChatHistoryManager])
+def test_history_pagination_returns_chats_sharing_a_second(tmp_path, manager_class):
+    """Chats with the same dts across a page boundary are neither skipped nor repeated."""
+    manager = manager_class("llm", str(tmp_path))
+    for index in range(5):
+        manager.save_chat(make_chat(f"chat-{index}", 100 if index < 4 else 101), "session")
+
+    listed, before = [], None
+    while True:
+        page = manager.get_recent_chats("session", limit=2, before=before)
+        if not page:
+            break
+        listed.extend(chat["chat_id"] for chat in page)
+        before = page[-1]["cursor"]
+
+    assert listed == ["chat-4", "chat-3", "chat-2", "chat-1", "chat-0"]
+    with pytest.raises(ValueError):
+        manager.get_recent_chats("session", before="not a cursor")
+
+
+def add_turn(chat, turn):
+    chat["messages"].append({"message_id": f"{chat['chat_id']}-u{turn}", "role": "user", "content": f"Change {turn}"})
+    chat["messages"].append({"message_id": f"{chat['chat_id']}-a{turn}", "role": "assistant", "content": f"Answer {turn}"})
+    chat["dts"] += 1
+
+
+def test_jsonl_history_appends_only_new_messages(tmp_path):
+    """Each turn appends a constant number of records instead of rewriting the chat."""
+    manager = JSONLChatHistoryManager("llm", str(tmp_path), fsync_interval=0, compact_threshold=10**6)
+    chat = make_chat("a", 100)
+    manager.save_chat(chat, "session")
+    log_path = tmp_path / "llm" / "session" / "a.jsonl"
+    sizes = []
+    for turn in range(3):
+        add_turn(chat, turn)
+        manager.save_chat(chat, "session")
+        sizes.append(log_path.stat().st_size)
+
+    growth = [after - before for before, after in zip(sizes, sizes[1:])]
+    assert max(growth) - min(growth) <= 2
+    assert manager.get_chat("a", "session") == chat
+    manager.close()
+
+
+def test_jsonl_history_compaction_and_partial_records(tmp_path):
+    """Compaction folds the log into a JSON snapshot; a torn last record is ignored."""
+    manager = JSONLChatHistoryManager("llm", str(tmp_path), fsync_interval=0, compact_threshold=1)
+    chat = make_chat("a", 100)
+    manager.save_chat(chat, "session")
+    add_turn(chat, 1)
+    manager.save_chat(chat, "session")
+
+    assert manager.compact() == 1
+    chat_dir = tmp_path / "llm" / "session"
+    assert not (chat_dir / "a.jsonl").exists()
+    assert ChatHistoryManager("llm", str(tmp_path)).get_chat("a", "session") == chat
+
+    add_turn(chat, 2)
+    manager.save_chat(chat, "session")
+    with open(chat_dir / "a.jsonl", "a") as f:
+        f.write('{"type": "message", "mess')
+    assert manager.get_chat("a", "session") == chat
+    assert [c["chat_id"] for c in manager.get_recent_chats("session")] == ["a"]
+    manager.close()
+
+
+def test_jsonl_history_lists_from_index_and_compacts_logs_after_restart(tmp_path):
+    """Listing reads the logs once per session, and logs written before a restart are still compacted."""
+    manager = JSONLChatHistoryManager("llm", str(tmp_path), fsync_interval=0, compact_threshold=10**6)
+    chats = [make_chat(f"chat-{index}", 100 + index) for index in range(3)]
+    for chat in chats:
+        manager.save_chat(chat, "session")
+    manager.close()
+
+    restarted = JSONLChatHistoryManager("llm", str(tmp_path), fsync_interval=0, compact_threshold=4)
+    loads = []
+    load_chat = restarted._load_chat
+    restarted._load_chat = lambda chat_id, session_id: loads.append(chat_id) or load_chat(chat_id, session_id)
+    assert [chat["chat_id"] for chat in restarted.get_recent_chats("session")] == ["chat-2", "chat-1", "chat-0"]
+    assert len(loads) == 3
+
+    # Later pages and new turns are served from the index
+    add_turn(chats[0], 1)
+    chats[0]["dts"] = 200
+    restarted.save_chat(chats[0], "session")
+    loads.clear()
+    assert [chat["chat_id"] for chat in restarted.get_recent_chats("session", limit=2)] == ["chat-0", "chat-2"]
+    assert loads == []
+
+    # Only chat-0 reached 4 records, 3 of them written before the restart
+    assert restarted.compact() == 1
+    assert not (tmp_path / "llm" / "session" / "chat-0.jsonl").exists()
+    assert restarted.get_chat("chat-0", "session") == chats[0]
+    restarted.close()
+
+
+def test_blob_store_dedupes_and_detects_mime(tmp_path):
+    """Identical images are stored once, under their real type rather than the declared one."""
+    store = BlobStore(str(tmp_path))
+    jpeg_bytes = b"\xff\xd8\xff\xe0" + b"crochet" * 10
+    digest, path = store.put(jpeg_bytes, "image/png")
+    digest_again, path_again = store.put(jpeg_bytes, "image/png")
+
+    assert sniff_image_mime(jpeg_bytes) == "image/jpeg"
+    assert path.endswith(f"{digest}.jpg") and path == path_again and digest == digest_again
+    assert store.stats() == {"writes": 1, "dedupe_hits": 1, "bytes_saved": len(jpeg_bytes)}
+    assert store.resolve(digest[:2], f"{digest}.jpg") == path
+    assert store.resolve(digest[:2], "../../etc/passwd") is None
+
+
+def test_chat_image_routes_read_files_off_the_event_loop(tmp_path, monkeypatch):
+    """Blob and legacy image responses check and read their files in the history pool, not on the event loop."""
+    from fastapi import HTTPException
+    from starlette.requests import Request
+    jpeg_bytes = b"\xff\xd8\xff\xe0" + b"crochet" * 10
+    store = BlobStore(str(tmp_path / "blobs"))
+    digest, _ = store.put(jpeg_bytes)
+    (tmp_path / "chat-1").mkdir()
+    (tmp_path / "chat-1" / "message-1.png").write_bytes(jpeg_bytes)
+    request = Request({"type": "http", "method": "GET", "headers": []})
+
+    threads = []
+    file_response = image_utils.image_file_response
+
+    def recording_file_response(*args, **kwargs):
+        threads.append(threading.get_ident())
+        return file_response(*args, **kwargs)
+
+    monkeypatch.setattr(image_utils, "image_file_response", recording_file_response)
+
+    async def run():
+        blob = await chat_image_blob_response(request, store, digest[:2], f"{digest}.jpg")
+        legacy = await legacy_chat_image_response(request, str(tmp_path), "chat-1", "message-1")
+        errors = []
+        for chat_id, message_id in [("chat-1", "missing"), ("..", "message-1")]:
+            with pytest.raises(HTTPException) as error:
+                await legacy_chat_image_response(request, str(tmp_path / "chat-1"), chat_id, message_id)
+            errors.append(error.value.status_code)
+        return blob, legacy, errors
+
+    blob, legacy, errors = asyncio.run(run())
+    assert blob.media_type == "image/jpeg" and blob.headers["etag"] == f'"{digest}"'
+    # Legacy files are named .png whatever their real type
+    assert legacy.media_type == "image/jpeg"
+    assert errors == [404, 403]
+    assert len(threads) == 2 and threading.get_ident() not in threads
+
+
+def make_request(body, content_type):
+    from starlette.requests import Request
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request({"type": "http", "method": "POST", "headers": [(b"content-type", content_type.encode())]}, receive)
+
+
+def test_read_chat_message_json_and_multipart():
+    """A base64 JSON image and a multipart binary image decode to the same shared bytes."""
+    import base64
+    import json
+    jpeg_bytes = b"\xff\xd8\xff\xe0" + b"crochet" * 10
+    json_body = json.dumps({"content": "hat", "image": "data:image/png;base64," + base64.b64encode(jpeg_bytes).decode()})
+    multipart_body = (
+        b'--b\r\nContent-Disposition: form-data; name="content"\r\n\r\nhat\r\n'
+        b'--b\r\nContent-Disposition: form-data; name="image"; filename="hat.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'
+        + jpeg_bytes + b"\r\n--b--\r\n"
+    )
+
+    from_json = asyncio.run(read_chat_message(make_request(json_body.encode(), "application/json")))
+    from_form = asyncio.run(read_chat_message(make_request(multipart_body, "multipart/form-data; boundary=b")))
+
+    for message in (from_json, from_form):
+        assert message["content"] == "hat"
+        assert isinstance(message["image"], ChatImage)
+        assert message["image"].data == jpeg_bytes and message["image"].mime_type == "image/jpeg"
+    assert ChatImage.coerce(from_json["image"]) is from_json["image"]
+
+
+def test_image_normalizer_orients_downscales_and_caches():
+    """Large photos are rotated upright, shrunk to the backend's edge and normalized once per hash."""
+    import io
+    from PIL import Image
+    photo = Image.effect_noise((3000, 2000), 64).convert("RGB")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees clockwise
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=95, exif=exif)
+    image = ChatImage(buffer.getvalue())
+    normalizer = ImageNormalizer(max_edges={"llm": 1024, "llm-llama": 560})
+
+    normalized = normalizer.normalize(image, "llm")
+    assert normalizer.normalize(image, "llm") is normalized
+    llama = normalizer.normalize(image, "llm-llama")
+
+    assert Image.open(io.BytesIO(normalized.data)).size == (683, 1024)
+    assert max(Image.open(io.BytesIO(llama.data)).size) == 560
+    assert normalized.mime_type == "image/jpeg" and len(normalized) < len(image)
+    stats = normalizer.stats()
+    assert stats["images"] == 3 and stats["cache"]["hits"] == 1
+    assert stats["bytes_saved"] == 3 * len(image) - 2 * len(normalized) - len(llama)
+
+
+def test_image_normalizer_keeps_small_images_and_undecodable_ones():
+    """Images already within bounds, and ones PIL cannot decode, are passed through unchanged."""
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.effect_noise((64, 48), 64).convert("RGB").save(buffer, format="JPEG", quality=60)
+    small = ChatImage(buffer.getvalue())
+    undecodable = ChatImage(b"\x00\x00\x00\x18ftypheic" + b"\x00" * 64)
+    normalizer = ImageNormalizer()
+
+    assert normalizer.normalize(small, "llm").data == small.data
+    assert normalizer.normalize(undecodable, "llm") is undecodable
+    assert normalizer.stats()["failures"] == 1
+
+
+class StubEmbeddingEngine(ImageEmbeddingEngine):
+    """Embedding engine with a stub model: features are the image's mean color."""
+
+    def _load_model(self):
+        self.forward_passes = []
+        return 3
+
+    def _features(self, images):
+        import numpy as np
+        time.sleep(0.05)
+        self.forward_passes.append(len(images))
+        return np.stack([np.asarray(image, dtype=np.float32).mean(axis=(0, 1)) for image in images])
+
+
+def test_image_embedding_engine_batches_concurrent_requests():
+    """Concurrent embeddings share one forward pass and return the pooled features as is."""
+    from PIL import Image
+    from concurrent.futures import ThreadPoolExecutor
+    engine = StubEmbeddingEngine(output_dim=3, batch_window_ms=50)
+    images = [Image.new("RGB", (4, 4), (i * 10, 0, 0)) for i in range(8)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        vectors = list(pool.map(engine.embed, images))
+
+    assert engine.forward_passes == [8]
+    assert engine.stats()["batches"] == 1 and engine.stats()["mean_batch_size"] == 8
+    # No projection: the vectors are in the space of the indexed image vectors
+    assert [vector.tolist() for vector in vectors] == [[i * 10.0, 0.0, 0.0] for i in range(8)]
+
+
+def test_image_embedding_engine_rejects_model_not_matching_vector_db():
+    """A model whose features differ in size from the indexed vectors fails to start."""
+    engine = StubEmbeddingEngine(output_dim=1024)
+    with pytest.raises(ValueError):
+        engine.start()
+    assert not engine.stats()["loaded"]
+
+
+def test_embedding_cache_memory_and_shared_disk_tiers(tmp_path):
+    """Repeated queries are served from memory, and other workers reuse embeddings through SQLite."""
+    db_path = str(tmp_path / "embeddings.db")
+    calls = []
+
+    def embed(text):
+        calls.append(text)
+        return [0.1, 0.2, 0.3]
+
+    cache = EmbeddingCache(db_path=db_path)
+    args = ("text-embedding-004", "RETRIEVAL_DOCUMENT", 256)
+    assert cache.get_or_compute(*args, "Make this amigurumi smaller", embed) == [0.1, 0.2, 0.3]
+    assert cache.get_or_compute(*args, "  make this   Amigurumi smaller ", embed) == [0.1, 0.2, 0.3]
+    cache.get_or_compute("text-embedding-004", "RETRIEVAL_DOCUMENT", 128, "Make this amigurumi smaller", embed)
+
+    other_worker = EmbeddingCache(db_path=db_path)
+    assert other_worker.get_or_compute(*args, "Make this amigurumi smaller", embed) == [0.1, 0.2, 0.3]
+
+    assert len(calls) == 2
+    assert cache.stats()["memory_hits"] == 1 and cache.stats()["misses"] == 2
+    assert other_worker.stats()["disk_hits"] == 1 and other_worker.stats()["hit_rate"] == 1.0
+
+
+def test_response_cache_exact_and_semantic_hits():
+    """First-turn replies are reused for the same image and prompt, or a close enough prompt."""
+    vectors = {"make this hat": [1.0, 0.0], "how do i make this hat": [0.96, 0.28], "make this hat blue": [0.0, 1.0]}
+    cache = ResponseCache(semantic_threshold=0.95, embed_fn=lambda text: vectors[text], cost_per_call={"llm": 0.01})
+    image = ChatImage(b"\xff\xd8\xff\xe0" + b"hat" * 10)
+    other_image = ChatImage(b"\xff\xd8\xff\xe0" + b"scarf" * 10)
+
+    assert cache.lookup("llm", {"content": "Make this hat", "image": image}) is None
+    cache.store("llm", {"content": "Make this hat", "image": image}, "Round 1: ...", latency=12.0)
+
+    assert cache.lookup("llm", {"content": " make  this HAT", "image": image}) == "Round 1: ..."
+    assert cache.lookup("llm", {"content": "How do I make this hat", "image": image}) == "Round 1: ..."
+    assert cache.lookup("llm", {"content": "Make this hat blue", "image": image}) is None
+    assert cache.lookup("llm", {"content": "Make this hat", "image": other_image}) is None
+    assert cache.lookup("llm-llama", {"content": "Make this hat", "image": image}) is None
+
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["semantic_hits"], stats["misses"]) == (1, 1, 4)
+    assert stats["saved_seconds"] == 24.0 and stats["saved_cost_usd"] == 0.02
+
+
+def test_response_cache_ttl_expiry():
+    """Cached replies are not served after the TTL."""
+    cache = ResponseCache(ttl_seconds=0.05)
+    cache.store("llm", {"content": "Make this hat"}, "Round 1: ...", latency=1.0)
+    assert cache.lookup("llm", {"content": "Make this hat"}) == "Round 1: ..."
+    time.sleep(0.1)
+    assert cache.lookup("llm", {"content": "Make this hat"}) is None
+
+
+def test_description_store_seeded_offline_and_versioned(tmp_path):
+    """Offline descriptions are found by image hash, and live descriptions are kept per prompt version."""
+    import hashlib
+    images_dir, descriptions_dir = tmp_path / "images", tmp_path / "image_descriptions_txt"
+    images_dir.mkdir()
+    descriptions_dir.mkdir()
+    png_bytes = b"\x89PNG\r\n\x1a\n" + b"granny square"
+    (images_dir / "granny.png").write_bytes(png_bytes)
+    (descriptions_dir / "granny.txt").write_text("Granny square in double crochet clusters.")
+    (images_dir / "failed.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"failed")
+    (descriptions_dir / "failed.txt").write_text("Error generating description")
+    digest = hashlib.sha256(png_bytes).hexdigest()
+
+    store = DescriptionStore(db_path=str(tmp_path / "descriptions.db"))
+    assert store.seed_offline(str(images_dir), str(descriptions_dir)) == 1
+    assert store.get(digest, "v1") == "Granny square in double crochet clusters."
+
+    store.put(digest, "v1", "Live description.")
+    reopened = DescriptionStore(db_path=str(tmp_path / "descriptions.db"))
+    assert reopened.get(digest, "v1") == "Live description."
+    assert reopened.get(digest, OFFLINE_PROMPT_VERSION) == "Granny square in double crochet clusters."
+    assert reopened.get("0" * 64, "v1") is None
+    assert store.stats()["offline_hits"] == 1 and reopened.stats()["misses"] == 1
+
+
+def test_in_flight_calls_share_one_execution():
+    """Concurrent calls with the same key wait for the running call instead of repeating it."""
+    from concurrent.futures import ThreadPoolExecutor
+    in_flight = InFlightCalls()
+    calls = []
+
+    def describe(image):
+        calls.append(image)
+        time.sleep(0.1)
+        return f"description of {image}"
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = list(pool.map(lambda _: in_flight.run("hat", describe, "hat"), range(5)))
+
+    assert results == ["description of hat"] * 5
+    assert calls == ["hat"]
+    assert in_flight.stats() == {"in_flight": 0, "calls": 1, "joined": 4}
+
+
+def test_chat_message_with_image_handle():
+    """A message can refer to an image uploaded ahead of time by its handle."""
+    import json
+    from fastapi import HTTPException
+    image = ChatImage(b"\xff\xd8\xff\xe0" + b"preupload" * 10)
+    image_handle = register_upload(image)
+
+    body = json.dumps({"content": "hat", "image_handle": image_handle}).encode()
+    message = asyncio.run(read_chat_message(make_request(body, "application/json")))
+    assert message["image"] is image and "image_handle" not in message
+
+    body = json.dumps({"content": "hat", "image_handle": "expired"}).encode()
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(read_chat_message(make_request(body, "application/json")))
+    assert error.value.status_code == 404
+
+
+def test_backend_http_client_retries_transient_failures():
+    """429/5xx and connection errors are retried with backoff; the latency histograms record every call."""
+    import httpx
+    from fastapi import HTTPException
+    responses = [httpx.ConnectError("cold start"), 503, 429, 200]
+    attempts = []
+
+    def handler(request):
+        attempts.append(request.read())
+        outcome = responses.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome, json={"output": "Chain 20."})
+
+    client = BackendHTTPClient("modal", max_retries=3, backoff_seconds=0.01, transport=httpx.MockTransport(handler))
+    response = asyncio.run(client.post("https://modal.test/predict", data={"description": "hat"}))
+    assert response.json() == {"output": "Chain 20."}
+    # The form body is rebuilt for every attempt
+    assert attempts == [b"description=hat"] * 4
+
+    # Exhausted retries surface as a 502 instead of a raw upstream error
+    responses[:] = [500, 500]
+    client.max_retries = 1
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(client.post("https://modal.test/predict", data={"description": "hat"}))
+    assert error.value.status_code == 502
+
+    stats = client.stats()
+    assert stats["requests"] == 2 and stats["retries"] == 4 and stats["failures"] == 1
+    assert stats["latency_seconds"]["count"] == 2 and stats["attempt_latency_seconds"]["count"] == 6
+
+
+def test_circuit_breaker_fails_fast_and_recovers():
+    """After repeated failures calls fail fast with 503 until a trial call succeeds."""
+    import httpx
+    from fastapi import HTTPException
+    statuses = [502, 502, 200]
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(statuses.pop(0))
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.2)
+    client = BackendHTTPClient("modal", max_retries=0, circuit_breaker=breaker, transport=httpx.MockTransport(handler))
+
+    async def call():
+        try:
+            return (await client.post("https://modal.test/predict")).status_code
+        except HTTPException as e:
+            return e.status_code, e.headers
+
+    assert asyncio.run(call()) == (502, None)
+    assert asyncio.run(call()) == (502, None)
+    assert breaker.state == "open"
+    # Rejected without reaching the backend
+    assert asyncio.run(call()) == (503, {"Retry-After": "1"})
+    assert len(calls) == 2
+
+    time.sleep(0.25)
+    assert breaker.state == "half_open"
+    assert asyncio.run(call()) == 200
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 0, "opens": 1, "rejected": 1}
+
+
+def test_cancelled_half_open_trial_releases_the_circuit():
+    """A half open trial cancelled mid request lets the next call be the trial instead of failing forever."""
+    import httpx
+
+    async def handler(request):
+        if request.url.path == "/slow":
+            await asyncio.sleep(10)
+        return httpx.Response(200)
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.1)
+    client = BackendHTTPClient("modal", max_retries=0, circuit_breaker=breaker, transport=httpx.MockTransport(handler))
+
+    async def run():
+        trial = asyncio.ensure_future(client.post("https://modal.test/slow"))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return (await client.post("https://modal.test/predict")).status_code
+
+    assert asyncio.run(run()) == 200
+    assert breaker.stats()["state"] == "closed" and breaker.stats()["rejected"] == 0
+
+
+def test_histogram_quantiles():
+    """Latency quantiles are interpolated within the histogram buckets."""
+    histogram = Histogram("test_seconds", buckets=(0.1, 1, 10))
+    for value in [0.05] * 50 + [0.5] * 45 + [5] * 5:
+        histogram.observe(value)
+
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 100 and snapshot["max"] == 5
+    assert snapshot["buckets"] == {"0.1": 50, "1": 95, "10": 100, "+Inf": 100}
+    assert snapshot["p50"] == pytest.approx(0.1)
+    assert snapshot["p95"] == pytest.approx(1)
+    assert 1 < snapshot["p99"] <= 10
+    assert Histogram("empty_seconds").snapshot()["p50"] is None
+
+
+def test_identical_generations_are_coalesced():
+    """Identical chat requests in flight share one upstream generation; different history does not."""
+    calls = []
+
+    def generate(chat_session, message):
+        calls.append(chat_session)
+        time.sleep(0.2)
+        return f"pattern for {message['content']}"
+
+    history = [{"message_id": "m1", "role": "user", "content": "hat"}, {"message_id": "m2", "role": "assistant", "content": "Chain 4."}]
+
+    async def run():
+        return await asyncio.gather(
+            generate_once("llm", generate, "session-1", {"content": "Granny  square"}, []),
+            generate_once("llm", generate, "session-2", {"content": "granny square"}, []),
+            generate_once("llm", generate, "session-3", {"content": "granny square"}, history),
+        )
+
+    before = generation_stats()
+    results = asyncio.run(run())
+    assert results[0] == ("pattern for Granny  square", False)
+    assert results[1] == ("pattern for Granny  square", True)
+    assert results[2] == ("pattern for granny square", False)
+    assert calls == ["session-1", "session-3"]
+    after = generation_stats()
+    assert after["upstream_calls"] - before["upstream_calls"] == 2
+    assert after["collapsed"] - before["collapsed"] == 1 and after["in_flight"] == 0
+
+
+def test_idempotency_store_replays_completed_and_in_flight_requests():
+    """Retries with the same key await the first attempt or get its stored result; failures are not stored."""
+    store = IdempotencyStore(ttl_seconds=0.3)
+    created = []
+
+    async def create_chat(title):
+        await asyncio.sleep(0.1)
+        created.append(title)
+        return {"chat_id": f"chat-{len(created)}", "title": title}
+
+    async def failing_chat(title):
+        raise RuntimeError("Modal is cold")
+
+    async def run():
+        key = ("llm", "session", None, "key-1")
+        first, retry = await asyncio.gather(store.run(key, create_chat, "hat"), store.run(key, create_chat, "hat"))
+        later = await store.run(key, create_chat, "hat")
+        other = await store.run(("llm", "session", None, "key-2"), create_chat, "scarf")
+        with pytest.raises(RuntimeError):
+            await store.run(("llm", "session", None, "key-3"), failing_chat, "hat")
+        recovered = await store.run(("llm", "session", None, "key-3"), create_chat, "hat")
+        await asyncio.sleep(0.35)
+        expired = await store.run(key, create_chat, "hat")
+        return first, retry, later, other, recovered, expired
+
+    first, retry, later, other, recovered, expired = asyncio.run(run())
+    assert first == ({"chat_id": "chat-1", "title": "hat"}, False)
+    assert retry == ({"chat_id": "chat-1", "title": "hat"}, True)
+    assert later == ({"chat_id": "chat-1", "title": "hat"}, True)
+    assert other == ({"chat_id": "chat-2", "title": "scarf"}, False)
+    assert recovered == ({"chat_id": "chat-3", "title": "hat"}, False)
+    assert expired == ({"chat_id": "chat-4", "title": "hat"}, False)
+    # Only the key stored after the others expired is left
+    assert store.stats() == {"entries": 1, "executed": 4, "replayed": 1, "joined_in_flight": 1}
+
+
+def test_rate_limiter_queues_within_quota_and_rejects_when_saturated():
+    """Calls beyond the burst wait for tokens; calls that would wait too long get 503 with Retry-After."""
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import HTTPException
+    limiter = BackendRateLimiter("gemini", rpm=600, burst=2, max_wait_seconds=0.25, max_queue=8)
+    start = time.perf_counter()
+
+    def call_gemini(_):
+        limiter.acquire()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        admitted = list(pool.map(call_gemini, range(4)))
+    # 2 immediately from the burst, then one every 0.1s
+    assert sorted(round(t, 1) for t in admitted) == [0.0, 0.0, 0.1, 0.2]
+
+    with pytest.raises(HTTPException) as error:
+        for _ in range(5):
+            limiter.reserve()
+    assert error.value.status_code == 503 and "Retry-After" in error.value.headers
+
+    stats = limiter.stats()
+    assert stats["admitted"] >= 6 and stats["rejected"] == 1 and stats["wait_seconds"]["count"] == stats["admitted"]
+    assert stats["max_queue_depth"] >= 2
+
+
+def test_rate_limiter_maps_upstream_429_and_cools_down():
+    """An upstream quota error becomes a 503 with Retry-After and withholds quota for the cooldown."""
+    from fastapi import HTTPException
+
+    class ResourceExhausted(Exception):
+        code = 429
+
+    limiter = BackendRateLimiter("embedding", rpm=600, burst=5, max_wait_seconds=0.1, cooldown_seconds=1)
+    # Other errors pass through unchanged
+    with pytest.raises(ValueError):
+        with limiter.limit():
+            raise ValueError("bad input")
+
+    with pytest.raises(HTTPException) as error:
+        with limiter.limit():
+            raise ResourceExhausted("Quota exceeded for aiplatform.googleapis.com")
+    assert error.value.status_code == 503 and error.value.headers == {"Retry-After": "1"}
+
+    # During the cooldown new calls are rejected up front instead of hitting the upstream
+    with pytest.raises(HTTPException):
+        asyncio.run(limiter.acquire_async())
+    assert limiter.stats()["upstream_throttled"] == 1
+
+
+def test_quota_waits_on_the_event_loop_not_in_worker_threads(monkeypatch):
+    """Generations admitted on the event loop wait for quota without holding a worker, so other calls are not queued behind them."""
+    limiter = BackendRateLimiter("test-quota", rpm=600, burst=1, max_wait_seconds=1, max_thread_wait_seconds=0)
+    monkeypatch.setitem(rate_limit_utils._limiters, "test-quota", limiter)
+    executor = BackendExecutor("test-quota", max_concurrency=1)
+    start = time.perf_counter()
+
+    def call_upstream():
+        with limiter.limit():
+            return time.perf_counter() - start
+
+    async def generate():
+        async with admitted({"test-quota": 1}):
+            return await executor.run(call_upstream)
+
+    async def run():
+        generations = [asyncio.ensure_future(generate()) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        # A call needing no quota gets the single worker while the generations wait
+        other = await executor.run(lambda: time.perf_counter() - start)
+        return other, await asyncio.gather(*generations)
+
+    other, admitted_at = asyncio.run(run())
+    assert other < 0.05
+    assert sorted(round(t, 1) for t in admitted_at) == [0.0, 0.1, 0.2, 0.3]
+
+    # A token admitted but not used by the call is given back
+    before = limiter.stats()["tokens"]
+
+    async def no_upstream_call():
+        async with admitted({"test-quota": 1}):
+            await executor.run(lambda: None)
+
+    time.sleep(0.1)
+    asyncio.run(no_upstream_call())
+    assert limiter.stats()["tokens"] == pytest.approx(min(1.0, before + 1), abs=0.05)
+
+
+def test_image_turn_admits_its_description_and_reply_on_the_event_loop(monkeypatch):
+    """An image turn whose description is not stored is admitted for both Gemini calls up front, so neither waits for quota in a worker thread."""
+    limiter = BackendRateLimiter("gemini", rpm=6000, burst=2, max_wait_seconds=5, max_thread_wait_seconds=0)
+    monkeypatch.setitem(rate_limit_utils._limiters, "gemini", limiter)
+    store = DescriptionStore(db_path=None)
+    monkeypatch.setattr(description_utils, "description_store", store)
+
+    def generate_description(image, model, version, generation_config):
+        with rate_limited("gemini"):
+            description = f"A crocheted item {image.digest[:8]}"
+        store.put(image.digest, version, description)
+        return description
+
+    monkeypatch.setattr(description_utils, "_generate_description", generate_description)
+
+    @uses_quotas(lambda message: {"gemini": description_calls(message["image"], "test") + 1})
+    def generate(message):
+        description = describe_image(message["image"], None, "test")
+        with rate_limited("gemini"):
+            return f"Pattern for {description}"
+
+    messages = [{"image": ChatImage(b"\xff\xd8\xff\xe0" + f"item {i}".encode() * 10)} for i in range(14)]
+
+    async def run():
+        return await asyncio.gather(*(run_fairly("test-gemini", f"session-{i}", generate, message) for i, message in enumerate(messages)))
+
+    replies = asyncio.run(run())
+    assert len(replies) == 14
+    stats = limiter.stats()
+    # Every call used a token admitted on the loop: none was rejected in a thread
+    assert stats["rejected"] == 0 and stats["admitted"] == 14
+
+    # Described images only need the reply's token
+    assert quota_usage(generate, messages[0]) == {"gemini": 1}
+
+
+def test_fair_scheduler_round_robins_sessions_with_per_session_cap():
+    """Free slots go round robin to sessions with waiting requests; a session never exceeds its cap."""
+    scheduler = FairScheduler("llm", max_concurrency=2, session_max_concurrency=2, session_max_queued=4)
+    order = []
+
+    async def generate(session_id, name):
+        async with scheduler.slot(session_id):
+            order.append(name)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        heavy = [asyncio.create_task(generate("heavy", f"heavy-{i}")) for i in range(6)]
+        await asyncio.sleep(0)
+        light = [asyncio.create_task(generate(session, session)) for session in ("light-1", "light-2")]
+        await asyncio.sleep(0)
+        # A full queue for the session is rejected, other sessions are unaffected
+        from fastapi import HTTPException
+        with pytest.raises(HTTPException) as error:
+            await generate("heavy", "heavy-overflow")
+        assert error.value.status_code == 429
+        await asyncio.gather(*heavy, *light)
+
+    asyncio.run(run())
+    # heavy-0/1 hold both slots, then every freed slot alternates with the light sessions
+    assert order[:2] == ["heavy-0", "heavy-1"]
+    assert order.index("light-1") <= 3 and order.index("light-2") <= 5
+    stats = scheduler.stats()
+    assert stats["granted"] == 8 and stats["rejected"] == 1 and stats["active"] == 0 and stats["waiting"] == 0
+
+
+def test_lazy_resource_created_once_on_first_use():
+    """Models are created on first use, once even under concurrent requests, and failed creations are retried."""
+    from concurrent.futures import ThreadPoolExecutor
+    created = []
+
+    class Model:
+        def generate_content(self, prompt):
+            return f"pattern for {prompt}"
+
+    def create_model():
+        created.append(1)
+        time.sleep(0.05)
+        return Model()
+
+    model = LazyResource("test.model", create_model)
+    assert created == [] and model.state == "pending"
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(model.generate_content, ["hat", "scarf", "bag", "toy"]))
+    assert results == ["pattern for hat", "pattern for scarf", "pattern for bag", "pattern for toy"]
+    assert created == [1] and model.status()["state"] == "ready"
+
+    attempts = []
+
+    def connect_chroma():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("Chroma is down")
+        return "collection"
+
+    collection = lazy_resource("test.chromadb", connect_chroma, required=False)
+    with pytest.raises(ConnectionError):
+        collection.get()
+    status = readiness()["dependencies"]["test.chromadb"]
+    assert status["state"] == "failed" and "Chroma is down" in status["error"]
+
+    # The warmup retries until every dependency is up
+    warmup(retry_seconds=0.01)
+    assert collection.get() == "collection" and len(attempts) == 3
+    assert readiness()["dependencies"]["test.chromadb"]["state"] == "ready"
+
+
+def test_metrics_registry_renders_prometheus_histograms():
+    """Histograms are exported per label set in the Prometheus text format."""
+    metrics = MetricsRegistry()
+    metrics.histogram("stage_seconds", "Stage latency", stage="chroma.query", backend="llm-rag").observe(0.02)
+    metrics.histogram("stage_seconds", stage="chroma.query", backend="llm-rag").observe(0.3)
+    metrics.register("quota_wait_seconds", Histogram("gemini"), quota="gemini")
+    text = metrics.render()
+    assert "# HELP api_stage_seconds Stage latency\n# TYPE api_stage_seconds histogram" in text
+    assert 'api_stage_seconds_bucket{backend="llm-rag",stage="chroma.query",le="0.025"} 1' in text
+    assert 'api_stage_seconds_bucket{backend="llm-rag",stage="chroma.query",le="+Inf"} 2' in text
+    assert 'api_stage_seconds_count{backend="llm-rag",stage="chroma.query"} 2' in text
+    assert 'api_quota_wait_seconds_count{quota="gemini"} 0' in text
+
+
+def test_spans_nest_inherit_backend_and_export(tmp_path, monkeypatch):
+    """Stages record a histogram per backend and export one trace per request, also across worker threads."""
+    exporter = JsonlSpanExporter(str(tmp_path / "traces.jsonl"))
+    monkeypatch.setattr(tracing_utils, "exporter", exporter)
+
+    @traced("test.retrieve")
+    def retrieve():
+        return ["chunk"]
+
+    @traced("test.stream")
+    def stream():
+        yield "a"
+        yield "b"
+
+    async def handle():
+        with span("test.request", backend="llm-rag") as request_span:
+            chunks = await run_in_backend("test-tracing", retrieve)
+            streamed = [chunk async for chunk in stream_in_backend("test-tracing", stream)]
+            with pytest.raises(ValueError):
+                with span("test.generation"):
+                    raise ValueError("bad prompt")
+        return request_span, chunks, streamed
+
+    request_span, chunks, streamed = asyncio.run(handle())
+    assert chunks == ["chunk"] and streamed == ["a", "b"]
+    assert tracing_utils.current_span() is None
+    exporter.flush()
+
+    with open(tmp_path / "traces.jsonl") as f:
+        spans = {record["name"]: record for record in map(json.loads, f)}
+    assert set(spans) == {"test.request", "test.retrieve", "test.stream", "test.generation"}
+    assert {record["trace_id"] for record in spans.values()} == {request_span.trace_id}
+    for name in ("test.retrieve", "test.stream", "test.generation"):
+        assert spans[name]["parent_id"] == request_span.span_id
+        assert spans[name]["backend"] == "llm-rag"
+    assert spans["test.generation"]["error"] == "ValueError"
+    assert registry.histogram("stage_seconds", stage="test.retrieve", backend="llm-rag").snapshot()["count"] == 1
+
+
+def test_profiling_middleware_writes_speedscope_profile_on_request(tmp_path, monkeypatch):
+    """Only requests sending X-Profile are profiled, including the backend threads running their calls."""
+    monkeypatch.setattr(profiling_utils, "PROFILE_DIR", str(tmp_path))
+
+    def busy_retrieval():
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+        return "chunks"
+
+    async def app(scope, receive, send):
+        body = (await run_in_backend("test-profiling", busy_retrieval)).encode()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": body})
+
+    async def request(headers):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/llm-rag/chats", "headers": headers}
+        await ProfilingMiddleware(app)(scope, receive, send)
+        return dict(messages[0]["headers"])
+
+    assert b"x-profile-id" not in asyncio.run(request([]))
+    profile_id = asyncio.run(request([(b"x-profile", b"1")]))[b"x-profile-id"].decode()
+    assert [profile["profile_id"] for profile in list_profiles()] == [profile_id]
+
+    with open(profiling_utils.profile_path(profile_id)) as f:
+        document = json.load(f)
+    frames = document["shared"]["frames"]
+    worker = next(profile for profile in document["profiles"] if profile["name"].startswith("backend-test-profiling"))
+    busy_samples = [stack for stack in worker["samples"] if frames[stack[-1]]["name"] == "busy_retrieval"]
+    assert document["name"] == "POST /llm-rag/chats" and len(busy_samples) >= 10
+    assert len(worker["samples"]) == len(worker["weights"])
+
+
+def test_profile_leaves_out_concurrent_requests_on_the_event_loop(tmp_path, monkeypatch):
+    """Event loop samples are only recorded while the loop runs the profiled request, not a concurrent one."""
+    monkeypatch.setattr(profiling_utils, "PROFILE_DIR", str(tmp_path))
+
+    def spin(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    async def profiled_work():
+        spin(0.1)
+
+    async def other_request_work():
+        spin(0.1)
+
+    async def app(scope, receive, send):
+        if scope["path"] == "/profiled":
+            await profiled_work()
+            await run_in_backend("test-profiling", spin, 0.15)
+        else:
+            await asyncio.sleep(0.12)
+            await other_request_work()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def request(path, headers):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        await ProfilingMiddleware(app)({"type": "http", "method": "GET", "path": path, "headers": headers}, receive, send)
+        return dict(messages[0]["headers"])
+
+    async def run():
+        return await asyncio.gather(request("/profiled", [(b"x-profile", b"1")]), request("/other", []))
+
+    profile_id = asyncio.run(run())[0][b"x-profile-id"].decode()
+    with open(profiling_utils.profile_path(profile_id)) as f:
+        document = json.load(f)
+    names = {document["shared"]["frames"][index]["name"] for profile in document["profiles"] for stack in profile["samples"] for index in stack}
+    assert {"profiled_work", "spin"} <= names
+    assert "other_request_work" not in names
+
+
+def test_profile_admin_endpoints_require_a_configured_token(monkeypatch):
+    """Listing and downloading profiles is refused unless PROFILE_TOKEN is set and sent."""
+    from fastapi import HTTPException
+    monkeypatch.setattr(profiling_utils, "PROFILE_TOKEN", "")
+    for token in (None, "", "guess"):
+        with pytest.raises(HTTPException) as error:
+            profiling_utils.check_profile_token(token)
+        assert error.value.status_code == 403
+
+    monkeypatch.setattr(profiling_utils, "PROFILE_TOKEN", "secret")
+    with pytest.raises(HTTPException):
+        profiling_utils.check_profile_token("guess")
+    profiling_utils.check_profile_token("secret")
+
+
+class StubCollection:
+    """Chroma collection returning fixed (id, distance) rows for each query vector."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def query(self, query_embeddings, n_results=5, include=None):
+        self.queries.append(len(query_embeddings))
+        rows = [self.rows[tuple(embedding)][:n_results] for embedding in query_embeddings]
+        return {
+            "ids": [[doc_id for doc_id, _ in row] for row in rows],
+            "distances": [[distance for _, distance in row] for row in rows],
+            "documents": [[f"text of {doc_id}" for doc_id, _ in row] for row in rows],
+        }
+
+
+def previous_re_rank_results(text_results, image_results, text_weight=0.6, image_weight=0.4):
+    """The per-query ranking used before the batched query."""
+    result_scores = {}
+    for results, weight in ((text_results, text_weight), (image_results, image_weight)):
+        for idx, doc_id in enumerate(results["ids"][0]):
+            result_scores[doc_id] = result_scores.get(doc_id, 0) + results["distances"][0][idx] * weight
+    return [{"id": doc_id, "score": score} for doc_id, score in sorted(result_scores.items(), key=lambda item: item[1])]
+
+
+def test_batched_query_ranks_like_the_per_query_implementation():
+    """One batched query fuses duplicates and ranks (ties included) exactly like the two separate queries did."""
+    rows = {
+        (1.0,): [("d3", 0.2), ("d1", 0.3), ("d7", 0.5), ("d2", 0.5), ("d9", 0.9)],
+        # d1 and d3 are returned by both queries, d4 and d8 only by the text query
+        (0.0,): [("d4", 0.1), ("d1", 0.2), ("d3", 0.4), ("d8", 0.75), ("d5", 1.0)],
+        (0.5,): [],
+    }
+    collection = StubCollection(rows)
+
+    ranked = query_ranked(collection, [[1.0], [0.0]], weights=(0.6, 0.4))
+    previous = previous_re_rank_results(collection.query([[1.0]]), collection.query([[0.0]]))
+
+    assert collection.queries == [2, 1, 1]
+    assert [result["id"] for result in ranked] == [result["id"] for result in previous]
+    assert [result["score"] for result in ranked] == pytest.approx([result["score"] for result in previous])
+    assert len({result["id"] for result in ranked}) == len(ranked) == 8
+    assert all(result["document"] == f"text of {result['id']}" for result in ranked)
+    # A query without results (e.g. an empty collection) contributes nothing
+    assert query_ranked(collection, [[0.5], [0.0]], weights=(0.6, 0.4))[0]["id"] == "d4"
+    assert query_ranked(collection, [[0.5]], weights=(1.0,)) == []
+
+
+def test_context_builder_dedupes_orders_and_packs_chunks_into_budget():
+    """Retrieved chunks are deduplicated, ordered by fused score and packed into the token budget."""
+    words = [f"stitch{i}" for i in range(400)]
+    first_part = " ".join(words[:120])
+    # Splitter overlap: the next chunk of the same pattern repeats its last 20 words
+    second_part = " ".join(words[100:220])
+    ranked_results = [
+        {"id": "b", "score": 0.4, "document": second_part},
+        {"id": "a", "score": 0.2, "document": first_part},
+        {"id": "a-copy", "score": 0.5, "document": first_part.upper()},
+        {"id": "long", "score": 0.6, "document": " ".join(words[220:400]) * 3},
+    ]
+    builder = ContextBuilder(token_budget=600)
+    context, report = builder.build(ranked_results)
+    assert context.split() == words[:220]
+    assert report["chunks_used"] == 2 and report["chunks_deduplicated"] == 1 and report["chunks_over_budget"] == 1
+    assert report["tokens_used"] == estimate_tokens(context) <= 600
+    assert report["tokens_saved"] == report["tokens_retrieved"] - report["tokens_used"] > 0
+
+    # A best chunk larger than the whole budget is truncated at a word boundary
+    context, report = builder.build([{"score": 0.1, "document": "chain " * 1000}], token_budget=50)
+    assert context == ("chain " * 33).strip() and report["tokens_used"] <= 50
+    assert builder.stats()["requests"] == 2 and builder.stats()["tokens_saved"] > 0
+
+
+def test_history_compactor_keeps_recent_turns_describes_images_and_rolls_summary():
+    """Old turns are folded into a rolling summary and their images replaced by descriptions, within the token ceiling."""
+    class Part:
+        """Minimal stand-in for vertexai Part (text or inline image)."""
+        def __init__(self, text=None, data=None):
+            self._text, self._data = text, data
+
+        @staticmethod
+        def from_text(text):
+            return Part(text=text)
+
+        @property
+        def text(self):
+            if self._text is None:
+                raise AttributeError("Part has no text")
+            return self._text
+
+        @property
+        def mime_type(self):
+            if self._data is None:
+                raise AttributeError("Part has no mime_type")
+            return "image/jpeg"
+
+        @property
+        def inline_data(self):
+            return type("Blob", (), {"data": self._data})()
+
+    class Content:
+        def __init__(self, role, parts):
+            self.role, self.parts = role, parts
+
+    def turn(i):
+        question = Content("user", [Part(data=f"image{i}".encode()), Part.from_text(f"question {i} " + "chunk " * 400)])
+        return [question, Content("model", [Part.from_text(f"pattern {i} " + "row " * 200)])]
+
+    descriptions = {b"image4": "A blue granny square", b"image5": "A red amigurumi"}
+    compactor = HistoryCompactor(keep_turns=2, described_turns=2, summary_max_tokens=200, token_ceiling=100000)
+    history = [content for i in range(8) for content in turn(i)]
+    compacted, report = compactor.compact(history, ["next question"], describe=descriptions.get)
+
+    # 2 described turns and 2 verbatim turns, the summary leads the first of them
+    assert len(compacted) == 8
+    summary = compacted[0].parts[0].text
+    assert summary.startswith(SUMMARY_HEADER) and "question 3" in summary and "question 0" not in summary
+    assert "A blue granny square" in compacted[0].parts[1].text and compacted[0].parts[2].text.startswith("question 4")
+    assert compacted[4].parts[0].mime_type == "image/jpeg" and compacted[6].parts[0].inline_data.data == b"image7"
+    assert report["turns_summarized"] == 4 and report["images_described"] == 6
+    assert 0 < report["tokens_after"] < report["tokens_before"] and report["tokens_avoided"] == report["tokens_before"] - report["tokens_after"]
+
+    # The summary rolls forward as turns are added instead of being summarized again
+    compacted, report = compactor.compact(compacted + turn(8), describe=descriptions.get)
+    summary = compacted[0].parts[0].text
+    assert summary.count(SUMMARY_HEADER) == 1 and "pattern 3" in summary and "question 4" in summary
+    assert "A blue granny square" in summary and estimate_tokens(summary) <= 200
+
+    # A short session is left alone; the ceiling keeps fewer turns
+    assert compactor.compact(turn(0))[0] is None
+    compacted, report = HistoryCompactor(keep_turns=4, described_turns=0, token_ceiling=1000).compact(history)
+    assert len(compacted) == 2 and report["tokens_after"] <= 1000
+    assert compactor.stats()["compactions"] == 2 and compactor.stats()["tokens_avoided"] > 0
+
+
+### Integration Tests ###
+
+def test_import_json_history_into_sqlite(tmp_path):
+    """Chats stored as JSON files are imported into the SQLite store."""
+    json_manager = ChatHistoryManager("llm-rag", str(tmp_path))
+    json_manager.save_chat(make_chat("a", 100), "session-1")
+    json_manager.save_chat(make_chat("b", 200), "session-2")
+
+    sqlite_manager = SQLiteChatHistoryManager("llm-rag", str(tmp_path))
+    assert sqlite_manager.import_json_history() == 2
+    assert sqlite_manager.get_recent_chats("session-1") == json_manager.get_recent_chats("session-1")
+    assert sqlite_manager.get_chat("b", "session-2") == json_manager.get_chat("b", "session-2")
+
+
+def test_event_loop_stays_responsive_during_slow_backend():
+    """A cheap handler (e.g. /status) is not stalled by in-flight generations."""
+
+    async def run():
+        generations = [asyncio.create_task(run_in_backend("llm", slow_backend, 0.5, "ok")) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        await asyncio.sleep(0)  # stands in for a cheap handler
+        status_latency = time.perf_counter() - start
+        results = await asyncio.gather(*generations)
+        return status_latency, results
+
+    status_latency, results = asyncio.run(run())
+    assert status_latency < 0.05
+    assert results == ["ok"] * 4
+    assert "llm" in backend_stats()
+
+
+def test_light_sessions_keep_flat_latency_under_heavy_burst():
+    """Load test: a heavy session's burst does not raise the latency of light sessions (stub backend)."""
+    service_time = 0.05
+
+    def light_latencies(scheduler, light_session):
+        async def generate(session_id):
+            start = time.perf_counter()
+            async with scheduler.slot(session_id):
+                await asyncio.sleep(service_time)  # stub upstream generation
+            return time.perf_counter() - start
+
+        async def run():
+            burst = [asyncio.create_task(generate("heavy")) for _ in range(40)]
+            light = []
+            for i in range(8):
+                await asyncio.sleep(0.03)
+                light.append(asyncio.create_task(generate(light_session(i))))
+            light_results = await asyncio.gather(*light)
+            await asyncio.gather(*burst)
+            return light_results
+
+        return asyncio.run(run())
+
+    # Without per-session queuing every request waits behind the burst (FIFO)
+    fifo = light_latencies(FairScheduler("llm", max_concurrency=4, session_max_concurrency=4, session_max_queued=100), lambda i: "heavy")
+    fair = light_latencies(FairScheduler("llm", max_concurrency=4, session_max_concurrency=3, session_max_queued=100), lambda i: f"light-{i}")
+
+    assert max(fifo) > 0.3
+    # Light requests start at once or after one generation at most
+    assert max(fair) < 2.5 * service_time